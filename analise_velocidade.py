@@ -0,0 +1,137 @@
+import os
+from dotenv import load_dotenv
+load_dotenv()
+import numpy as np
+
+# Perfil de velocidade de uma viagem a partir das posições da HistoryPosition,
+# calculado numa única passada vetorizada: velocidade máxima, tempo e
+# distância acima de cada limite, episódios de excesso sustentado e distância
+# percorrida (haversine). Cada trecho entre duas posições consecutivas herda a
+# velocidade da posição inicial; trechos com intervalo maior que
+# VELOCIDADE_GAP_MAXIMO_S são tratados como falta de sinal e não contam tempo.
+VELOCIDADE_LIMITES = [float(v) for v in os.getenv("POWERBI_VELOCIDADE_LIMITES", "70,80,90").split(",")]
+VELOCIDADE_EPISODIO_MINIMO_S = int(os.getenv("POWERBI_VELOCIDADE_EPISODIO_MINIMO_S", "30"))
+VELOCIDADE_GAP_MAXIMO_S = int(os.getenv("POWERBI_VELOCIDADE_GAP_MAXIMO_S", "300"))
+
+RAIO_TERRA_KM = 6371.0088
+
+# Severidade pelo maior limite ultrapassado (índice em VELOCIDADE_LIMITES)
+SEVERIDADES = ["Leve", "Moderada", "Grave"]
+
+def arrays_posicoes(posicoes):
+    """(tempos epoch s, velocidades, latitudes, longitudes) ordenados por EventDate."""
+    tempos, velocidades, latitudes, longitudes = [], [], [], []
+    for pos in posicoes:
+        evento = pos.get("EventDate")
+        if not evento or len(evento) < 19:
+            continue
+        tempos.append(evento[:19])
+        velocidades.append(pos.get("Velocity") or 0)
+        latitudes.append(pos.get("Latitude") if pos.get("Latitude") is not None else np.nan)
+        longitudes.append(pos.get("Longitude") if pos.get("Longitude") is not None else np.nan)
+    t = np.array(tempos, dtype="datetime64[s]").astype(np.int64)
+    ordem = np.argsort(t, kind="stable")
+    return (
+        t[ordem],
+        np.asarray(velocidades, dtype=np.float64)[ordem],
+        np.asarray(latitudes, dtype=np.float64)[ordem],
+        np.asarray(longitudes, dtype=np.float64)[ordem],
+    )
+
+def distancias_haversine(lat, lon):
+    """Distância em km entre posições consecutivas (len(lat) - 1 valores)."""
+    lat_r = np.radians(lat)
+    lon_r = np.radians(lon)
+    dlat = np.diff(lat_r)
+    dlon = np.diff(lon_r)
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat_r[:-1]) * np.cos(lat_r[1:]) * np.sin(dlon / 2) ** 2
+    d = 2 * RAIO_TERRA_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+    return np.nan_to_num(d, nan=0.0)
+
+def episodios(acima, t, minimo_s, gap_maximo_s=None):
+    """
+    Durações (s) das sequências contínuas de posições em que `acima` é
+    verdadeiro, descartando as menores que minimo_s. Um intervalo maior que
+    gap_maximo_s (padrão VELOCIDADE_GAP_MAXIMO_S) é falta de sinal: encerra a
+    sequência e não conta tempo, como em tempo_acima_s.
+    """
+    if not acima.any():
+        return np.empty(0, dtype=np.int64)
+    gap = VELOCIDADE_GAP_MAXIMO_S if gap_maximo_s is None else gap_maximo_s
+    dt = np.diff(t).astype(np.float64)
+    corte = dt > gap
+    dt[corte] = 0.0
+    acumulado = np.concatenate(([0.0], np.cumsum(dt)))
+
+    # A sequência segue da posição k para k + 1 se ambas estão acima e não há corte entre elas
+    segue = acima[:-1] & acima[1:] & ~corte
+    inicios = np.flatnonzero(acima & ~np.concatenate(([False], segue)))
+    ultimos = np.flatnonzero(acima & ~np.concatenate((segue, [False])))
+    # O episódio dura até a posição seguinte à última da sequência (ou a
+    # última do array); um corte ali já tem dt zerado
+    fins = np.minimum(ultimos + 1, len(t) - 1)
+    duracoes = np.rint(acumulado[fins] - acumulado[inicios]).astype(np.int64)
+    return duracoes[duracoes >= minimo_s]
+
+def _severidade(velocidade_maxima, limites):
+    ultrapassados = sum(1 for limite in limites if velocidade_maxima > limite)
+    if not ultrapassados:
+        return None
+    return SEVERIDADES[min(ultrapassados - 1, len(SEVERIDADES) - 1)]
+
+def perfil_velocidade(posicoes, limites=None, episodio_minimo_s=None):
+    """
+    Calcula o perfil de velocidade de uma lista de posições.
+    Retorna um dict com velocidade_maxima, distancia_percorrida_km, o tempo (s)
+    e a distância (km) acima de cada limite, os episódios de excesso sustentado
+    acima do primeiro limite e a severidade (None se não houve excesso).
+    """
+    limites = sorted(limites or VELOCIDADE_LIMITES)
+    minimo_s = VELOCIDADE_EPISODIO_MINIMO_S if episodio_minimo_s is None else episodio_minimo_s
+    t, v, lat, lon = arrays_posicoes(posicoes)
+
+    velocidade_maxima = float(v.max()) if len(v) else 0.0
+    perfil = {
+        "posicoes": int(len(t)),
+        "velocidade_maxima": velocidade_maxima,
+        "distancia_percorrida_km": 0.0,
+        "tempo_acima_s": {limite: 0 for limite in limites},
+        "distancia_acima_km": {limite: 0.0 for limite in limites},
+        "episodios_excesso": 0,
+        "maior_episodio_s": 0,
+        "severidade": _severidade(velocidade_maxima, limites),
+    }
+    if len(t) < 2:
+        return perfil
+
+    dt = np.diff(t).astype(np.float64)
+    dt[dt > VELOCIDADE_GAP_MAXIMO_S] = 0.0
+    dist = distancias_haversine(lat, lon)
+    v_trecho = v[:-1]
+
+    # Matriz limites x trechos: todos os limites numa única operação
+    acima = v_trecho[np.newaxis, :] > np.asarray(limites)[:, np.newaxis]
+    tempo_acima = acima @ dt
+    distancia_acima = acima @ dist
+
+    perfil["distancia_percorrida_km"] = float(dist.sum())
+    perfil["tempo_acima_s"] = {limite: int(round(tempo_acima[i])) for i, limite in enumerate(limites)}
+    perfil["distancia_acima_km"] = {limite: float(distancia_acima[i]) for i, limite in enumerate(limites)}
+
+    episodios_acima = episodios(v > limites[0], t, minimo_s)
+    perfil["episodios_excesso"] = int(len(episodios_acima))
+    perfil["maior_episodio_s"] = int(episodios_acima.max()) if len(episodios_acima) else 0
+    return perfil
+
+def colunas_informacoes(perfil):
+    """Valores do perfil no formato das colunas de informacoes (limite principal)."""
+    limite = min(perfil["tempo_acima_s"])
+    return {
+        "velocidade_maxima": round(perfil["velocidade_maxima"], 2),
+        "tempo_acima_limite_s": perfil["tempo_acima_s"][limite],
+        "distancia_acima_limite_km": round(perfil["distancia_acima_km"][limite], 3),
+        "episodios_excesso": perfil["episodios_excesso"],
+        "maior_episodio_s": perfil["maior_episodio_s"],
+        "distancia_percorrida_km": round(perfil["distancia_percorrida_km"], 3),
+        "severidade_velocidade": perfil["severidade"],
+    }
@@ -10,7 +10,9 @@ from apscheduler.schedulers.blocking import BlockingScheduler
 from grid import processar_grid
 from ultima_execucao import atualizar_ultima_execucao
 from routeviolation import routeviolation, verificar_violações_por_velocidade, refresh_mv
-from remover_rotas_canceladas import remover_rotas_canceladas
+from remover_rotas_canceladas import reconciliar_rotas
+from reconstrucao_viagens import reconstruir_viagens
+from desvio_rota import preparar_referencias
 
 def log_execution_time(func):
     def wrapper():
@@ -48,6 +50,16 @@ def refresh_mv_job():
     except Exception as e:
         logging.exception(f"Erro crítico no job refresh_mv_job: {e}")
 
+def refresh_mv_completo_job():
+    logging.info("Iniciando job: refresh_mv_completo_job")
+    try:
+        start_time = time.time()
+        refresh_mv(completo=True)
+        elapsed_time = time.time() - start_time
+        logging.info(f"Job refresh_mv_completo_job finalizado em {elapsed_time:.2f} segundos.")
+    except Exception as e:
+        logging.exception(f"Erro crítico no job refresh_mv_completo_job: {e}")
+
 def tags_job():
     logging.info("Iniciando job: tags_job")
     try:
@@ -93,6 +105,13 @@ scheduler.add_job(
     max_instances=1,
     coalesce=True,
 )
+scheduler.add_job(
+    func=log_execution_time(reconstruir_viagens),
+    trigger="interval",
+    minutes=10,
+    max_instances=1,
+    coalesce=True,
+)
 scheduler.add_job(
     func=log_execution_time(routeviolation_completo),
     trigger="interval",
@@ -100,6 +119,13 @@ scheduler.add_job(
     max_instances=1,
     coalesce=True,
 )
+scheduler.add_job(
+    func=log_execution_time(preparar_referencias),
+    trigger="interval",
+    minutes=30,
+    max_instances=1,
+    coalesce=True,
+)
 scheduler.add_job(
     func=refresh_mv_job,
     trigger="interval",
@@ -107,6 +133,16 @@ scheduler.add_job(
     max_instances=1,
     coalesce=True,
 )
+# Reconstrução completa diária: corrige o que o incremental não enxerga
+# (ex.: alterações em graderumocerto)
+scheduler.add_job(
+    func=refresh_mv_completo_job,
+    trigger="cron",
+    hour="3",
+    minute="30",
+    max_instances=1,
+    coalesce=True,
+)
 scheduler.add_job(
     func=log_execution_time(tags_job),
     trigger="cron",
@@ -116,7 +152,7 @@ scheduler.add_job(
     coalesce=True,
 )
 scheduler.add_job(
-    func=log_execution_time(remover_rotas_canceladas),
+    func=log_execution_time(reconciliar_rotas),
     trigger="cron",
     hour="19",
     minute="0",
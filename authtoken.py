@@ -1,27 +1,120 @@
 import os
 from dotenv import load_dotenv
 load_dotenv()
-import requests
+import base64
+import json
+import threading
+import time
+import satx_client
 
-def obter_token():
-    auth_url = "https://integration.systemsatx.com.br/Login"
+# Cache de token compartilhado por todos os jobs do processo.
+# O token é renovado antes de expirar (SATX_TOKEN_MARGEM_SEGUNDOS) e, se
+# SATX_TOKEN_CACHE_ARQUIVO estiver definido, persistido em disco para que um
+# worker reiniciado reaproveite um token ainda válido.
+TOKEN_TTL_PADRAO = int(os.getenv("SATX_TOKEN_TTL_SEGUNDOS", "3600"))
+TOKEN_MARGEM = int(os.getenv("SATX_TOKEN_MARGEM_SEGUNDOS", "300"))
+TOKEN_CACHE_ARQUIVO = os.getenv("SATX_TOKEN_CACHE_ARQUIVO")
+
+_token_lock = threading.Lock()
+_token_cache = {"token": None, "expira_em": 0.0}
+
+def _expiracao_jwt(token):
+    # Tokens JWT trazem o instante de expiração no claim "exp"
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        exp = json.loads(base64.urlsafe_b64decode(payload)).get("exp")
+        return float(exp) if exp else None
+    except Exception:
+        return None
+
+def _calcular_expiracao(token, auth_data):
+    exp = _expiracao_jwt(token)
+    if exp:
+        return exp
+    expires_in = auth_data.get("ExpiresIn") or auth_data.get("expires_in")
+    try:
+        if expires_in:
+            return time.time() + float(expires_in)
+    except (TypeError, ValueError):
+        pass
+    return time.time() + TOKEN_TTL_PADRAO
+
+def _token_valido(expira_em):
+    return time.time() < expira_em - TOKEN_MARGEM
+
+def _carregar_token_arquivo():
+    if not TOKEN_CACHE_ARQUIVO or not os.path.exists(TOKEN_CACHE_ARQUIVO):
+        return
+    try:
+        with open(TOKEN_CACHE_ARQUIVO, "r", encoding="utf-8") as f:
+            dados = json.load(f)
+        if dados.get("token") and _token_valido(float(dados.get("expira_em", 0))):
+            _token_cache["token"] = dados["token"]
+            _token_cache["expira_em"] = float(dados["expira_em"])
+    except Exception as e:
+        print("Erro ao ler cache de token:", e)
+
+def _salvar_token_arquivo():
+    if not TOKEN_CACHE_ARQUIVO:
+        return
+    tmp = f"{TOKEN_CACHE_ARQUIVO}.tmp"
+    try:
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(_token_cache, f)
+        os.replace(tmp, TOKEN_CACHE_ARQUIVO)
+    except Exception as e:
+        print("Erro ao salvar cache de token:", e)
+
+def _login():
     params = {
         "Username": os.getenv("SATX_USERNAME"),
         "Password": os.getenv("SATX_PASSWORD")
     }
-    auth_response = requests.post(auth_url, params=params)
+    auth_response = satx_client.post(satx_client.LOGIN, params=params)
     if auth_response.status_code == 200:
         auth_data = auth_response.json()
         token = auth_data.get("AccessToken")
         if token:
             print("Token obtido com sucesso!")
-            return token
+            return token, _calcular_expiracao(token, auth_data)
         else:
             print("Token não encontrado na resposta.")
-            return None
+            return None, 0.0
     else:
         print("Erro na autenticação:", auth_response.status_code, auth_response.text)
-        return None
+        return None, 0.0
+
+def obter_token(forcar_renovacao=False):
+    # O lock é mantido durante o login: jobs concorrentes esperam e reutilizam
+    # o mesmo token em vez de abrir logins paralelos.
+    with _token_lock:
+        if not forcar_renovacao:
+            if _token_cache["token"] is None:
+                _carregar_token_arquivo()
+            if _token_cache["token"] and _token_valido(_token_cache["expira_em"]):
+                return _token_cache["token"]
+
+        token, expira_em = _login()
+        if token:
+            _token_cache["token"] = token
+            _token_cache["expira_em"] = expira_em
+            _salvar_token_arquivo()
+        return token
+
+def invalidar_token(token=None):
+    # Descarta o token em cache (ex.: após um 401). Se `token` for informado,
+    # só invalida quando ainda for o mesmo, evitando descartar um já renovado.
+    with _token_lock:
+        if token is None or _token_cache["token"] == token:
+            _token_cache["token"] = None
+            _token_cache["expira_em"] = 0.0
+            if TOKEN_CACHE_ARQUIVO and os.path.exists(TOKEN_CACHE_ARQUIVO):
+                try:
+                    os.remove(TOKEN_CACHE_ARQUIVO)
+                except OSError:
+                    pass
 
 if __name__ == '__main__':
-    obter_token()
\ No newline at end of file
+    obter_token()
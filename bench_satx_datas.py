@@ -0,0 +1,98 @@
+"""
+Benchmark das conversões de data da SATX: funções antigas (strptime/strftime,
+dateutil.isoparse, parser.parse + pytz.localize) contra satx_datas, num
+payload sintético de 100 mil linhas.
+
+    python bench_satx_datas.py [linhas]
+"""
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+import pytz
+import dateutil.parser
+from dateutil import parser
+
+import satx_datas
+
+PARANA_TZ = pytz.timezone("America/Sao_Paulo")
+
+# --- implementações anteriores, copiadas para comparação ---
+
+def format_date_antigo(date_str):
+    if not date_str:
+        return None
+    try:
+        dt = datetime.strptime(date_str, "%Y-%m-%dT%H:%M:%SZ")
+        return dt.strftime("%d/%m/%Y %H:%M:%S")
+    except Exception:
+        return date_str
+
+def ajustar_timestamp_antigo(dt_str, shift_hours=3):
+    if not dt_str:
+        return dt_str
+    try:
+        dt = dateutil.parser.isoparse(dt_str) - timedelta(hours=shift_hours)
+        return dt.strftime('%Y-%m-%d %H:%M:%S')
+    except Exception:
+        return dt_str
+
+def derivar_data_antigo(event_date_str, fallback_date):
+    try:
+        dt = dateutil.parser.isoparse(event_date_str) - timedelta(hours=3)
+        return dt.strftime('%Y-%m-%d')
+    except Exception:
+        return fallback_date.strftime('%Y-%m-%d')
+
+def janela_utc_antiga(start):
+    start_dt = parser.parse(start, dayfirst=True)
+    start_dt = PARANA_TZ.localize(start_dt)
+    return start_dt.astimezone(pytz.utc).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+# --- payload ---
+
+def gerar_payload(linhas):
+    # Horários de grade se repetem muito (mesmos minutos em várias rotas/dias)
+    random.seed(42)
+    base = datetime(2024, 5, 10)
+    iso = []
+    for _ in range(linhas):
+        dt = base + timedelta(days=random.randint(0, 9), minutes=random.randint(300, 1200) // 5 * 5)
+        iso.append(dt.strftime("%Y-%m-%dT%H:%M:%SZ"))
+    br = [format_date_antigo(s) for s in iso]
+    return iso, br
+
+def medir(nome, func):
+    inicio = time.perf_counter()
+    func()
+    decorrido = time.perf_counter() - inicio
+    print(f"{nome:<45} {decorrido * 1000:10.1f} ms")
+    return decorrido
+
+def main(linhas):
+    iso, br = gerar_payload(linhas)
+    fallback = datetime(2024, 5, 10)
+    print(f"Payload: {linhas} linhas, {len(set(iso))} horários distintos\n")
+
+    print("grid.format_date (4 campos por linha)")
+    a = medir("  strptime + strftime", lambda: [format_date_antigo(s) for s in iso for _ in range(4)])
+    satx_datas.satx_para_br.cache_clear()
+    b = medir("  satx_datas.satx_para_br", lambda: [satx_datas.satx_para_br(s) for s in iso for _ in range(4)])
+    print(f"  ganho: {a / b:.1f}x\n")
+
+    print("tags: horário local + data de execução")
+    a = medir("  isoparse duas vezes", lambda: [(ajustar_timestamp_antigo(s), derivar_data_antigo(s, fallback)) for s in iso])
+    satx_datas.iso_para_local.cache_clear()
+    b = medir("  satx_datas.iso_para_local", lambda: [satx_datas.iso_para_local(s) for s in iso])
+    print(f"  ganho: {a / b:.1f}x\n")
+
+    print("routeviolation: janela UTC da HistoryPosition")
+    a = medir("  parser.parse + localize", lambda: [janela_utc_antiga(s) for s in br])
+    satx_datas.br_para_datetime.cache_clear()
+    b = medir("  br_para_datetime + local_para_utc",
+              lambda: [satx_datas.local_para_utc(satx_datas.br_para_datetime(s)) for s in br])
+    print(f"  ganho: {a / b:.1f}x\n")
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000)
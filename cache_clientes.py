@@ -0,0 +1,68 @@
+import os
+from dotenv import load_dotenv
+load_dotenv()
+import threading
+import time
+
+# Caches de mapeamentos de rota compartilhados pelos jobs do processo.
+# O mapeamento rota -> client_name de historico_grades é carregado uma vez
+# (uma única consulta agregada) e depois mantido pelas próprias gravações do
+# processar_grid; o mapeamento rota -> route_name de graderumocerto é usado
+# pelo remover_rotas_canceladas. Ambos expiram após POWERBI_CACHE_ROTAS_TTL_SEGUNDOS
+# e são recarregados na próxima consulta.
+CACHE_TTL = int(os.getenv("POWERBI_CACHE_ROTAS_TTL_SEGUNDOS", "3600"))
+
+_cache_lock = threading.Lock()
+_clientes = {"dados": None, "expira_em": 0.0}
+_graderumocerto = {"dados": None, "expira_em": 0.0}
+
+def _expirado(cache):
+    return cache["dados"] is None or time.time() >= cache["expira_em"]
+
+def _carregar_clientes(cursor):
+    cursor.execute("""
+        SELECT route_integration_code, MAX(client_name)
+        FROM historico_grades
+        WHERE client_name IS NOT NULL AND client_name <> ''
+        GROUP BY route_integration_code
+    """)
+    return {r[0]: r[1] for r in cursor.fetchall() if r[0]}
+
+def _carregar_graderumocerto(cursor):
+    cursor.execute("SELECT route_integration_code, route_name FROM graderumocerto")
+    return {r[0]: r[1] for r in cursor.fetchall() if r[0]}
+
+def _obter(cache, cursor, carregar):
+    with _cache_lock:
+        if _expirado(cache):
+            cache["dados"] = carregar(cursor)
+            cache["expira_em"] = time.time() + CACHE_TTL
+            print(f"Cache de rotas carregado: {len(cache['dados'])} entradas")
+        return cache["dados"]
+
+def clientes_por_rota(cursor, codigos):
+    """
+    Retorna {route_integration_code: client_name} para os códigos informados
+    que tenham cliente conhecido, consultando o banco só quando o cache expira.
+    """
+    dados = _obter(_clientes, cursor, _carregar_clientes)
+    return {c: dados[c] for c in codigos if c in dados}
+
+def registrar_clientes(pares):
+    """Atualiza o cache com os pares (route_integration_code, client_name) gravados."""
+    with _cache_lock:
+        if _clientes["dados"] is None:
+            return
+        for codigo, client_name in pares:
+            if codigo and client_name:
+                _clientes["dados"][codigo] = client_name
+
+def rotas_graderumocerto(cursor):
+    """Retorna {route_integration_code: route_name} de graderumocerto (route_name pode ser None)."""
+    return _obter(_graderumocerto, cursor, _carregar_graderumocerto)
+
+def invalidar_cache():
+    with _cache_lock:
+        for cache in (_clientes, _graderumocerto):
+            cache["dados"] = None
+            cache["expira_em"] = 0.0
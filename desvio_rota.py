@@ -0,0 +1,388 @@
+import os
+from dotenv import load_dotenv
+load_dotenv()
+import json
+import threading
+import time
+import mysql.connector
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from authtoken import obter_token
+from migracoes import aplicar_migracoes
+
+import posicoes_cache
+import satx_datas
+
+# Detecção geométrica de desvio de rota. Para cada rota/sentido monta-se uma
+# referência com as trilhas de viagens recentes sem não conformidade (o
+# conjunto de segmentos entre posições consecutivas), guardada em
+# rotas_referencia. Na consulta, os segmentos ficam num índice de grade
+# (células de DESVIO_CELULA_M metros) e a distância de cada posição até o
+# segmento mais próximo é calculada de forma vetorizada só contra os
+# segmentos das células vizinhas. As referências são montadas pelo job
+# preparar_referencias (buscas em paralelo); a verificação de velocidade só
+# as consulta e pula a medição de desvio quando ainda não existem. O mesmo
+# job mede depois as viagens classificadas sem referência
+# (desvio_medido_em NULL) dos últimos DESVIO_REMEDICAO_DIAS dias.
+DESVIO_LIMIAR_M = float(os.getenv("POWERBI_DESVIO_LIMIAR_M", "150"))
+DESVIO_CELULA_M = float(os.getenv("POWERBI_DESVIO_CELULA_M", "250"))
+DESVIO_ESPACAMENTO_M = float(os.getenv("POWERBI_DESVIO_ESPACAMENTO_M", "15"))
+DESVIO_GAP_MAXIMO_S = int(os.getenv("POWERBI_DESVIO_GAP_MAXIMO_S", "300"))
+REFERENCIA_VIAGENS = int(os.getenv("POWERBI_REFERENCIA_VIAGENS", "3"))
+REFERENCIA_JANELA_DIAS = int(os.getenv("POWERBI_REFERENCIA_JANELA_DIAS", "30"))
+REFERENCIA_VALIDADE_DIAS = int(os.getenv("POWERBI_REFERENCIA_VALIDADE_DIAS", "7"))
+# Intervalo até reconsultar rotas_referencia depois de não achar a referência
+REFERENCIA_RECONSULTA_S = int(os.getenv("POWERBI_REFERENCIA_RECONSULTA_S", "300"))
+REFERENCIA_CONCORRENCIA = int(os.getenv("POWERBI_REFERENCIA_CONCORRENCIA", "4"))
+# Segmentos mais longos que isto são saltos de GPS e não entram no índice
+DESVIO_SEGMENTO_MAXIMO_M = float(os.getenv("POWERBI_DESVIO_SEGMENTO_MAXIMO_M", "2000"))
+DESVIO_REMEDICAO_DIAS = int(os.getenv("POWERBI_DESVIO_REMEDICAO_DIAS", "10"))
+DESVIO_REMEDICAO_LOTE = int(os.getenv("POWERBI_DESVIO_REMEDICAO_LOTE", "200"))
+
+# Viagens já classificadas pela velocidade cujo desvio ainda não foi medido
+SEM_DESVIO_MEDIDO = """
+    i.desvio_medido_em IS NULL
+    AND i.violation_type IN ('Velocidade Excedida', 'Desvio de Rota')
+    AND i.data_execucao >= CURDATE() - INTERVAL %s DAY
+"""
+
+RAIO_TERRA_M = 6371008.8
+
+_indices = {}
+_indices_lock = threading.Lock()
+
+class IndiceGrade:
+    """
+    Segmentos de referência projetados em metros (equiretangular local) e
+    distribuídos em células quadradas de lado `celula` metros.
+    """
+    def __init__(self, trilhas, celula=DESVIO_CELULA_M):
+        self.celula = celula
+        pontos = np.concatenate([np.asarray(t, dtype=np.float64) for t in trilhas])
+        self.lat0 = np.radians(pontos[:, 0].mean())
+        self.lon0 = np.radians(pontos[:, 1].mean())
+
+        inicios, fins = [], []
+        for trilha in trilhas:
+            xy = self.projetar(np.asarray(trilha, dtype=np.float64))
+            inicios.append(xy[:-1])
+            fins.append(xy[1:])
+        a = np.concatenate(inicios)
+        b = np.concatenate(fins)
+        comprimento = np.hypot(*(b - a).T)
+        validos = comprimento <= DESVIO_SEGMENTO_MAXIMO_M
+        if not validos.any():
+            validos[:] = True
+        self.a, self.b, comprimento = a[validos], b[validos], comprimento[validos]
+
+        # Cada segmento é amostrado ao longo da linha a cada meia célula e
+        # entra nas células das amostras: custo proporcional ao comprimento,
+        # não à área do retângulo envolvente. Toda posição do segmento fica a
+        # menos de uma célula de uma amostra, o que a vizinhança 3x3 cobre.
+        passos = np.maximum(1, np.ceil(comprimento / (celula / 2))).astype(np.int64)
+        amostras = passos + 1
+        segmento = np.repeat(np.arange(len(self.a)), amostras)
+        primeira = np.repeat(np.cumsum(amostras) - amostras, amostras)
+        fracao = (np.arange(len(segmento)) - primeira) / np.repeat(passos, amostras)
+        pontos = self.a[segmento] + fracao[:, np.newaxis] * (self.b - self.a)[segmento]
+        celula_amostra = np.floor(pontos / celula).astype(np.int64)
+        pares = np.unique(np.column_stack((celula_amostra, segmento)), axis=0)
+        quebras = np.flatnonzero(np.any(np.diff(pares[:, :2], axis=0) != 0, axis=1)) + 1
+        self.celulas = {(int(g[0, 0]), int(g[0, 1])): g[:, 2] for g in np.split(pares, quebras)}
+
+    def projetar(self, latlon):
+        lat = np.radians(latlon[:, 0])
+        lon = np.radians(latlon[:, 1])
+        return np.column_stack(((lon - self.lon0) * np.cos(self.lat0) * RAIO_TERRA_M,
+                                (lat - self.lat0) * RAIO_TERRA_M))
+
+    def _distancias_segmentos(self, p, ids):
+        # Distância ponto-segmento em matriz (pontos x segmentos)
+        a = self.a[ids][np.newaxis, :, :]
+        ab = self.b[ids][np.newaxis, :, :] - a
+        ap = p[:, np.newaxis, :] - a
+        comprimento2 = (ab ** 2).sum(axis=2)
+        t = np.where(comprimento2 > 0, (ap * ab).sum(axis=2) / np.where(comprimento2 > 0, comprimento2, 1), 0)
+        t = np.clip(t, 0.0, 1.0)
+        proximo = ap - t[:, :, np.newaxis] * ab
+        return np.sqrt((proximo ** 2).sum(axis=2)).min(axis=1)
+
+    def distancias(self, latlon):
+        """Distância em metros de cada posição (lat, lon) até a referência."""
+        p = self.projetar(np.asarray(latlon, dtype=np.float64))
+        resultado = np.full(len(p), np.inf)
+        if not len(p):
+            return resultado
+        celula_ponto = np.floor(p / self.celula).astype(np.int64)
+        unicas, inverso = np.unique(celula_ponto, axis=0, return_inverse=True)
+        inverso = inverso.reshape(-1)
+        for k, (cx, cy) in enumerate(unicas):
+            vizinhos = [self.celulas[c] for c in ((cx + dx, cy + dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1))
+                        if c in self.celulas]
+            if not vizinhos:
+                continue
+            ids = np.unique(np.concatenate(vizinhos))
+            sel = inverso == k
+            resultado[sel] = self._distancias_segmentos(p[sel], ids)
+
+        # Além de uma célula o vizinho mais próximo pode estar fora da vizinhança:
+        # calcula contra todos os segmentos, em blocos
+        longe = np.flatnonzero(resultado > self.celula)
+        todos = np.arange(len(self.a))
+        for inicio in range(0, len(longe), 256):
+            bloco = longe[inicio:inicio + 256]
+            resultado[bloco] = self._distancias_segmentos(p[bloco], todos)
+        return resultado
+
+def _simplificar(pontos):
+    # Descarta posições a menos de DESVIO_ESPACAMENTO_M da última mantida
+    mantidos = [pontos[0]]
+    lat0 = np.radians(pontos[0][0])
+    for lat, lon in pontos[1:]:
+        ult_lat, ult_lon = mantidos[-1]
+        dx = np.radians(lon - ult_lon) * np.cos(lat0) * RAIO_TERRA_M
+        dy = np.radians(lat - ult_lat) * RAIO_TERRA_M
+        if dx * dx + dy * dy >= DESVIO_ESPACAMENTO_M ** 2:
+            mantidos.append((lat, lon))
+    return mantidos
+
+def _trilha(posicoes):
+    pontos = [(p["Latitude"], p["Longitude"]) for p in posicoes
+              if p.get("Latitude") is not None and p.get("Longitude") is not None]
+    if len(pontos) < 2:
+        return None
+    trilha = _simplificar(pontos)
+    return trilha if len(trilha) >= 2 else None
+
+def garantir_tabela_referencias(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS rotas_referencia (
+            route_key VARCHAR(255) NOT NULL,
+            direcao VARCHAR(255) NOT NULL,
+            trilhas LONGTEXT NOT NULL,
+            viagens INT NOT NULL,
+            atualizado_em DATETIME NOT NULL,
+            PRIMARY KEY (route_key, direcao)
+        )
+    """)
+
+def _viagens_conformes(cursor, route_key, direcao):
+    # Viagens recentes da rota sem registro de não conformidade no dia
+    consulta = """
+        SELECT h.real_vehicle, h.real_departure_dt, h.real_arrival_dt
+        FROM historico_grades h
+        WHERE h.route_key = %s
+          {filtro_direcao}
+          AND h.real_vehicle IS NOT NULL
+          AND h.real_departure_dt IS NOT NULL AND h.real_arrival_dt > h.real_departure_dt
+          AND h.data_registro >= CURDATE() - INTERVAL %s DAY
+          AND NOT EXISTS (
+              SELECT 1 FROM informacoes i
+              WHERE i.route_key = h.route_key AND i.data_execucao = h.data_registro
+          )
+        ORDER BY h.real_departure_dt DESC
+        LIMIT %s
+    """
+    cursor.execute(consulta.format(filtro_direcao="AND TRIM(LOWER(h.direction_name)) = %s"),
+                   (route_key, direcao, REFERENCIA_JANELA_DIAS, REFERENCIA_VIAGENS))
+    viagens = cursor.fetchall()
+    if not viagens:
+        # Sentido pode vir escrito de outra forma na grade: usa a rota inteira
+        cursor.execute(consulta.format(filtro_direcao=""), (route_key, REFERENCIA_JANELA_DIAS, REFERENCIA_VIAGENS))
+        viagens = cursor.fetchall()
+    return viagens
+
+def _posicoes_viagem(token, viagem):
+    veiculo, partida, chegada = viagem
+    try:
+        return posicoes_cache.posicoes_na_janela(
+            token, veiculo, satx_datas.local_para_utc(partida), satx_datas.local_para_utc(chegada)
+        )
+    except Exception as e:
+        print(f"Erro buscando posições de {veiculo}: {e}")
+        return None
+
+def construir_referencia(conn, token, route_key, direcao, executor=None):
+    """
+    Monta e grava a referência da rota/sentido, buscando as viagens em
+    paralelo quando recebe um executor. Retorna as trilhas ou None.
+    """
+    cursor = conn.cursor()
+    viagens = _viagens_conformes(cursor, route_key, direcao)
+    mapear = executor.map if executor else map
+    trilhas = []
+    for posicoes in mapear(lambda viagem: _posicoes_viagem(token, viagem), viagens):
+        trilha = _trilha(posicoes) if posicoes else None
+        if trilha:
+            trilhas.append(trilha)
+    if not trilhas:
+        cursor.close()
+        return None
+    cursor.execute("""
+        INSERT INTO rotas_referencia (route_key, direcao, trilhas, viagens, atualizado_em)
+        VALUES (%s, %s, %s, %s, NOW())
+        ON DUPLICATE KEY UPDATE trilhas = VALUES(trilhas), viagens = VALUES(viagens), atualizado_em = VALUES(atualizado_em)
+    """, (route_key, direcao, json.dumps(trilhas), len(trilhas)))
+    conn.commit()
+    cursor.close()
+    # Descarta uma ausência guardada em memória para que a referência nova seja lida
+    with _indices_lock:
+        _indices.pop((route_key, direcao), None)
+    print(f"🗺️ Referência de {route_key} ({direcao}) montada com {len(trilhas)} viagens")
+    return trilhas
+
+def obter_indice(conn, token, route_name, direcao, construir=True):
+    """
+    Índice de grade da referência da rota/sentido (memória -> rotas_referencia
+    -> montagem a partir das viagens conformes). None se não houver referência.
+    Com construir=False não monta nada: a ausência fica para o
+    preparar_referencias e é reconsultada após REFERENCIA_RECONSULTA_S.
+    """
+    # Mesma normalização de TRIM(LOWER(...)) usada em route_key
+    route_key = (route_name or "").lower().strip(" ")
+    direcao = (direcao or "").lower().strip(" ")
+    chave = (route_key, direcao)
+    agora = time.time()
+    with _indices_lock:
+        item = _indices.get(chave)
+    if item and item[1] > agora:
+        return item[0]
+
+    cursor = conn.cursor()
+    garantir_tabela_referencias(cursor)
+    cursor.execute("""
+        SELECT trilhas FROM rotas_referencia
+        WHERE route_key = %s AND direcao = %s AND atualizado_em >= NOW() - INTERVAL %s DAY
+    """, (route_key, direcao, REFERENCIA_VALIDADE_DIAS))
+    linha = cursor.fetchone()
+    cursor.close()
+    if linha:
+        trilhas = json.loads(linha[0])
+    elif construir:
+        trilhas = construir_referencia(conn, token, route_key, direcao)
+    else:
+        with _indices_lock:
+            _indices[chave] = (None, agora + REFERENCIA_RECONSULTA_S)
+        return None
+
+    indice = IndiceGrade(trilhas) if trilhas else None
+    with _indices_lock:
+        # Sem referência, tenta de novo só depois de uma hora
+        _indices[chave] = (indice, agora + (3600 if indice is None else REFERENCIA_VALIDADE_DIAS * 86400))
+    return indice
+
+def remedir_desvios(conn, token, executor):
+    """
+    Mede o desvio das viagens classificadas antes de a referência da rota
+    existir. Retorna quantas foram medidas.
+    """
+    cursor = conn.cursor()
+    ultimo_id = 0
+    medidas = 0
+    while True:
+        cursor.execute(f"""
+            SELECT i.id, i.RouteName, i.Direction, h.real_vehicle, h.real_departure_dt, h.real_arrival_dt
+            FROM informacoes i
+            JOIN informacoes_com_cliente_mv mv ON mv.id = i.id
+            JOIN historico_grades h ON h.id = mv.id_grade
+            JOIN rotas_referencia r
+              ON r.route_key = i.route_key AND r.direcao = TRIM(LOWER(COALESCE(i.Direction, '')))
+             AND r.atualizado_em >= NOW() - INTERVAL %s DAY
+            WHERE {SEM_DESVIO_MEDIDO}
+              AND i.id > %s
+              AND h.real_vehicle IS NOT NULL
+              AND h.real_departure_dt IS NOT NULL AND h.real_arrival_dt > h.real_departure_dt
+            ORDER BY i.id
+            LIMIT %s
+        """, (REFERENCIA_VALIDADE_DIAS, DESVIO_REMEDICAO_DIAS, ultimo_id, DESVIO_REMEDICAO_LOTE))
+        linhas = cursor.fetchall()
+        if not linhas:
+            break
+        ultimo_id = linhas[-1][0]
+
+        viagens = [linha[3:] for linha in linhas]
+        medicoes = []
+        for linha, posicoes in zip(linhas, executor.map(lambda viagem: _posicoes_viagem(token, viagem), viagens)):
+            # Falha da API: fica para a próxima execução
+            if posicoes is None:
+                continue
+            indice = obter_indice(conn, token, linha[1], linha[2], construir=False)
+            if indice is None:
+                continue
+            desvio = medir_desvio(indice, posicoes)
+            medicoes.append((desvio["desvio_maximo_m"], desvio["desvio_duracao_s"], linha[0]))
+        if medicoes:
+            cursor.executemany("""
+                UPDATE informacoes SET desvio_maximo_m = %s, desvio_duracao_s = %s, desvio_medido_em = NOW()
+                WHERE id = %s
+            """, medicoes)
+            conn.commit()
+            medidas += len(medicoes)
+    cursor.close()
+    return medidas
+
+def preparar_referencias(concorrencia=None):
+    """
+    Job: monta as referências ausentes ou vencidas das rotas/sentidos com
+    viagens aguardando a verificação de velocidade ou a medição do desvio,
+    e mede o desvio das viagens classificadas antes da referência existir.
+    """
+    token = obter_token()
+    if not token:
+        print("Não foi possível obter token.")
+        return
+    conn = mysql.connector.connect(
+        host=os.getenv("POWERBI_DB_HOST"),
+        database=os.getenv("POWERBI_DB_NAME"),
+        user=os.getenv("POWERBI_DB_USER"),
+        password=os.getenv("POWERBI_DB_PASSWORD")
+    )
+    aplicar_migracoes(conn)
+    cursor = conn.cursor()
+    garantir_tabela_referencias(cursor)
+    cursor.execute(f"""
+        SELECT DISTINCT i.route_key, TRIM(LOWER(COALESCE(i.Direction, '')))
+        FROM informacoes i
+        LEFT JOIN rotas_referencia r
+          ON r.route_key = i.route_key AND r.direcao = TRIM(LOWER(COALESCE(i.Direction, '')))
+         AND r.atualizado_em >= NOW() - INTERVAL %s DAY
+        WHERE (i.violation_type IS NULL OR ({SEM_DESVIO_MEDIDO}))
+          AND i.route_key IS NOT NULL AND r.route_key IS NULL
+    """, (REFERENCIA_VALIDADE_DIAS, DESVIO_REMEDICAO_DIAS))
+    pendentes = cursor.fetchall()
+    cursor.close()
+
+    montadas = 0
+    with ThreadPoolExecutor(max_workers=concorrencia or REFERENCIA_CONCORRENCIA) as executor:
+        for route_key, direcao in pendentes:
+            if construir_referencia(conn, token, route_key, direcao, executor):
+                montadas += 1
+        medidas = remedir_desvios(conn, token, executor)
+    conn.close()
+    print(f"✅ Referências de rota: {montadas} de {len(pendentes)} montadas; {medidas} desvios medidos.")
+
+def medir_desvio(indice, posicoes):
+    """
+    Distância máxima (m) das posições até a referência e duração (s) fora dela
+    (distância acima de DESVIO_LIMIAR_M). Trechos com intervalo maior que
+    DESVIO_GAP_MAXIMO_S não contam tempo.
+    """
+    validas = [p for p in posicoes
+               if p.get("Latitude") is not None and p.get("Longitude") is not None and p.get("EventDate")]
+    if not validas:
+        return {"desvio_maximo_m": None, "desvio_duracao_s": None}
+    validas.sort(key=lambda p: p["EventDate"])
+    latlon = np.array([(p["Latitude"], p["Longitude"]) for p in validas], dtype=np.float64)
+    t = np.array([p["EventDate"][:19] for p in validas], dtype="datetime64[s]").astype(np.int64)
+
+    d = indice.distancias(latlon)
+    fora = d > DESVIO_LIMIAR_M
+    dt = np.diff(t).astype(np.float64)
+    dt[dt > DESVIO_GAP_MAXIMO_S] = 0.0
+    return {
+        "desvio_maximo_m": int(round(d.max())),
+        "desvio_duracao_s": int(round(dt[fora[:-1]].sum())),
+    }
+
+if __name__ == '__main__':
+    preparar_referencias()
@@ -2,21 +2,66 @@ import os
 from dotenv import load_dotenv
 load_dotenv()
 
-import requests
+import contextlib
 import datetime
+import hashlib
+import json
 import mysql.connector
+from mysql.connector.constants import ClientFlag
 import pytz
+import queue
+import requests
+import threading
 import time  # adicionando import time
+from concurrent.futures import ThreadPoolExecutor
 from authtoken import obter_token
+import cache_clientes
+import grid_snapshots
+from migracoes import aplicar_migracoes
+import satx_client
+import satx_datas
+
+# Quantos dias são buscados em paralelo na API (1 = modo sequencial antigo)
+# e quantos dias já baixados podem aguardar o estágio de gravação.
+GRID_CONCORRENCIA = int(os.getenv("POWERBI_GRID_CONCORRENCIA", "4"))
+GRID_FILA_MAX = int(os.getenv("POWERBI_GRID_FILA_MAX", "3"))
+
+# Política de atualização por idade do dia: hoje em toda execução, ontem a
+# cada GRID_INTERVALO_ONTEM_MIN e os demais algumas vezes ao dia. Um dia antigo
+# que mudou recentemente volta a ser tratado como "ontem".
+GRID_INTERVALO_ONTEM_MIN = int(os.getenv("POWERBI_GRID_INTERVALO_ONTEM_MIN", "30"))
+GRID_INTERVALO_ANTIGOS_MIN = int(os.getenv("POWERBI_GRID_INTERVALO_ANTIGOS_MIN", "360"))
+# Folga para o job de 10 em 10 minutos não perder a janela por alguns segundos
+GRID_FOLGA_AGENDA = datetime.timedelta(minutes=1)
+
+# Com hash por linha, dias alterados só reenviam as rotas cujo conteúdo mudou
+GRID_HASH_POR_LINHA = os.getenv("POWERBI_GRID_HASH_POR_LINHA", "1") == "1"
+
+# "executemany": upsert linha a linha (padrão). "bulk": grava o dia numa tabela
+# temporária com INSERTs de várias linhas e aplica tudo com um único
+# INSERT ... SELECT ... ON DUPLICATE KEY UPDATE, segurando os locks bem menos.
+GRID_MODO_ESCRITA = os.getenv("POWERBI_GRID_MODO_ESCRITA", "executemany")
+GRID_BULK_LINHAS = int(os.getenv("POWERBI_GRID_BULK_LINHAS", "1000"))
+
+# Streaming: lê a resposta do Grid/List incrementalmente e grava em lotes de
+# GRID_STREAMING_LOTE itens, mantendo a memória constante em dias grandes.
+GRID_STREAMING = os.getenv("POWERBI_GRID_STREAMING", "0") == "1"
+GRID_STREAMING_LOTE = int(os.getenv("POWERBI_GRID_STREAMING_LOTE", "500"))
 
 def format_date(date_str):
-    if not date_str:
+    return satx_datas.satx_para_br(date_str)
+
+def parse_date(date_str):
+    # Versão tipada de format_date/nullify_date para as colunas DATETIME
+    return satx_datas.satx_para_datetime(date_str)
+
+def to_decimal(valor):
+    if valor is None or valor == '':
         return None
     try:
-        dt = datetime.datetime.strptime(date_str, "%Y-%m-%dT%H:%M:%SZ")
-        return dt.strftime("%d/%m/%Y %H:%M:%S")
-    except Exception:
-        return date_str
+        return round(float(valor), 2)
+    except (TypeError, ValueError):
+        return None
 
 def to_iso(date_str):
     try:
@@ -30,23 +75,458 @@ def nullify_date(date_str):
          return None
     return date_str
 
-def processar_grid():
-    token = obter_token()
-    if not token:
+# Removido update separado; ON DUPLICATE KEY cuidará de atualizar (sem sobrescrever real_* com NULL)
+# As colunas *_dt/*_num espelham as VARCHAR e ficam logo após a correspondente:
+# o MySQL avalia as atribuições em ordem, então real_arrival_dt precisa vir
+# antes de real_arrival para enxergar o mesmo valor antigo.
+insert_historico_query = '''
+INSERT INTO historico_grades (
+    line, estimated_departure, estimated_arrival, real_departure, real_arrival,
+    route_integration_code, route_name, direction_name, shift,
+    estimated_vehicle, real_vehicle, estimated_distance, travelled_distance, client_name, data_registro,
+    estimated_departure_dt, estimated_arrival_dt, real_departure_dt, real_arrival_dt,
+    estimated_distance_num, travelled_distance_num
+) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+ON DUPLICATE KEY UPDATE
+    estimated_departure = IF(real_arrival IS NULL OR real_arrival = '' , VALUES(estimated_departure), estimated_departure),
+    estimated_departure_dt = IF(real_arrival IS NULL OR real_arrival = '' , VALUES(estimated_departure_dt), estimated_departure_dt),
+    estimated_arrival = IF(real_arrival IS NULL OR real_arrival = '' , VALUES(estimated_arrival), estimated_arrival),
+    estimated_arrival_dt = IF(real_arrival IS NULL OR real_arrival = '' , VALUES(estimated_arrival_dt), estimated_arrival_dt),
+    real_departure = IF(real_arrival IS NULL OR real_arrival = '' , IFNULL(VALUES(real_departure), real_departure), real_departure),
+    real_departure_dt = IF(real_arrival IS NULL OR real_arrival = '' , IFNULL(VALUES(real_departure_dt), real_departure_dt), real_departure_dt),
+    real_arrival_dt = IF(real_arrival IS NULL OR real_arrival = '' , IFNULL(VALUES(real_arrival_dt), real_arrival_dt), real_arrival_dt),
+    real_arrival = IF(real_arrival IS NULL OR real_arrival = '' , IFNULL(VALUES(real_arrival), real_arrival), real_arrival),
+    real_vehicle = IF(real_arrival IS NULL OR real_arrival = '' , IFNULL(VALUES(real_vehicle), real_vehicle), real_vehicle),
+    estimated_vehicle = IF(real_arrival IS NULL OR real_arrival = '' , VALUES(estimated_vehicle), estimated_vehicle),
+    estimated_distance = IF(real_arrival IS NULL OR real_arrival = '' , VALUES(estimated_distance), estimated_distance),
+    estimated_distance_num = IF(real_arrival IS NULL OR real_arrival = '' , VALUES(estimated_distance_num), estimated_distance_num),
+    travelled_distance = IF(real_arrival IS NULL OR real_arrival = '' , VALUES(travelled_distance), travelled_distance),
+    travelled_distance_num = IF(real_arrival IS NULL OR real_arrival = '' , VALUES(travelled_distance_num), travelled_distance_num),
+    route_name = IF(real_arrival IS NULL OR real_arrival = '' , VALUES(route_name), route_name),
+    direction_name = IF(real_arrival IS NULL OR real_arrival = '' , VALUES(direction_name), direction_name),
+    shift = IF(real_arrival IS NULL OR real_arrival = '' , VALUES(shift), shift),
+    client_name = IF(real_arrival IS NULL OR real_arrival = '' , IFNULL(VALUES(client_name), client_name), client_name),
+    line = IF(real_arrival IS NULL OR real_arrival = '' , VALUES(line), line)
+'''
+
+COLUNAS_HISTORICO = (
+    "line, estimated_departure, estimated_arrival, real_departure, real_arrival, "
+    "route_integration_code, route_name, direction_name, shift, "
+    "estimated_vehicle, real_vehicle, estimated_distance, travelled_distance, client_name, data_registro, "
+    "estimated_departure_dt, estimated_arrival_dt, real_departure_dt, real_arrival_dt, "
+    "estimated_distance_num, travelled_distance_num"
+)
+
+criar_staging_query = """
+CREATE TEMPORARY TABLE IF NOT EXISTS historico_grades_stg (
+    seq INT AUTO_INCREMENT PRIMARY KEY,
+    line VARCHAR(50),
+    estimated_departure VARCHAR(50),
+    estimated_arrival VARCHAR(50),
+    real_departure VARCHAR(50),
+    real_arrival VARCHAR(50),
+    route_integration_code VARCHAR(255),
+    route_name VARCHAR(255),
+    direction_name VARCHAR(255),
+    shift VARCHAR(50),
+    estimated_vehicle VARCHAR(255),
+    real_vehicle VARCHAR(255),
+    estimated_distance VARCHAR(50),
+    travelled_distance VARCHAR(50),
+    client_name VARCHAR(255),
+    data_registro DATE,
+    estimated_departure_dt DATETIME,
+    estimated_arrival_dt DATETIME,
+    real_departure_dt DATETIME,
+    real_arrival_dt DATETIME,
+    estimated_distance_num DECIMAL(10,2),
+    travelled_distance_num DECIMAL(10,2)
+)
+"""
+
+# Mesmas regras de insert_historico_query, aplicadas de uma vez a partir da
+# staging. As colunas do destino são qualificadas para não colidir com as da
+# staging `s`; ORDER BY seq preserva a ordem do payload e a das atribuições
+# é a mesma.
+merge_historico_query = f'''
+INSERT INTO historico_grades ({COLUNAS_HISTORICO})
+SELECT {COLUNAS_HISTORICO} FROM historico_grades_stg AS s ORDER BY s.seq
+ON DUPLICATE KEY UPDATE
+    estimated_departure = IF(historico_grades.real_arrival IS NULL OR historico_grades.real_arrival = '' , s.estimated_departure, historico_grades.estimated_departure),
+    estimated_departure_dt = IF(historico_grades.real_arrival IS NULL OR historico_grades.real_arrival = '' , s.estimated_departure_dt, historico_grades.estimated_departure_dt),
+    estimated_arrival = IF(historico_grades.real_arrival IS NULL OR historico_grades.real_arrival = '' , s.estimated_arrival, historico_grades.estimated_arrival),
+    estimated_arrival_dt = IF(historico_grades.real_arrival IS NULL OR historico_grades.real_arrival = '' , s.estimated_arrival_dt, historico_grades.estimated_arrival_dt),
+    real_departure = IF(historico_grades.real_arrival IS NULL OR historico_grades.real_arrival = '' , IFNULL(s.real_departure, historico_grades.real_departure), historico_grades.real_departure),
+    real_departure_dt = IF(historico_grades.real_arrival IS NULL OR historico_grades.real_arrival = '' , IFNULL(s.real_departure_dt, historico_grades.real_departure_dt), historico_grades.real_departure_dt),
+    real_arrival_dt = IF(historico_grades.real_arrival IS NULL OR historico_grades.real_arrival = '' , IFNULL(s.real_arrival_dt, historico_grades.real_arrival_dt), historico_grades.real_arrival_dt),
+    real_arrival = IF(historico_grades.real_arrival IS NULL OR historico_grades.real_arrival = '' , IFNULL(s.real_arrival, historico_grades.real_arrival), historico_grades.real_arrival),
+    real_vehicle = IF(historico_grades.real_arrival IS NULL OR historico_grades.real_arrival = '' , IFNULL(s.real_vehicle, historico_grades.real_vehicle), historico_grades.real_vehicle),
+    estimated_vehicle = IF(historico_grades.real_arrival IS NULL OR historico_grades.real_arrival = '' , s.estimated_vehicle, historico_grades.estimated_vehicle),
+    estimated_distance = IF(historico_grades.real_arrival IS NULL OR historico_grades.real_arrival = '' , s.estimated_distance, historico_grades.estimated_distance),
+    estimated_distance_num = IF(historico_grades.real_arrival IS NULL OR historico_grades.real_arrival = '' , s.estimated_distance_num, historico_grades.estimated_distance_num),
+    travelled_distance = IF(historico_grades.real_arrival IS NULL OR historico_grades.real_arrival = '' , s.travelled_distance, historico_grades.travelled_distance),
+    travelled_distance_num = IF(historico_grades.real_arrival IS NULL OR historico_grades.real_arrival = '' , s.travelled_distance_num, historico_grades.travelled_distance_num),
+    route_name = IF(historico_grades.real_arrival IS NULL OR historico_grades.real_arrival = '' , s.route_name, historico_grades.route_name),
+    direction_name = IF(historico_grades.real_arrival IS NULL OR historico_grades.real_arrival = '' , s.direction_name, historico_grades.direction_name),
+    shift = IF(historico_grades.real_arrival IS NULL OR historico_grades.real_arrival = '' , s.shift, historico_grades.shift),
+    client_name = IF(historico_grades.real_arrival IS NULL OR historico_grades.real_arrival = '' , IFNULL(s.client_name, historico_grades.client_name), historico_grades.client_name),
+    line = IF(historico_grades.real_arrival IS NULL OR historico_grades.real_arrival = '' , s.line, historico_grades.line)
+'''
+
+def _carregar_staging(cursor, batch_data):
+    cursor.execute(criar_staging_query)
+    cursor.execute("DELETE FROM historico_grades_stg")
+    linha_placeholders = "(" + ", ".join(["%s"] * len(COLUNAS_HISTORICO.split(","))) + ")"
+    for inicio in range(0, len(batch_data), GRID_BULK_LINHAS):
+        lote = batch_data[inicio:inicio + GRID_BULK_LINHAS]
+        valores = ", ".join([linha_placeholders] * len(lote))
+        params = [campo for linha in lote for campo in linha]
+        cursor.execute(f"INSERT INTO historico_grades_stg ({COLUNAS_HISTORICO}) VALUES {valores}", params)
+
+def _upsert_historico(cursor, batch_data):
+    # Retorna o número de linhas afetadas em historico_grades
+    if GRID_MODO_ESCRITA == "bulk":
+        _carregar_staging(cursor, batch_data)
+        cursor.execute(merge_historico_query)
+        return cursor.rowcount
+    cursor.executemany(insert_historico_query, batch_data)
+    return cursor.rowcount
+
+def _buscar_grade_dia(token, data_alvo):
+    # Reusa um snapshot recente do dia (grid_snapshots) ou busca e grava um novo
+    data_formatada = data_alvo.strftime("%d/%m/%Y")
+    data = grid_snapshots.obter_grade_dia(token, data_alvo)
+    if data is None:
+        return None
+    if not data:
+        print(f"Nenhuma grade encontrada para {data_formatada}")
+        return []
+    return data
+
+class _HashConteudo:
+    # Soma módulo 2^256 dos SHA-256 de cada item: não depende da ordem dos
+    # itens e pode ser acumulada item a item no modo streaming.
+    def __init__(self):
+        self.total = 0
+        self.quantidade = 0
+
+    def adicionar(self, item):
+        digest = hashlib.sha256(json.dumps(item, sort_keys=True).encode("utf-8")).digest()
+        self.total = (self.total + int.from_bytes(digest, "big")) % (1 << 256)
+        self.quantidade += 1
+
+    def hexdigest(self):
+        return f"{self.total:064x}"
+
+def _hash_payload(data):
+    hash_conteudo = _HashConteudo()
+    for item in data:
+        hash_conteudo.adicionar(item)
+    return hash_conteudo.hexdigest()
+
+def _hash_linha(linha):
+    return hashlib.md5(json.dumps(linha, default=str).encode("utf-8")).hexdigest()
+
+def _em_chunks(lista, tamanho=1000):
+    for c in range(0, len(lista), tamanho):
+        yield lista[c:c + tamanho]
+
+def _em_lotes(itens, tamanho):
+    lote = []
+    for item in itens:
+        lote.append(item)
+        if len(lote) >= tamanho:
+            yield lote
+            lote = []
+    if lote:
+        yield lote
+
+def _itens_nao_cancelados(itens):
+    for item in itens:
+        if item.get('IsTripCanceled') is True:
+            continue
+        yield item
+
+def _filtrar_linhas_alteradas(cursor, data_alvo, batch_data):
+    # O JOIN garante que rotas removidas do histórico (ex.: remover_rotas_canceladas)
+    # voltem a ser gravadas mesmo que o hash antigo ainda exista.
+    hashes_gravados = {}
+    codigos = list({linha[5] for linha in batch_data})
+    for chunk in _em_chunks(codigos):
+        placeholders = ','.join(['%s'] * len(chunk))
+        cursor.execute(f"""
+            SELECT l.route_integration_code, l.hash_linha
+            FROM grid_hash_linhas l
+            JOIN historico_grades h
+              ON h.route_integration_code = l.route_integration_code AND h.data_registro = l.data_registro
+            WHERE l.data_registro = %s AND l.route_integration_code IN ({placeholders})
+        """, [data_alvo.date()] + chunk)
+        for r in cursor.fetchall():
+            hashes_gravados[r[0]] = r[1]
+
+    alteradas = []
+    hashes = []
+    for linha in batch_data:
+        hash_atual = _hash_linha(linha)
+        route_integration_code = linha[5]
+        if hashes_gravados.get(route_integration_code) != hash_atual:
+            alteradas.append(linha)
+            hashes.append((route_integration_code, data_alvo.date(), hash_atual))
+    return alteradas, hashes
+
+def _clientes_existentes(cursor, raw_items):
+    route_codes = { (itm.get('RouteIntegrationCode') or '').strip() for itm in raw_items }
+    return cache_clientes.clientes_por_rota(cursor, route_codes)
+
+def _montar_linha(item, data_alvo, existing_routes):
+    line = item.get('LineIntegrationCode')
+    estimated_departure = nullify_date(format_date(item.get('EstimatedDepartureDate')))
+    estimated_arrival = nullify_date(format_date(item.get('EstimatedArrivalDate')))
+    real_departure = nullify_date(format_date(item.get('RealDepartureDate')))
+    raw_real_arrival = item.get('RealArrivalDate') or item.get('RealdArrivalDate')
+    real_arrival = nullify_date(format_date(raw_real_arrival))
+    route_integration_code = (item.get('RouteIntegrationCode') or '').strip()
+    route_name = item.get('RouteName')
+    direction_name = item.get('DirectionName')
+    shift = item.get('Shift')
+    estimated_vehicle = item.get('EstimatedVehicle')
+    real_vehicle = item.get('RealVehicle')
+    estimated_distance = item.get('EstimatedDistance')
+    travelled_distance = item.get('TravelledDistance')
+    client_name = item.get('ClientName') or existing_routes.get(route_integration_code)
+    if client_name:
+        client_name = client_name.strip()
+    return (
+        line, estimated_departure, estimated_arrival, real_departure, real_arrival,
+        route_integration_code, route_name, direction_name, shift,
+        estimated_vehicle, real_vehicle, estimated_distance, travelled_distance,
+        client_name, data_alvo.date(),
+        parse_date(item.get('EstimatedDepartureDate')), parse_date(item.get('EstimatedArrivalDate')),
+        parse_date(item.get('RealDepartureDate')), parse_date(raw_real_arrival),
+        to_decimal(estimated_distance), to_decimal(travelled_distance)
+    )
+
+def atualizar_grade_ultima_dia(cursor, data_registro):
+    """
+    Recalcula em historico_grades_ultima o id mais recente por rota
+    normalizada no dia. Não faz commit: roda na transação de quem gravou.
+    """
+    cursor.execute("DELETE FROM historico_grades_ultima WHERE data_registro = %s", (data_registro,))
+    cursor.execute("""
+        INSERT INTO historico_grades_ultima (route_name_norm, data_registro, id_grade)
+        SELECT route_key, data_registro, MAX(id)
+        FROM historico_grades
+        WHERE data_registro = %s AND route_key IS NOT NULL
+        GROUP BY route_key, data_registro
+    """, (data_registro,))
+
+def _gravar_linhas(conn, cursor, data_alvo, raw_items):
+    """
+    Enriquece, filtra pelas linhas alteradas e grava um conjunto de itens não
+    cancelados do dia com um commit. Retorna True se historico_grades mudou.
+    """
+    data_formatada = data_alvo.strftime("%d/%m/%Y")
+    existing_routes = _clientes_existentes(cursor, raw_items)
+    batch_data = [_montar_linha(item, data_alvo, existing_routes) for item in raw_items]
+
+    hashes = []
+    if GRID_HASH_POR_LINHA:
+        total = len(batch_data)
+        batch_data, hashes = _filtrar_linhas_alteradas(cursor, data_alvo, batch_data)
+        if not batch_data:
+            print(f"⏩ Nenhuma rota alterada em {data_formatada}")
+            return False
+        print(f"{len(batch_data)} de {total} rotas alteradas em {data_formatada}")
+
+    # Retry simples para contornar lock wait
+    alterado = False
+    for attempt in range(3):
+        try:
+            # Sem FOUND_ROWS, linhas reescritas com os mesmos valores contam 0
+            alterado = _upsert_historico(cursor, batch_data) > 0
+            if alterado:
+                atualizar_grade_ultima_dia(cursor, data_alvo.date())
+            if hashes:
+                cursor.executemany("""
+                    INSERT INTO grid_hash_linhas (route_integration_code, data_registro, hash_linha)
+                    VALUES (%s, %s, %s)
+                    ON DUPLICATE KEY UPDATE hash_linha = VALUES(hash_linha)
+                """, hashes)
+            conn.commit()
+            cache_clientes.registrar_clientes((linha[5], linha[13]) for linha in batch_data)
+            break
+        except mysql.connector.Error as e:
+            conn.rollback()
+            if e.errno == 1205:  # Lock wait timeout
+                print(f"Lock wait (tentativa {attempt+1}) em {data_formatada}, aguardando...")
+                time.sleep(2 * (attempt + 1))
+                if attempt == 2:
+                    raise
+            else:
+                raise
+    return alterado
+
+def _gravar_grade_dia(conn, cursor, data_alvo, data):
+    data_formatada = data_alvo.strftime("%d/%m/%Y")
+
+    # Pré-filtrar itens não cancelados
+    raw_items = list(_itens_nao_cancelados(data))
+    if not raw_items:
+        print(f"Todas as viagens canceladas em {data_formatada}")
+        return False
+
+    alterado = _gravar_linhas(conn, cursor, data_alvo, raw_items)
+    print(f"✅ Grades processadas para {data_formatada}")
+    return alterado
+
+def _contabilizar(itens, hash_conteudo):
+    for item in itens:
+        hash_conteudo.adicionar(item)
+        yield item
+
+def _processar_dia_streaming(conn, cursor, token, data_alvo, agora, registrar=True):
+    # Decodifica o array da resposta item a item e grava em lotes limitados:
+    # o pico de memória depende de GRID_STREAMING_LOTE, não do tamanho do dia.
+    # Sem o payload inteiro não há como pular o dia antes de gravar; o filtro
+    # por hash de linha é que evita reescrever rotas inalteradas.
+    data_formatada = data_alvo.strftime("%d/%m/%Y")
+    with contextlib.ExitStack() as pilha:
+        try:
+            resp = pilha.enter_context(grid_snapshots.abrir_grade_dia(token, data_alvo))
+        except Exception as e:
+            print(f"Erro ao consultar API para {data_formatada}: {e}")
+            return
+        if resp is None:
+            return
+
+        hash_conteudo = _HashConteudo()
+        alterado = False
+        gravados = 0
+        try:
+            itens = _itens_nao_cancelados(_contabilizar(satx_client.iterar_array_json(resp), hash_conteudo))
+            for lote in _em_lotes(itens, GRID_STREAMING_LOTE):
+                alterado = _gravar_linhas(conn, cursor, data_alvo, lote) or alterado
+                gravados += len(lote)
+            resp.confirmar()
+        except (ValueError, requests.exceptions.RequestException) as e:
+            # Dia fica sem registro de busca e será tentado de novo
+            print(f"Erro lendo grade de {data_formatada}: {e}")
+            return
+
+    if hash_conteudo.quantidade == 0:
+        print(f"Nenhuma grade encontrada para {data_formatada}")
+    elif gravados == 0:
+        print(f"Todas as viagens canceladas em {data_formatada}")
+    else:
+        print(f"✅ Grades processadas para {data_formatada}")
+    if registrar:
+        _registrar_busca_dia(conn, cursor, data_alvo, agora, alterado, hash_conteudo.hexdigest())
+
+def _intervalo_atualizacao(idade_dias, ultima_alteracao, agora):
+    if idade_dias <= 0:
+        return datetime.timedelta(0)
+    intervalo_ontem = datetime.timedelta(minutes=GRID_INTERVALO_ONTEM_MIN)
+    intervalo_antigos = datetime.timedelta(minutes=GRID_INTERVALO_ANTIGOS_MIN)
+    if idade_dias == 1:
+        return intervalo_ontem
+    if ultima_alteracao and agora - ultima_alteracao < intervalo_antigos:
+        return intervalo_ontem
+    return intervalo_antigos
+
+def _carregar_controle(cursor, datas):
+    cursor.execute(
+        "SELECT data_registro, ultima_busca, ultima_alteracao, hash_conteudo FROM grid_controle_dias WHERE data_registro >= %s",
+        (min(d.date() for d in datas),)
+    )
+    return {r[0]: (r[1], r[2], r[3]) for r in cursor.fetchall()}
+
+def _selecionar_dias(controle, datas, agora):
+    agora_local = agora.replace(tzinfo=None)
+    selecionadas = []
+    for data_alvo in datas:
+        ultima_busca, ultima_alteracao, _ = controle.get(data_alvo.date(), (None, None, None))
+        idade = (agora.date() - data_alvo.date()).days
+        intervalo = _intervalo_atualizacao(idade, ultima_alteracao, agora_local)
+        if ultima_busca is None or agora_local - ultima_busca >= intervalo - GRID_FOLGA_AGENDA:
+            selecionadas.append(data_alvo)
+    return selecionadas
+
+def _registrar_busca_dia(conn, cursor, data_alvo, agora, alterado, hash_conteudo):
+    agora_local = agora.replace(tzinfo=None)
+    cursor.execute("""
+        INSERT INTO grid_controle_dias (data_registro, ultima_busca, ultima_alteracao, hash_conteudo)
+        VALUES (%s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE
+            ultima_busca = VALUES(ultima_busca),
+            ultima_alteracao = IFNULL(VALUES(ultima_alteracao), ultima_alteracao),
+            hash_conteudo = VALUES(hash_conteudo)
+    """, (data_alvo.date(), agora_local, agora_local if alterado else None, hash_conteudo))
+    conn.commit()
+
+def _processar_dia(conn, cursor, data_alvo, data, agora, controle, registrar=True):
+    if data is None:
         return
+    hash_conteudo = _hash_payload(data)
+    hash_anterior = controle.get(data_alvo.date(), (None, None, None))[2]
+    if hash_conteudo == hash_anterior:
+        print(f"⏩ Grade de {data_alvo.strftime('%d/%m/%Y')} inalterada desde a última busca")
+        alterado = False
+    else:
+        alterado = _gravar_grade_dia(conn, cursor, data_alvo, data) if data else False
+    if registrar:
+        _registrar_busca_dia(conn, cursor, data_alvo, agora, alterado, hash_conteudo)
+
+def _buscar_grade_dia_seguro(token, data_alvo):
+    try:
+        return _buscar_grade_dia(token, data_alvo)
+    except Exception as e:
+        print(f"Erro ao consultar API para {data_alvo.strftime('%d/%m/%Y')}: {e}")
+        return None
 
-    api_url = "https://integration.systemsatx.com.br/GlobalBus/Grid/List?paramClientIntegrationCode=1003"
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Content-Type": "application/json"
-    }
+def _processar_dias_em_pipeline(conn, cursor, token, datas, concorrencia, agora, controle):
+    # Estágio de busca: até `concorrencia` dias baixados ao mesmo tempo.
+    # Estágio de gravação: esta thread, única dona da conexão MySQL, consome os
+    # dias prontos pela fila limitada e mantém o commit por dia.
+    fila = queue.Queue(maxsize=GRID_FILA_MAX)
+    parar = threading.Event()
+
+    def buscar(data_alvo):
+        data = _buscar_grade_dia_seguro(token, data_alvo)
+        while not parar.is_set():
+            try:
+                fila.put((data_alvo, data), timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    executor = ThreadPoolExecutor(max_workers=concorrencia, thread_name_prefix="grid-fetch")
+    try:
+        for data_alvo in datas:
+            executor.submit(buscar, data_alvo)
+        for _ in datas:
+            data_alvo, data = fila.get()
+            _processar_dia(conn, cursor, data_alvo, data, agora, controle)
+    finally:
+        parar.set()
+        executor.shutdown(wait=True, cancel_futures=True)
+
+def processar_grid(concorrencia=None, forcar_todos=False, streaming=None, offline=False, datas=None):
+    """
+    offline reprocessa a partir dos snapshots do grid_snapshots, sem chamar a
+    API nem mexer na agenda de grid_controle_dias; datas (lista de date)
+    substitui os últimos 10 dias e ignora a agenda.
+    """
+    token = None if offline else obter_token()
+    if not offline and not token:
+        return
 
     try:
         conn = mysql.connector.connect(
             host=os.getenv("POWERBI_DB_HOST"),
             database=os.getenv("POWERBI_DB_NAME"),
             user=os.getenv("POWERBI_DB_USER"),
-            password=os.getenv("POWERBI_DB_PASSWORD")
+            password=os.getenv("POWERBI_DB_PASSWORD"),
+            client_flags=[-ClientFlag.FOUND_ROWS]
         )
     except mysql.connector.Error as err:
         print("Erro ao conectar no banco de dados:", err)
@@ -76,123 +556,59 @@ def processar_grid():
         UNIQUE KEY idx_codigo_data (route_integration_code, data_registro)
     );
     """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS grid_controle_dias (
+        data_registro DATE PRIMARY KEY,
+        ultima_busca DATETIME,
+        ultima_alteracao DATETIME,
+        hash_conteudo CHAR(64)
+    );
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS grid_hash_linhas (
+        route_integration_code VARCHAR(255) NOT NULL,
+        data_registro DATE NOT NULL,
+        hash_linha CHAR(32) NOT NULL,
+        PRIMARY KEY (route_integration_code, data_registro),
+        KEY idx_hash_data (data_registro)
+    );
+    """)
     conn.commit()
+    aplicar_migracoes(conn)
 
-    # Removido update separado; ON DUPLICATE KEY cuidará de atualizar (sem sobrescrever real_* com NULL)
-    insert_historico_query = '''
-    INSERT INTO historico_grades (
-        line, estimated_departure, estimated_arrival, real_departure, real_arrival,
-        route_integration_code, route_name, direction_name, shift,
-        estimated_vehicle, real_vehicle, estimated_distance, travelled_distance, client_name, data_registro
-    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-    ON DUPLICATE KEY UPDATE
-        estimated_departure = IF(real_arrival IS NULL OR real_arrival = '' , VALUES(estimated_departure), estimated_departure),
-        estimated_arrival = IF(real_arrival IS NULL OR real_arrival = '' , VALUES(estimated_arrival), estimated_arrival),
-        real_departure = IF(real_arrival IS NULL OR real_arrival = '' , IFNULL(VALUES(real_departure), real_departure), real_departure),
-        real_arrival = IF(real_arrival IS NULL OR real_arrival = '' , IFNULL(VALUES(real_arrival), real_arrival), real_arrival),
-        real_vehicle = IF(real_arrival IS NULL OR real_arrival = '' , IFNULL(VALUES(real_vehicle), real_vehicle), real_vehicle),
-        estimated_vehicle = IF(real_arrival IS NULL OR real_arrival = '' , VALUES(estimated_vehicle), estimated_vehicle),
-        estimated_distance = IF(real_arrival IS NULL OR real_arrival = '' , VALUES(estimated_distance), estimated_distance),
-        travelled_distance = IF(real_arrival IS NULL OR real_arrival = '' , VALUES(travelled_distance), travelled_distance),
-        route_name = IF(real_arrival IS NULL OR real_arrival = '' , VALUES(route_name), route_name),
-        direction_name = IF(real_arrival IS NULL OR real_arrival = '' , VALUES(direction_name), direction_name),
-        shift = IF(real_arrival IS NULL OR real_arrival = '' , VALUES(shift), shift),
-        client_name = IF(real_arrival IS NULL OR real_arrival = '' , IFNULL(VALUES(client_name), client_name), client_name),
-        line = IF(real_arrival IS NULL OR real_arrival = '' , VALUES(line), line)
-    '''
-
-    dias_a_verificar = 10
-    for i in range(dias_a_verificar):
-        data_alvo = datetime.datetime.now(pytz.timezone("America/Sao_Paulo")) - datetime.timedelta(days=i)
-        data_formatada = data_alvo.strftime("%d/%m/%Y")
-        data_iso = to_iso(data_formatada)
-
-        payload = [{"PropertyName": "EffectiveDate", "Condition": "Equal", "Value": data_iso}]
-        response_api = requests.post(api_url, headers=headers, json=payload)
-
-        if response_api.status_code != 200:
-            print(f"Erro na API para {data_formatada}: {response_api.status_code}")
-            continue
-
-        data = response_api.json()
-        if not data:
-            print(f"Nenhuma grade encontrada para {data_formatada}")
-            continue
+    agora = datetime.datetime.now(pytz.timezone("America/Sao_Paulo"))
+    # Offline não consulta a agenda nem o hash do dia: o snapshot teria o
+    # mesmo hash gravado pela busca online e o dia seria pulado
+    if offline or datas is not None:
+        forcar_todos = True
+    if datas is not None:
+        datas = [datetime.datetime.combine(d, datetime.time()) for d in datas]
+    else:
+        datas = [agora - datetime.timedelta(days=i) for i in range(10)]
+    dias_a_verificar = len(datas)
+    # forcar_todos ignora a agenda e o hash do dia: reprocessa todos os dias
+    controle = {} if forcar_todos else _carregar_controle(cursor, datas)
+    if not forcar_todos:
+        datas = _selecionar_dias(controle, datas, agora)
+    print(f"Dias selecionados para atualização: {len(datas)} de {dias_a_verificar}")
 
-        # Pré-filtrar itens não cancelados e coletar códigos
-        raw_items = []
-        for item in data:
-            if item.get('IsTripCanceled') is True:
-                continue
-            raw_items.append(item)
-        if not raw_items:
-            print(f"Todas as viagens canceladas em {data_formatada}")
-            continue
-        route_codes = { (itm.get('RouteIntegrationCode') or '').strip() for itm in raw_items }
-        existing_routes = {}
-        if route_codes:
-            # Montar query IN dinâmica em chunks para evitar limites
-            route_codes_list = list(route_codes)
-            chunk_size = 1000
-            for c in range(0, len(route_codes_list), chunk_size):
-                chunk = route_codes_list[c:c+chunk_size]
-                placeholders = ','.join(['%s'] * len(chunk))
-                cursor.execute(f"SELECT route_integration_code, client_name FROM historico_grades WHERE route_integration_code IN ({placeholders})", chunk)
-                for r in cursor.fetchall():
-                    existing_routes[r[0]] = r[1]
-
-        batch_data = []
-        for item in raw_items:
-            line = item.get('LineIntegrationCode')
-            estimated_departure = nullify_date(format_date(item.get('EstimatedDepartureDate')))
-            estimated_arrival = nullify_date(format_date(item.get('EstimatedArrivalDate')))
-            real_departure = nullify_date(format_date(item.get('RealDepartureDate')))
-            raw_real_arrival = item.get('RealArrivalDate') or item.get('RealdArrivalDate')
-            real_arrival = nullify_date(format_date(raw_real_arrival))
-            route_integration_code = (item.get('RouteIntegrationCode') or '').strip()
-            route_name = item.get('RouteName')
-            direction_name = item.get('DirectionName')
-            shift = item.get('Shift')
-            estimated_vehicle = item.get('EstimatedVehicle')
-            real_vehicle = item.get('RealVehicle')
-            estimated_distance = item.get('EstimatedDistance')
-            travelled_distance = item.get('TravelledDistance')
-            client_name = item.get('ClientName') or existing_routes.get(route_integration_code)
-            if client_name:
-                client_name = client_name.strip()
-            batch_data.append((
-                line, estimated_departure, estimated_arrival, real_departure, real_arrival,
-                route_integration_code, route_name, direction_name, shift,
-                estimated_vehicle, real_vehicle, estimated_distance, travelled_distance,
-                client_name, data_alvo.date()
-            ))
-
-        # Retry simples para contornar lock wait
-        for attempt in range(3):
-            try:
-                cursor.executemany(insert_historico_query, batch_data)
-                conn.commit()
-                break
-            except mysql.connector.Error as e:
-                if e.errno == 1205:  # Lock wait timeout
-                    print(f"Lock wait (tentativa {attempt+1}) em {data_formatada}, aguardando...")
-                    time.sleep(2 * (attempt + 1))
-                    if attempt == 2:
-                        raise
-                else:
-                    raise
-
-        print(f"✅ Grades processadas para {data_formatada}")
+    if concorrencia is None:
+        concorrencia = GRID_CONCORRENCIA
+    if streaming is None:
+        streaming = GRID_STREAMING
+    if streaming:
+        # Um dia por vez: cada resposta aberta é consumida direto pelo gravador
+        for data_alvo in datas:
+            _processar_dia_streaming(conn, cursor, token, data_alvo, agora, registrar=not offline)
+    elif concorrencia > 1 and len(datas) > 1 and not offline:
+        _processar_dias_em_pipeline(conn, cursor, token, datas, concorrencia, agora, controle)
+    else:
+        for data_alvo in datas:
+            data = _buscar_grade_dia_seguro(token, data_alvo)
+            _processar_dia(conn, cursor, data_alvo, data, agora, controle, registrar=not offline)
 
-    update_travelled_distance_query = """
-    UPDATE historico_grades
-    SET travelled_distance = FLOOR(estimated_distance)
-    WHERE real_arrival IS NOT NULL 
-      AND travelled_distance = 0
-      AND STR_TO_DATE(estimated_departure, '%d/%m/%Y %H:%i:%s') >= DATE_SUB(NOW(), INTERVAL 7 DAY);
-    """
-    cursor.execute(update_travelled_distance_query)
-    conn.commit()
+    # travelled_distance zerada pela SATX é preenchida com a distância real
+    # pelo reconstrucao_viagens
 
     cursor.close()
     conn.close()
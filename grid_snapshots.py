@@ -0,0 +1,310 @@
+import os
+from dotenv import load_dotenv
+load_dotenv()
+import contextlib
+import datetime
+import gzip
+import json
+import shutil
+import sys
+import threading
+
+import satx_client
+
+# Snapshots locais das respostas brutas do Grid/List, um arquivo JSON gzip por
+# busca em <dir>/<cliente>/<data efetiva>/<instante UTC da busca>.json.gz.
+# Qualquer consumidor do Grid/List (processar_grid, reconciliar_rotas) reusa
+# um snapshot mais novo que a validade pedida em vez de chamar a SATX; sem
+# token (modo offline) o snapshot mais recente é usado qualquer que seja a
+# idade, o que permite reprocessar e fazer backfill sem tocar na API.
+GRID_SNAPSHOTS_DIR = os.getenv("POWERBI_GRID_SNAPSHOTS_DIR", ".cache_grid")
+GRID_SNAPSHOTS_VALIDADE_SEGUNDOS = int(os.getenv("POWERBI_GRID_SNAPSHOTS_VALIDADE_SEGUNDOS", "300"))
+# Snapshots mantidos por cliente/dia (os mais recentes)
+GRID_SNAPSHOTS_MANTER = int(os.getenv("POWERBI_GRID_SNAPSHOTS_MANTER", "3"))
+# Dias de grade mantidos por cliente; diretórios de dias mais antigos são removidos (0 = sem limite)
+GRID_SNAPSHOTS_DIAS = int(os.getenv("POWERBI_GRID_SNAPSHOTS_DIAS", "30"))
+
+FORMATO_INSTANTE = "%Y%m%dT%H%M%S_%fZ"
+EXTENSAO = ".json.gz"
+
+_poda_lock = threading.Lock()
+
+def _agora_utc():
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+def _cliente_padrao():
+    return satx_client.GRID_PARAMS["paramClientIntegrationCode"]
+
+def _dia(data_alvo):
+    return data_alvo.date() if isinstance(data_alvo, datetime.datetime) else data_alvo
+
+def _diretorio(dia, cliente):
+    return os.path.join(GRID_SNAPSHOTS_DIR, str(cliente), dia.isoformat())
+
+def listar(data_alvo, cliente=None):
+    """Snapshots do cliente/dia como [(obtido_em UTC, caminho)], do mais antigo ao mais novo."""
+    diretorio = _diretorio(_dia(data_alvo), cliente or _cliente_padrao())
+    try:
+        nomes = os.listdir(diretorio)
+    except FileNotFoundError:
+        return []
+    snapshots = []
+    for nome in nomes:
+        if not nome.endswith(EXTENSAO):
+            continue
+        try:
+            obtido_em = datetime.datetime.strptime(nome[:-len(EXTENSAO)], FORMATO_INSTANTE)
+        except ValueError:
+            continue
+        snapshots.append((obtido_em, os.path.join(diretorio, nome)))
+    return sorted(snapshots)
+
+def mais_recente(data_alvo, idade_maxima=None, cliente=None):
+    """
+    (obtido_em, caminho) do snapshot mais novo do dia, ou None se não houver
+    nenhum com menos de idade_maxima segundos (None = qualquer idade).
+    """
+    snapshots = listar(data_alvo, cliente)
+    if not snapshots:
+        return None
+    obtido_em, caminho = snapshots[-1]
+    if idade_maxima is not None and (_agora_utc() - obtido_em).total_seconds() >= idade_maxima:
+        return None
+    return obtido_em, caminho
+
+def carregar(caminho):
+    with gzip.open(caminho, "rb") as f:
+        return json.loads(f.read() or b"[]")
+
+def _podar(diretorio):
+    with _poda_lock:
+        try:
+            nomes = sorted(n for n in os.listdir(diretorio) if n.endswith(EXTENSAO))
+        except FileNotFoundError:
+            return
+        for nome in nomes[:-GRID_SNAPSHOTS_MANTER] if GRID_SNAPSHOTS_MANTER > 0 else []:
+            try:
+                os.remove(os.path.join(diretorio, nome))
+            except OSError:
+                pass
+        if GRID_SNAPSHOTS_DIAS > 0:
+            _podar_dias(os.path.dirname(diretorio), os.path.basename(diretorio))
+
+def _podar_dias(diretorio_cliente, manter):
+    # A idade é a da data efetiva do diretório; o dia recém-gravado fica
+    # (um backfill de dias antigos não apaga o que acabou de baixar)
+    limite = _agora_utc().date() - datetime.timedelta(days=GRID_SNAPSHOTS_DIAS)
+    try:
+        nomes = os.listdir(diretorio_cliente)
+    except FileNotFoundError:
+        return
+    for nome in nomes:
+        try:
+            dia = datetime.date.fromisoformat(nome)
+        except ValueError:
+            continue
+        if dia < limite and nome != manter:
+            shutil.rmtree(os.path.join(diretorio_cliente, nome), ignore_errors=True)
+
+class _Gravacao:
+    # Arquivo temporário que só vira snapshot em concluir(); assim uma
+    # resposta interrompida nunca é servida como grade completa. Falhas de
+    # disco só desligam a gravação: quem consome a grade não é afetado.
+    def __init__(self, data_alvo, obtido_em=None, cliente=None):
+        self.dia = _dia(data_alvo)
+        self.obtido_em = obtido_em or _agora_utc()
+        self.diretorio = _diretorio(self.dia, cliente or _cliente_padrao())
+        self.caminho = os.path.join(self.diretorio, self.obtido_em.strftime(FORMATO_INSTANTE) + EXTENSAO)
+        self.tmp = f"{self.caminho}.{os.getpid()}.{threading.get_ident()}.tmp"
+        self.arquivo = None
+        try:
+            os.makedirs(self.diretorio, exist_ok=True)
+            self.arquivo = gzip.open(self.tmp, "wb")
+        except OSError as e:
+            self._falhou(e)
+
+    def _falhou(self, erro):
+        print(f"Não foi possível gravar snapshot do grid de {self.dia}: {erro}")
+        self.descartar()
+
+    def escrever(self, dados):
+        if self.arquivo is None:
+            return
+        try:
+            self.arquivo.write(dados)
+        except OSError as e:
+            self._falhou(e)
+
+    def concluir(self):
+        if self.arquivo is None:
+            return None
+        try:
+            self.arquivo.close()
+            self.arquivo = None
+            os.replace(self.tmp, self.caminho)
+        except OSError as e:
+            self._falhou(e)
+            return None
+        _podar(self.diretorio)
+        return self.caminho
+
+    def descartar(self):
+        if self.arquivo is not None:
+            try:
+                self.arquivo.close()
+            except OSError:
+                pass
+            self.arquivo = None
+        try:
+            os.remove(self.tmp)
+        except OSError:
+            pass
+
+def gravar(data_alvo, conteudo, obtido_em=None, cliente=None):
+    """Grava o corpo bruto (bytes) de uma resposta do Grid/List. Retorna o caminho ou None."""
+    gravacao = _Gravacao(data_alvo, obtido_em, cliente)
+    gravacao.escrever(conteudo)
+    return gravacao.concluir()
+
+def _payload(data_alvo):
+    return [{"PropertyName": "EffectiveDate", "Condition": "Equal",
+             "Value": _dia(data_alvo).strftime("%Y-%m-%dT00:00:00Z")}]
+
+def _usar_snapshot(token, data_alvo, idade_maxima, cliente):
+    # Sem token só o que já está em disco pode ser usado
+    if token is None:
+        return mais_recente(data_alvo, None, cliente)
+    if idade_maxima is None:
+        idade_maxima = GRID_SNAPSHOTS_VALIDADE_SEGUNDOS
+    return mais_recente(data_alvo, idade_maxima, cliente) if idade_maxima > 0 else None
+
+def _params(cliente):
+    return satx_client.GRID_PARAMS if cliente is None else {"paramClientIntegrationCode": cliente}
+
+def obter_grade_dia(token, data_alvo, idade_maxima=None, cliente=None):
+    """
+    Itens do Grid/List do dia: de um snapshot com menos de idade_maxima
+    segundos (padrão GRID_SNAPSHOTS_VALIDADE_SEGUNDOS; 0 força a busca) ou da
+    API, gravando a resposta. Com token None usa só os snapshots.
+    Retorna None se a grade não puder ser obtida.
+    """
+    snapshot = _usar_snapshot(token, data_alvo, idade_maxima, cliente)
+    if snapshot:
+        return carregar(snapshot[1])
+    if token is None:
+        print(f"Sem snapshot do grid para {_dia(data_alvo)} (modo offline)")
+        return None
+
+    obtido_em = _agora_utc()
+    resp = satx_client.post(satx_client.GRID_LIST, token=token, json=_payload(data_alvo), params=_params(cliente))
+    if resp.status_code != 200:
+        print(f"Erro na API para {_dia(data_alvo)}: {resp.status_code}")
+        return None
+    gravar(data_alvo, resp.content, obtido_em, cliente)
+    return resp.json()
+
+class _RespostaSnapshot:
+    # Expõe um snapshot em disco com a interface usada por iterar_array_json
+    def __init__(self, arquivo):
+        self.arquivo = arquivo
+        self.encoding = "utf-8"
+
+    def iter_content(self, chunk_size=satx_client.STREAM_CHUNK):
+        while True:
+            bloco = self.arquivo.read(chunk_size)
+            if not bloco:
+                return
+            yield bloco
+
+    def confirmar(self):
+        pass
+
+class _RespostaGravada:
+    # Repassa os chunks da resposta HTTP e os copia para o snapshot
+    def __init__(self, resp, gravacao):
+        self.resp = resp
+        self.gravacao = gravacao
+        self.encoding = resp.encoding
+        self.iterador = None
+        self.confirmada = False
+
+    def iter_content(self, chunk_size=satx_client.STREAM_CHUNK):
+        if self.iterador is None:
+            self.iterador = self.resp.iter_content(chunk_size=chunk_size)
+        for chunk in self.iterador:
+            self.gravacao.escrever(chunk)
+            yield chunk
+
+    def confirmar(self):
+        # O decodificador para no "]": o que resta do corpo também vai para o arquivo
+        for _ in self.iter_content():
+            pass
+        self.gravacao.concluir()
+        self.confirmada = True
+
+@contextlib.contextmanager
+def abrir_grade_dia(token, data_alvo, idade_maxima=None, cliente=None):
+    """
+    Versão em streaming de obter_grade_dia: entrega um objeto para
+    satx_client.iterar_array_json (ou None se a grade não puder ser obtida).
+    A resposta da API só é gravada como snapshot se o chamador chamar
+    confirmar() depois de consumi-la por inteiro.
+    """
+    snapshot = _usar_snapshot(token, data_alvo, idade_maxima, cliente)
+    if snapshot:
+        with gzip.open(snapshot[1], "rb") as arquivo:
+            yield _RespostaSnapshot(arquivo)
+        return
+    if token is None:
+        print(f"Sem snapshot do grid para {_dia(data_alvo)} (modo offline)")
+        yield None
+        return
+
+    obtido_em = _agora_utc()
+    resp = satx_client.post(satx_client.GRID_LIST, token=token, json=_payload(data_alvo),
+                            params=_params(cliente), stream=True)
+    with resp:
+        if resp.status_code != 200:
+            print(f"Erro na API para {_dia(data_alvo)}: {resp.status_code}")
+            yield None
+            return
+        gravacao = _Gravacao(data_alvo, obtido_em, cliente)
+        resposta = _RespostaGravada(resp, gravacao)
+        try:
+            yield resposta
+        finally:
+            if not resposta.confirmada:
+                gravacao.descartar()
+
+def backfill(token, inicio, fim, cliente=None):
+    """Baixa para o disco os snapshots de inicio a fim (dates, inclusive)."""
+    dia = inicio
+    baixados = 0
+    while dia <= fim:
+        try:
+            if obter_grade_dia(token, dia, idade_maxima=0, cliente=cliente) is not None:
+                baixados += 1
+        except Exception as e:
+            print(f"Erro baixando grid de {dia}: {e}")
+        dia += datetime.timedelta(days=1)
+    print(f"Backfill concluído: {baixados} dia(s) gravados em {GRID_SNAPSHOTS_DIR}")
+
+if __name__ == "__main__":
+    # python grid_snapshots.py backfill AAAA-MM-DD AAAA-MM-DD
+    # python grid_snapshots.py reprocessar AAAA-MM-DD AAAA-MM-DD  (sem API)
+    if len(sys.argv) != 4 or sys.argv[1] not in ("backfill", "reprocessar"):
+        print("Uso: python grid_snapshots.py backfill|reprocessar AAAA-MM-DD AAAA-MM-DD")
+        sys.exit(1)
+    inicio = datetime.date.fromisoformat(sys.argv[2])
+    fim = datetime.date.fromisoformat(sys.argv[3])
+    if sys.argv[1] == "backfill":
+        from authtoken import obter_token
+        token = obter_token()
+        if not token:
+            print("Não foi possível obter token.")
+            sys.exit(1)
+        backfill(token, inicio, fim)
+    else:
+        from grid import processar_grid
+        datas = [inicio + datetime.timedelta(days=i) for i in range((fim - inicio).days + 1)]
+        processar_grid(offline=True, datas=datas)
@@ -0,0 +1,330 @@
+import os
+from dotenv import load_dotenv
+load_dotenv()
+
+import sys
+import time
+import mysql.connector
+
+# Migrações de esquema aplicadas sem bloquear os jobs: colunas novas são
+# adicionadas (INSTANT/INPLACE pelo próprio MySQL), o preenchimento é feito em
+# lotes pequenos por faixa de id com commit a cada lote e os índices são
+# criados com LOCK=NONE. Cada migração concluída fica registrada em
+# migracoes_aplicadas para não ser repetida.
+TAMANHO_LOTE = int(os.getenv("POWERBI_MIGRACAO_LOTE", "5000"))
+PAUSA_LOTE = float(os.getenv("POWERBI_MIGRACAO_PAUSA_SEGUNDOS", "0.05"))
+# Os jobs do agendador disparam juntos e todos chamam aplicar_migracoes: quem
+# chega depois espera (até MIGRACAO_LOCK_SEGUNDOS) o primeiro terminar.
+MIGRACAO_LOCK_SEGUNDOS = int(os.getenv("POWERBI_MIGRACAO_LOCK_SEGUNDOS", "600"))
+
+FORMATO_DATA_REGEX = "^[0-9]{2}/[0-9]{2}/[0-9]{4} [0-9]{2}:[0-9]{2}:[0-9]{2}$"
+NUMERO_REGEX = "^-?[0-9]+([.][0-9]+)?$"
+
+COLUNAS_TIPADAS_HISTORICO = [
+    ("estimated_departure_dt", "DATETIME"),
+    ("estimated_arrival_dt", "DATETIME"),
+    ("real_departure_dt", "DATETIME"),
+    ("real_arrival_dt", "DATETIME"),
+    ("estimated_distance_num", "DECIMAL(10,2)"),
+    ("travelled_distance_num", "DECIMAL(10,2)"),
+]
+
+INDICES_TIPADOS_HISTORICO = [
+    ("idx_hg_estimated_departure_dt", "estimated_departure_dt"),
+    ("idx_hg_real_departure_dt", "real_departure_dt"),
+    ("idx_hg_real_arrival_dt", "real_arrival_dt"),
+]
+
+# Marca de alteração usada pelo refresh incremental da MV: o MySQL só atualiza
+# o ON UPDATE quando algum valor da linha muda de fato.
+COLUNA_ATUALIZADO_EM = "TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP"
+
+INDICES_MV = [
+    ("informacoes", "idx_info_atualizado_em", "atualizado_em"),
+    ("informacoes", "idx_info_data_execucao", "data_execucao"),
+    ("historico_grades", "idx_hg_atualizado_em", "atualizado_em"),
+    ("historico_grades", "idx_hg_data_registro", "data_registro"),
+]
+
+# Chave de rota normalizada (TRIM(LOWER(nome))) como coluna gerada indexada,
+# para que joins e deletes por nome de rota usem índice.
+COLUNAS_ROUTE_KEY = [
+    ("informacoes", "RouteName", "idx_info_route_key", "route_key, data_execucao"),
+    ("graderumocerto", "route_name", "idx_grc_route_key", "route_key"),
+    ("historico_grades", "route_name", "idx_hg_route_key", "route_key, data_registro"),
+    ("informacoes_com_cliente_mv", "RouteName", "idx_mv_route_key", "route_key, data_execucao"),
+]
+TABELAS_ROUTE_KEY_LEGADO = ("informacoes", "graderumocerto", "historico_grades")
+
+# Hash do conteúdo do dia em grid_controle_dias (tabelas criadas antes dele)
+COLUNAS_CONTROLE_GRID = [
+    ("hash_conteudo", "CHAR(64)"),
+]
+
+# Perfil de velocidade gravado pelo verificar_violações_por_velocidade
+COLUNAS_PERFIL_VELOCIDADE = [
+    ("velocidade_maxima", "DECIMAL(6,2)"),
+    ("tempo_acima_limite_s", "INT"),
+    ("distancia_acima_limite_km", "DECIMAL(10,3)"),
+    ("episodios_excesso", "INT"),
+    ("maior_episodio_s", "INT"),
+    ("distancia_percorrida_km", "DECIMAL(10,3)"),
+    ("severidade_velocidade", "VARCHAR(20)"),
+]
+
+# Desvio medido contra a trilha de referência da rota (desvio_rota.py)
+COLUNAS_DESVIO_ROTA = [
+    ("desvio_maximo_m", "INT"),
+    ("desvio_duracao_s", "INT"),
+]
+# Quando o desvio foi medido; NULL = classificada antes de haver referência
+COLUNAS_DESVIO_MEDIDO = [
+    ("desvio_medido_em", "DATETIME"),
+]
+
+# Resultado da reconstrução das viagens (reconstrucao_viagens.py)
+COLUNAS_RECONSTRUCAO = [
+    ("distancia_real_km", "DECIMAL(10,3)"),
+    ("paradas", "INT"),
+    ("tempo_parado_s", "INT"),
+    ("reconstruido_em", "DATETIME"),
+]
+
+# Fila do verificar_violações_por_velocidade: linhas ainda sem classificação
+# achadas direto pelo índice e juntadas à MV pelo id
+INDICES_FILA_VELOCIDADE = [
+    ("informacoes", "idx_info_violation_type_id", "violation_type, id"),
+    ("informacoes_com_cliente_mv", "idx_mv_id", "id"),
+]
+
+def conectar_mysql():
+    return mysql.connector.connect(
+        host=os.getenv("POWERBI_DB_HOST"),
+        database=os.getenv("POWERBI_DB_NAME"),
+        user=os.getenv("POWERBI_DB_USER"),
+        password=os.getenv("POWERBI_DB_PASSWORD")
+    )
+
+def _garantir_tabela_migracoes(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS migracoes_aplicadas (
+            nome VARCHAR(100) PRIMARY KEY,
+            aplicada_em DATETIME NOT NULL
+        )
+    """)
+
+def _migracao_aplicada(cursor, nome):
+    cursor.execute("SELECT 1 FROM migracoes_aplicadas WHERE nome = %s", (nome,))
+    return cursor.fetchone() is not None
+
+def _registrar_migracao(conn, cursor, nome):
+    cursor.execute("INSERT IGNORE INTO migracoes_aplicadas (nome, aplicada_em) VALUES (%s, NOW())", (nome,))
+    conn.commit()
+
+def _tabela_existe(cursor, tabela):
+    cursor.execute(
+        "SELECT 1 FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = %s",
+        (tabela,)
+    )
+    return cursor.fetchone() is not None
+
+def adicionar_coluna(cursor, tabela, coluna, definicao):
+    try:
+        cursor.execute(f"ALTER TABLE {tabela} ADD COLUMN {coluna} {definicao}")
+    except mysql.connector.Error as err:
+        if err.errno != 1060:  # coluna já existe
+            raise
+
+def criar_indice(cursor, tabela, nome, colunas):
+    try:
+        cursor.execute(f"ALTER TABLE {tabela} ADD INDEX {nome} ({colunas}), ALGORITHM=INPLACE, LOCK=NONE")
+    except mysql.connector.Error as err:
+        if err.errno != 1061:  # índice já existe
+            raise
+
+def garantir_colunas_tipadas_historico(cursor):
+    for coluna, tipo in COLUNAS_TIPADAS_HISTORICO:
+        adicionar_coluna(cursor, "historico_grades", coluna, tipo)
+
+def _expr_data(coluna):
+    # %% porque as queries de preenchimento também recebem parâmetros
+    return f"IF({coluna} REGEXP '{FORMATO_DATA_REGEX}', STR_TO_DATE({coluna}, '%%d/%%m/%%Y %%H:%%i:%%s'), NULL)"
+
+def _expr_numero(coluna):
+    return f"IF({coluna} REGEXP '{NUMERO_REGEX}', CAST({coluna} AS DECIMAL(10,2)), NULL)"
+
+def preencher_colunas_tipadas_historico(conn, cursor, tamanho_lote=TAMANHO_LOTE):
+    cursor.execute("SELECT MIN(id), MAX(id) FROM historico_grades")
+    min_id, max_id = cursor.fetchone()
+    if min_id is None:
+        return
+
+    update_sql = f"""
+        UPDATE historico_grades SET
+            estimated_departure_dt = {_expr_data('estimated_departure')},
+            estimated_arrival_dt = {_expr_data('estimated_arrival')},
+            real_departure_dt = {_expr_data('real_departure')},
+            real_arrival_dt = {_expr_data('real_arrival')},
+            estimated_distance_num = {_expr_numero('estimated_distance')},
+            travelled_distance_num = {_expr_numero('travelled_distance')}
+        WHERE id >= %s AND id < %s
+    """
+
+    inicio = min_id
+    while inicio <= max_id:
+        fim = inicio + tamanho_lote
+        cursor.execute(update_sql, (inicio, fim))
+        conn.commit()
+        print(f"historico_grades: ids {inicio}..{fim - 1} preenchidos")
+        inicio = fim
+        time.sleep(PAUSA_LOTE)
+
+def migrar_historico_grades_tipado(conn, tamanho_lote=TAMANHO_LOTE):
+    nome = "historico_grades_colunas_tipadas"
+    cursor = conn.cursor()
+    _garantir_tabela_migracoes(cursor)
+    if _migracao_aplicada(cursor, nome):
+        cursor.close()
+        return
+    print("🔧 Migrando historico_grades para colunas DATETIME/DECIMAL...")
+    garantir_colunas_tipadas_historico(cursor)
+    preencher_colunas_tipadas_historico(conn, cursor, tamanho_lote)
+    for indice, coluna in INDICES_TIPADOS_HISTORICO:
+        criar_indice(cursor, "historico_grades", indice, coluna)
+    _registrar_migracao(conn, cursor, nome)
+    cursor.close()
+    print("✅ Migração historico_grades_colunas_tipadas concluída.")
+
+def migrar_atualizado_em(conn):
+    nome = "informacoes_historico_atualizado_em"
+    cursor = conn.cursor()
+    _garantir_tabela_migracoes(cursor)
+    if _migracao_aplicada(cursor, nome):
+        cursor.close()
+        return
+    # informacoes é criada pelo routeviolation; sem ela, tenta na próxima execução
+    if not (_tabela_existe(cursor, "informacoes") and _tabela_existe(cursor, "historico_grades")):
+        cursor.close()
+        return
+    print("🔧 Adicionando atualizado_em em informacoes/historico_grades...")
+    for tabela in ("informacoes", "historico_grades"):
+        adicionar_coluna(cursor, tabela, "atualizado_em", COLUNA_ATUALIZADO_EM)
+    for tabela, indice, coluna in INDICES_MV:
+        criar_indice(cursor, tabela, indice, coluna)
+    _registrar_migracao(conn, cursor, nome)
+    cursor.close()
+    print(f"✅ Migração {nome} concluída.")
+
+def criar_historico_grades_ultima(conn):
+    # Registro mais recente de historico_grades por rota normalizada e data,
+    # usado pela MV; mantido depois pelo processar_grid e pelo remover.
+    nome = "historico_grades_ultima"
+    cursor = conn.cursor()
+    _garantir_tabela_migracoes(cursor)
+    if _migracao_aplicada(cursor, nome):
+        cursor.close()
+        return
+    print("🔧 Criando historico_grades_ultima...")
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS historico_grades_ultima (
+            route_name_norm VARCHAR(255) NOT NULL,
+            data_registro DATE NOT NULL,
+            id_grade INT NOT NULL,
+            PRIMARY KEY (route_name_norm, data_registro),
+            KEY idx_hgu_data (data_registro)
+        )
+    """)
+    cursor.execute("""
+        INSERT INTO historico_grades_ultima (route_name_norm, data_registro, id_grade)
+        SELECT TRIM(LOWER(route_name)), data_registro, MAX(id)
+        FROM historico_grades
+        WHERE route_name IS NOT NULL AND data_registro IS NOT NULL
+        GROUP BY TRIM(LOWER(route_name)), data_registro
+        ON DUPLICATE KEY UPDATE id_grade = VALUES(id_grade)
+    """)
+    conn.commit()
+    _registrar_migracao(conn, cursor, nome)
+    cursor.close()
+    print(f"✅ Migração {nome} concluída.")
+
+def criar_route_key(conn):
+    # Cada tabela é migrada e registrada assim que existe: uma tabela ainda
+    # não criada (ex.: informacoes antes do primeiro routeviolation) não
+    # impede as demais, e entra numa execução seguinte.
+    cursor = conn.cursor()
+    _garantir_tabela_migracoes(cursor)
+    # Bases migradas antes do registro por tabela já têm as três primeiras
+    legado = _migracao_aplicada(cursor, "route_key_gerada")
+    for tabela, origem, indice, colunas in COLUNAS_ROUTE_KEY:
+        nome = f"route_key_gerada_{tabela}"
+        if legado and tabela in TABELAS_ROUTE_KEY_LEGADO:
+            continue
+        if _migracao_aplicada(cursor, nome) or not _tabela_existe(cursor, tabela):
+            continue
+        print(f"🔧 Criando route_key em {tabela}...")
+        # VIRTUAL: adicionar a coluna não reescreve a tabela; o índice
+        # secundário (criado com LOCK=NONE) guarda o valor calculado.
+        adicionar_coluna(cursor, tabela, "route_key",
+                         f"VARCHAR(255) GENERATED ALWAYS AS (TRIM(LOWER({origem}))) VIRTUAL")
+        criar_indice(cursor, tabela, indice, colunas)
+        _registrar_migracao(conn, cursor, nome)
+        print(f"✅ Migração {nome} concluída.")
+    cursor.close()
+
+def _migrar_colunas(conn, nome, tabela, colunas):
+    cursor = conn.cursor()
+    _garantir_tabela_migracoes(cursor)
+    if _migracao_aplicada(cursor, nome) or not _tabela_existe(cursor, tabela):
+        cursor.close()
+        return
+    print(f"🔧 Adicionando colunas de {nome} em {tabela}...")
+    for coluna, definicao in colunas:
+        adicionar_coluna(cursor, tabela, coluna, definicao)
+    _registrar_migracao(conn, cursor, nome)
+    cursor.close()
+    print(f"✅ Migração {nome} concluída.")
+
+def _migrar_indices(conn, nome, indices):
+    cursor = conn.cursor()
+    _garantir_tabela_migracoes(cursor)
+    tabelas = {tabela for tabela, _, _ in indices}
+    if _migracao_aplicada(cursor, nome) or not all(_tabela_existe(cursor, t) for t in tabelas):
+        cursor.close()
+        return
+    print(f"🔧 Criando índices de {nome}...")
+    for tabela, indice, colunas in indices:
+        criar_indice(cursor, tabela, indice, colunas)
+    _registrar_migracao(conn, cursor, nome)
+    cursor.close()
+    print(f"✅ Migração {nome} concluída.")
+
+def aplicar_migracoes(conn, tamanho_lote=TAMANHO_LOTE):
+    cursor = conn.cursor()
+    cursor.execute("SELECT GET_LOCK('migracoes', %s)", (MIGRACAO_LOCK_SEGUNDOS,))
+    if not cursor.fetchone()[0]:
+        cursor.close()
+        raise RuntimeError(f"Migrações em andamento em outra conexão há mais de {MIGRACAO_LOCK_SEGUNDOS}s")
+    try:
+        migrar_historico_grades_tipado(conn, tamanho_lote)
+        migrar_atualizado_em(conn)
+        criar_historico_grades_ultima(conn)
+        criar_route_key(conn)
+        _migrar_colunas(conn, "grid_controle_dias_hash", "grid_controle_dias", COLUNAS_CONTROLE_GRID)
+        _migrar_colunas(conn, "informacoes_perfil_velocidade", "informacoes", COLUNAS_PERFIL_VELOCIDADE)
+        _migrar_colunas(conn, "informacoes_desvio_rota", "informacoes", COLUNAS_DESVIO_ROTA)
+        _migrar_colunas(conn, "informacoes_desvio_medido_em", "informacoes", COLUNAS_DESVIO_MEDIDO)
+        _migrar_colunas(conn, "historico_grades_reconstrucao", "historico_grades", COLUNAS_RECONSTRUCAO)
+        _migrar_indices(conn, "fila_velocidade", INDICES_FILA_VELOCIDADE)
+    finally:
+        cursor.execute("SELECT RELEASE_LOCK('migracoes')")
+        cursor.fetchone()
+        cursor.close()
+
+if __name__ == "__main__":
+    # python migracoes.py [tamanho_lote]
+    lote = int(sys.argv[1]) if len(sys.argv) > 1 else TAMANHO_LOTE
+    conexao = conectar_mysql()
+    try:
+        aplicar_migracoes(conexao, lote)
+    finally:
+        conexao.close()
@@ -0,0 +1,212 @@
+import os
+from dotenv import load_dotenv
+load_dotenv()
+import bisect
+import datetime
+import gzip
+import json
+import re
+import threading
+from collections import OrderedDict
+
+import satx_client
+import satx_datas
+
+# Cache local de HistoryPosition por veículo e dia UTC. Cada dia de um veículo
+# é baixado uma vez e qualquer janela dentro dele é servida por busca binária
+# no EventDate. Dias já fechados (terminados há mais de
+# POSICOES_FECHAMENTO_HORAS) ficam em arquivos JSON gzip em disco; dias em
+# aberto ficam só em memória e são rebaixados após POSICOES_TTL_ABERTO_SEGUNDOS.
+POSICOES_CACHE_DIR = os.getenv("POWERBI_POSICOES_CACHE_DIR", ".cache_posicoes")
+POSICOES_CACHE_MEMORIA = int(os.getenv("POWERBI_POSICOES_CACHE_MEMORIA", "64"))
+POSICOES_CACHE_MAX_MB = int(os.getenv("POWERBI_POSICOES_CACHE_MAX_MB", "512"))
+POSICOES_FECHAMENTO_HORAS = int(os.getenv("POWERBI_POSICOES_FECHAMENTO_HORAS", "6"))
+POSICOES_TTL_ABERTO_SEGUNDOS = int(os.getenv("POWERBI_POSICOES_TTL_ABERTO_SEGUNDOS", "300"))
+
+_memoria = OrderedDict()
+_memoria_lock = threading.Lock()
+# Locks por faixa de chave: número fixo, não cresce com os veículos/dias vistos
+_chaves_locks = [threading.Lock() for _ in range(64)]
+_gravacoes_lock = threading.Lock()
+_gravacoes_desde_poda = 0
+
+class FalhaHistoryPosition(Exception):
+    """HistoryPosition respondeu com erro; transitoria indica 429/5xx."""
+    def __init__(self, veiculo, dia, status):
+        super().__init__(f"HistoryPosition retornou {status} para {veiculo} em {dia}")
+        self.status = status
+        self.transitoria = status == 429 or status >= 500
+
+def _agora_utc():
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+def _lock_da_chave(chave):
+    return _chaves_locks[hash(chave) % len(_chaves_locks)]
+
+def _caminho(veiculo, dia):
+    nome = re.sub(r"[^A-Za-z0-9_-]", "_", str(veiculo))
+    return os.path.join(POSICOES_CACHE_DIR, dia.isoformat(), f"{nome}.json.gz")
+
+def _montar_entrada(posicoes, obtido_em, fechada):
+    # Ordena por EventDate e guarda os horários em lista paralela para o bisect
+    com_tempo = []
+    for pos in posicoes:
+        tempo = satx_datas.iso_para_datetime(pos.get("EventDate"))
+        if tempo is not None:
+            com_tempo.append((tempo, pos))
+    com_tempo.sort(key=lambda par: par[0])
+    return {
+        "tempos": [t for t, _ in com_tempo],
+        "posicoes": [p for _, p in com_tempo],
+        "obtido_em": obtido_em,
+        "fechada": fechada,
+    }
+
+def _ler_disco(veiculo, dia):
+    caminho = _caminho(veiculo, dia)
+    if not os.path.exists(caminho):
+        return None
+    try:
+        with gzip.open(caminho, "rt", encoding="utf-8") as f:
+            posicoes = json.load(f)
+        os.utime(caminho)  # marca como usado recentemente para a poda LRU
+    except Exception as e:
+        print(f"Cache de posições ilegível em {caminho}: {e}")
+        return None
+    return _montar_entrada(posicoes, _agora_utc(), True)
+
+def _gravar_disco(veiculo, dia, posicoes):
+    global _gravacoes_desde_poda
+    caminho = _caminho(veiculo, dia)
+    os.makedirs(os.path.dirname(caminho), exist_ok=True)
+    tmp = f"{caminho}.tmp"
+    try:
+        with gzip.open(tmp, "wt", encoding="utf-8") as f:
+            json.dump(posicoes, f)
+        os.replace(tmp, caminho)
+    except OSError as e:
+        print(f"Não foi possível gravar cache de posições em {caminho}: {e}")
+        return
+    with _gravacoes_lock:
+        _gravacoes_desde_poda += 1
+        podar = _gravacoes_desde_poda >= 100
+        if podar:
+            _gravacoes_desde_poda = 0
+    if podar:
+        podar_disco()
+
+def podar_disco(max_mb=None):
+    """Remove os arquivos usados há mais tempo até o cache caber em max_mb."""
+    limite = (max_mb or POSICOES_CACHE_MAX_MB) * 1024 * 1024
+    arquivos = []
+    for raiz, _, nomes in os.walk(POSICOES_CACHE_DIR):
+        for nome in nomes:
+            caminho = os.path.join(raiz, nome)
+            try:
+                st = os.stat(caminho)
+            except OSError:
+                continue
+            arquivos.append((st.st_mtime, st.st_size, caminho))
+    total = sum(tamanho for _, tamanho, _ in arquivos)
+    for _, tamanho, caminho in sorted(arquivos):
+        if total <= limite:
+            break
+        try:
+            os.remove(caminho)
+            total -= tamanho
+        except OSError:
+            pass
+
+def _valida(entrada, ate, agora):
+    if entrada["fechada"]:
+        return True
+    return entrada["obtido_em"] >= ate and (agora - entrada["obtido_em"]).total_seconds() < POSICOES_TTL_ABERTO_SEGUNDOS
+
+def _guardar_memoria(chave, entrada):
+    with _memoria_lock:
+        _memoria[chave] = entrada
+        _memoria.move_to_end(chave)
+        while len(_memoria) > POSICOES_CACHE_MEMORIA:
+            _memoria.popitem(last=False)
+
+def _buscar_api(token, veiculo, dia):
+    payload = {
+        "TrackedUnitType": 1,
+        "TrackedUnitIntegrationCode": veiculo,
+        "StartDatePosition": dia.strftime('%Y-%m-%dT00:00:00.000Z'),
+        "EndDatePosition": dia.strftime('%Y-%m-%dT23:59:59.595Z')
+    }
+    response = satx_client.post(satx_client.HISTORY_POSITION, token=token, json=payload)
+    if response.status_code == 204 or (response.status_code == 200 and not response.content):
+        return []
+    if response.status_code != 200:
+        raise FalhaHistoryPosition(veiculo, dia, response.status_code)
+    dados = response.json()
+    return dados if isinstance(dados, list) else [dados]
+
+def _dia_posicoes(token, veiculo, dia, ate=None):
+    agora = _agora_utc()
+    fim_dia = datetime.datetime.combine(dia, datetime.time.max)
+    ate = min(ate or fim_dia, agora)
+    chave = (str(veiculo), dia)
+
+    with _memoria_lock:
+        entrada = _memoria.get(chave)
+        if entrada is not None:
+            _memoria.move_to_end(chave)
+    if entrada is not None and _valida(entrada, ate, agora):
+        return entrada
+
+    # Um download por veículo/dia mesmo com várias threads pedindo a mesma chave
+    with _lock_da_chave(chave):
+        with _memoria_lock:
+            entrada = _memoria.get(chave)
+        if entrada is not None and _valida(entrada, ate, agora):
+            return entrada
+
+        entrada = _ler_disco(veiculo, dia)
+        if entrada is None:
+            obtido_em = _agora_utc()
+            posicoes = _buscar_api(token, veiculo, dia)
+            fechada = obtido_em >= fim_dia + datetime.timedelta(hours=POSICOES_FECHAMENTO_HORAS)
+            entrada = _montar_entrada(posicoes, obtido_em, fechada)
+            if fechada:
+                _gravar_disco(veiculo, dia, entrada["posicoes"])
+        _guardar_memoria(chave, entrada)
+        return entrada
+
+def posicoes_do_dia(token, veiculo, dia):
+    """
+    Todas as posições do veículo no dia UTC `dia` (date), ordenadas por
+    EventDate. Retorna None se a API falhar.
+    """
+    try:
+        entrada = _dia_posicoes(token, veiculo, dia)
+    except FalhaHistoryPosition as e:
+        print(e)
+        return None
+    return list(entrada["posicoes"])
+
+def posicoes_na_janela(token, veiculo, inicio_utc, fim_utc, levantar=False):
+    """
+    Posições do veículo com EventDate entre inicio_utc e fim_utc (datetimes
+    ingênuos em UTC, inclusive), juntando os dias UTC que a janela cobre.
+    Retorna None se a API falhar para algum dos dias; com levantar=True
+    propaga a FalhaHistoryPosition (com o status) em vez disso.
+    """
+    resultado = []
+    dia = inicio_utc.date()
+    while dia <= fim_utc.date():
+        try:
+            entrada = _dia_posicoes(token, veiculo, dia, ate=fim_utc)
+        except FalhaHistoryPosition as e:
+            if levantar:
+                raise
+            print(e)
+            return None
+        tempos = entrada["tempos"]
+        ini = bisect.bisect_left(tempos, inicio_utc)
+        fim = bisect.bisect_right(tempos, fim_utc)
+        resultado.extend(entrada["posicoes"][ini:fim])
+        dia += datetime.timedelta(days=1)
+    return resultado
@@ -0,0 +1,220 @@
+import os
+from dotenv import load_dotenv
+load_dotenv()
+
+import mysql.connector
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from authtoken import obter_token
+from migracoes import aplicar_migracoes
+import analise_velocidade
+import posicoes_cache
+import satx_datas
+
+# Reconstrução das viagens concluídas a partir das posições da HistoryPosition:
+# distância percorrida (odômetro), número de paradas e tempo parado. Roda de
+# forma incremental sobre as linhas de historico_grades alteradas desde a
+# última marca (atualizado_em, id) que já têm chegada real; as posições de
+# cada veículo/dia vêm do posicoes_cache, baixadas uma vez para todas as
+# viagens do dia.
+RECONSTRUCAO_LOTE = int(os.getenv("POWERBI_RECONSTRUCAO_LOTE", "200"))
+RECONSTRUCAO_CONCORRENCIA = int(os.getenv("POWERBI_RECONSTRUCAO_CONCORRENCIA", "4"))
+RECONSTRUCAO_FOLGA_SEGUNDOS = int(os.getenv("POWERBI_RECONSTRUCAO_FOLGA_SEGUNDOS", "120"))
+# Só viagens que chegaram nos últimos dias (a mesma janela revisada pelo grid);
+# evita reprocessar o histórico inteiro na primeira execução
+RECONSTRUCAO_JANELA_DIAS = int(os.getenv("POWERBI_RECONSTRUCAO_JANELA_DIAS", "10"))
+# Velocidade abaixo da qual o veículo é considerado parado e duração mínima de uma parada
+PARADA_VELOCIDADE_KMH = float(os.getenv("POWERBI_PARADA_VELOCIDADE_KMH", "3"))
+PARADA_MINIMA_S = int(os.getenv("POWERBI_PARADA_MINIMA_S", "60"))
+# Trechos que implicariam velocidade acima disto são saltos de GPS
+SALTO_GPS_KMH = float(os.getenv("POWERBI_SALTO_GPS_KMH", "150"))
+# Tentativas de uma viagem com falha transitória (timeout, 429, 5xx) antes
+# de a marca passar por ela; erros 4xx não seguram a marca
+RECONSTRUCAO_MAX_TENTATIVAS = int(os.getenv("POWERBI_RECONSTRUCAO_MAX_TENTATIVAS", "5"))
+
+MARCA = "reconstrucao_viagens"
+
+def conectar_mysql():
+    return mysql.connector.connect(
+        host=os.getenv("POWERBI_DB_HOST"),
+        database=os.getenv("POWERBI_DB_NAME"),
+        user=os.getenv("POWERBI_DB_USER"),
+        password=os.getenv("POWERBI_DB_PASSWORD")
+    )
+
+def reconstruir(posicoes):
+    """
+    Distância (km), paradas e tempo parado (s) de uma viagem, numa passada
+    vetorizada. Retorna None se não houver posições suficientes.
+    """
+    t, v, lat, lon = analise_velocidade.arrays_posicoes(posicoes)
+    if len(t) < 2:
+        return None
+
+    dist = analise_velocidade.distancias_haversine(lat, lon)
+    dt = np.diff(t).astype(np.float64)
+    # Odômetro: ignora saltos impossíveis e a oscilação do GPS com o veículo parado
+    velocidade_implicita = np.where(dt > 0, dist / np.where(dt > 0, dt, 1) * 3600, np.inf)
+    parado = v < PARADA_VELOCIDADE_KMH
+    valido = (velocidade_implicita <= SALTO_GPS_KMH) & ~(parado[:-1] & parado[1:])
+
+    paradas = analise_velocidade.episodios(parado, t, PARADA_MINIMA_S)
+    return {
+        "distancia_real_km": round(float(dist[valido].sum()), 3),
+        "paradas": int(len(paradas)),
+        "tempo_parado_s": int(paradas.sum()),
+    }
+
+def _garantir_marca(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS reconstrucao_marca (
+            nome VARCHAR(64) PRIMARY KEY,
+            ultima_alteracao DATETIME NOT NULL,
+            ultimo_id BIGINT NOT NULL
+        )
+    """)
+    cursor.execute("SELECT ultima_alteracao, ultimo_id FROM reconstrucao_marca WHERE nome = %s", (MARCA,))
+    linha = cursor.fetchone()
+    return linha if linha else ("1970-01-01 00:00:00", 0)
+
+def _garantir_falhas(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS reconstrucao_falhas (
+            id_grade BIGINT PRIMARY KEY,
+            tentativas INT NOT NULL,
+            ultimo_erro VARCHAR(255),
+            atualizado_em DATETIME NOT NULL
+        )
+    """)
+
+def _registrar_falha(cursor, id_grade, erro, permanente):
+    """Conta mais uma tentativa da viagem. Retorna True se ela ainda deve segurar a marca."""
+    cursor.execute("""
+        INSERT INTO reconstrucao_falhas (id_grade, tentativas, ultimo_erro, atualizado_em)
+        VALUES (%s, 1, %s, NOW())
+        ON DUPLICATE KEY UPDATE tentativas = tentativas + 1, ultimo_erro = VALUES(ultimo_erro), atualizado_em = NOW()
+    """, (id_grade, str(erro)[:255]))
+    if permanente:
+        print(f"Grade {id_grade} ignorada pela reconstrução: {erro}")
+        return False
+    cursor.execute("SELECT tentativas FROM reconstrucao_falhas WHERE id_grade = %s", (id_grade,))
+    tentativas = cursor.fetchone()[0]
+    if tentativas >= RECONSTRUCAO_MAX_TENTATIVAS:
+        print(f"Grade {id_grade} ignorada após {tentativas} tentativas: {erro}")
+        return False
+    return True
+
+def _gravar_lote(cursor, resultados):
+    # Um único UPDATE com CASE por coluna. atualizado_em = atualizado_em evita
+    # que a própria reconstrução dispare o ON UPDATE (e uma nova reconstrução
+    # e recálculo da MV). travelled_distance só é preenchida quando a SATX
+    # informou 0 ou nada.
+    ids = list(resultados)
+    sets = []
+    params = []
+    for coluna in ("distancia_real_km", "paradas", "tempo_parado_s"):
+        casos = " ".join(["WHEN %s THEN %s"] * len(ids))
+        sets.append(f"{coluna} = CASE id {casos} END")
+        params.extend(v for i in ids for v in (i, resultados[i][coluna]))
+    casos = " ".join(["WHEN %s THEN %s"] * len(ids))
+    distancias = [v for i in ids for v in (i, resultados[i]["distancia_real_km"])]
+    placeholders = ",".join(["%s"] * len(ids))
+    cursor.execute(f"""
+        UPDATE historico_grades SET
+            travelled_distance = IF(COALESCE(travelled_distance_num, 0) = 0, CAST(ROUND(CASE id {casos} END, 2) AS CHAR), travelled_distance),
+            travelled_distance_num = IF(COALESCE(travelled_distance_num, 0) = 0, ROUND(CASE id {casos} END, 2), travelled_distance_num),
+            {", ".join(sets)},
+            reconstruido_em = NOW(),
+            atualizado_em = atualizado_em
+        WHERE id IN ({placeholders})
+    """, distancias + distancias + params + ids)
+
+def _posicoes_viagem(token, veiculo, partida, chegada):
+    return posicoes_cache.posicoes_na_janela(
+        token, veiculo, satx_datas.local_para_utc(partida), satx_datas.local_para_utc(chegada),
+        levantar=True
+    )
+
+def reconstruir_viagens(concorrencia=None):
+    token = obter_token()
+    if not token:
+        print("Não foi possível obter token.")
+        return
+
+    conn = conectar_mysql()
+    aplicar_migracoes(conn)
+    cursor = conn.cursor()
+    ultima_alteracao, ultimo_id = _garantir_marca(cursor)
+    _garantir_falhas(cursor)
+    conn.commit()
+    cursor.execute("SELECT NOW() - INTERVAL %s SECOND", (RECONSTRUCAO_FOLGA_SEGUNDOS,))
+    limite = cursor.fetchone()[0]
+
+    executor = ThreadPoolExecutor(max_workers=concorrencia or RECONSTRUCAO_CONCORRENCIA)
+    total = 0
+    while True:
+        cursor.execute("""
+            SELECT id, atualizado_em, real_vehicle, real_departure_dt, real_arrival_dt
+            FROM historico_grades
+            WHERE (atualizado_em > %s OR (atualizado_em = %s AND id > %s)) AND atualizado_em < %s
+              AND real_arrival_dt IS NOT NULL
+              AND real_arrival_dt >= NOW() - INTERVAL %s DAY
+            ORDER BY atualizado_em, id
+            LIMIT %s
+        """, (ultima_alteracao, ultima_alteracao, ultimo_id, limite, RECONSTRUCAO_JANELA_DIAS, RECONSTRUCAO_LOTE))
+        linhas = cursor.fetchall()
+        if not linhas:
+            break
+        ultimo_id, ultima_alteracao = linhas[-1][0], linhas[-1][1]
+
+        futuros = {}
+        for id_grade, _, veiculo, partida, chegada in linhas:
+            # Só viagens concluídas
+            if veiculo and partida and chegada and chegada > partida:
+                futuros[executor.submit(_posicoes_viagem, token, veiculo, partida, chegada)] = id_grade
+
+        resultados = {}
+        concluidas = []
+        falhou = False
+        for futuro in as_completed(futuros):
+            id_grade = futuros[futuro]
+            try:
+                posicoes = futuro.result()
+            except posicoes_cache.FalhaHistoryPosition as e:
+                falhou |= _registrar_falha(cursor, id_grade, e, permanente=not e.transitoria)
+                continue
+            except Exception as e:
+                # Timeouts e erros de conexão: transitórios
+                print(f"Erro buscando posições da grade {id_grade}: {e}")
+                falhou |= _registrar_falha(cursor, id_grade, e, permanente=False)
+                continue
+            concluidas.append(id_grade)
+            resultado = reconstruir(posicoes)
+            if resultado:
+                resultados[id_grade] = resultado
+
+        if resultados:
+            _gravar_lote(cursor, resultados)
+        if concluidas:
+            placeholders = ",".join(["%s"] * len(concluidas))
+            cursor.execute(f"DELETE FROM reconstrucao_falhas WHERE id_grade IN ({placeholders})", concluidas)
+        if falhou:
+            # Marca não avança: o lote é repetido na próxima execução
+            conn.commit()
+            total += len(resultados)
+            print("⚠️ Falha transitória na HistoryPosition; lote será repetido na próxima execução.")
+            break
+        cursor.execute("""
+            INSERT INTO reconstrucao_marca (nome, ultima_alteracao, ultimo_id) VALUES (%s, %s, %s)
+            ON DUPLICATE KEY UPDATE ultima_alteracao = VALUES(ultima_alteracao), ultimo_id = VALUES(ultimo_id)
+        """, (MARCA, ultima_alteracao, ultimo_id))
+        conn.commit()
+        total += len(resultados)
+
+    executor.shutdown(wait=True)
+    cursor.close()
+    conn.close()
+    print(f"✅ Reconstrução concluída: {total} viagens atualizadas.")
+
+if __name__ == '__main__':
+    reconstruir_viagens()
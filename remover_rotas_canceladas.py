@@ -2,231 +2,240 @@ import os
 from dotenv import load_dotenv
 load_dotenv()
 
-import requests
 import datetime
 import mysql.connector
 import pytz
 from authtoken import obter_token
-
-def remover_rotas_canceladas(dias_verificar=10):
-    token = obter_token()
-    if not token:
-        print("Não foi possível obter token.")
-        return
-
-    api_url = "https://integration.systemsatx.com.br/GlobalBus/Grid/List?paramClientIntegrationCode=1003"
-    headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
-
-    try:
-        conn = mysql.connector.connect(
-            host=os.getenv("POWERBI_DB_HOST"),
-            database=os.getenv("POWERBI_DB_NAME"),
-            user=os.getenv("POWERBI_DB_USER"),
-            password=os.getenv("POWERBI_DB_PASSWORD")
+import cache_clientes
+import grid_snapshots
+import satx_client
+from grid import atualizar_grade_ultima_dia
+from routeviolation import garantir_tabelas_mv, refresh_mv
+
+TABELAS_RECONCILIACAO = ("historico_grades", "informacoes")
+# Recalcula na MV as chaves removidas ao fim da reconciliação
+RECONCILIACAO_ATUALIZAR_MV = os.getenv("POWERBI_RECONCILIACAO_ATUALIZAR_MV", "1") == "1"
+# Snapshot do Grid/List aceito sem nova busca (cobre um ciclo do processar_grid)
+RECONCILIACAO_VALIDADE_SNAPSHOT = int(os.getenv("POWERBI_RECONCILIACAO_VALIDADE_SNAPSHOT_SEGUNDOS", "900"))
+
+# A fase de remoção é feita por conjunto: os pares (chave, data) vão em lote
+# para uma tabela temporária e cada tabela de destino recebe um único DELETE
+# com JOIN. Remoções não alteram atualizado_em; as chaves removidas ficam
+# pendentes em mv_chaves_pendentes para o refresh incremental da
+# informacoes_com_cliente_mv.
+def _carregar_remocoes(cursor, canceled_map, missing_map, normalizar=None):
+    """
+    Carrega os pares (chave, data) a remover em remocao_chaves. Um par
+    cancelado e ausente ao mesmo tempo conta como cancelado.
+    Retorna as datas afetadas.
+    """
+    pares = {}
+    for motivo, mapa in (("ausente", missing_map), ("cancelada", canceled_map)):
+        for chave, datas in mapa.items():
+            chave = normalizar(chave) if normalizar else chave
+            for dt in datas:
+                pares[(chave, dt)] = motivo
+
+    cursor.execute("DROP TEMPORARY TABLE IF EXISTS remocao_chaves")
+    cursor.execute("""
+        CREATE TEMPORARY TABLE remocao_chaves (
+            chave VARCHAR(255) NOT NULL,
+            data DATE NOT NULL,
+            motivo VARCHAR(16) NOT NULL,
+            PRIMARY KEY (chave, data)
         )
-    except mysql.connector.Error as err:
-        print("Erro ao conectar no banco de dados:", err)
-        return
-
-    cursor = conn.cursor()
-    cursor.execute("SELECT DISTINCT route_integration_code FROM graderumocerto")
-    routes_in_db = {row[0] for row in cursor.fetchall() if row[0]}
-
-    canceled_map = {}
-    missing_map = {}
-    now = datetime.datetime.now(pytz.timezone("America/Sao_Paulo"))
-    for i in range(dias_verificar):
-        data_alvo = now - datetime.timedelta(days=i)
-        data_iso = data_alvo.strftime("%Y-%m-%dT00:00:00Z")
-        payload = [{"PropertyName": "EffectiveDate", "Condition": "Equal", "Value": data_iso}]
-        try:
-            resp = requests.post(api_url, headers=headers, json=payload, timeout=30)
-        except Exception as e:
-            print(f"Erro ao consultar API para {data_alvo.date()}: {e}")
-            continue
-
-        if resp.status_code != 200:
-            print(f"API retornou {resp.status_code} para {data_alvo.date()}")
-            continue
-
-        try:
-            items = resp.json()
-        except Exception:
-            continue
-
-        api_present = {it.get('RouteIntegrationCode') for it in items if it.get('RouteIntegrationCode')}
-
-        for item in items:
-            if item.get('IsTripCanceled') is True:
-                code = item.get('RouteIntegrationCode')
-                if code and code in routes_in_db:
-                    canceled_map.setdefault(code, set()).add(data_alvo.date())
-
-        cursor.execute("SELECT DISTINCT route_integration_code FROM historico_grades WHERE data_registro = %s", (data_alvo.date(),))
-        db_codes_date = {row[0] for row in cursor.fetchall() if row[0]}
-
-        to_remove = db_codes_date - api_present
-        for code in to_remove:
-            if code in routes_in_db:
-                missing_map.setdefault(code, set()).add(data_alvo.date())
-
-    if not canceled_map and not missing_map:
-        print("Nenhuma rota cancelada ou ocorrência ausente encontrada no período verificado.")
-        cursor.close()
-        conn.close()
-        return
-
-    if canceled_map:
-        print("Removendo ocorrências marcadas como canceladas (historico_grades):")
-        for code, dates in canceled_map.items():
-            for dt in dates:
-                try:
-                    cursor.execute(
-                        "DELETE FROM historico_grades WHERE route_integration_code = %s AND data_registro = %s",
-                        (code, dt)
-                    )
-                    print(f"  - {code} removida do historico em {dt} (cancelada)")
-                except Exception as e:
-                    print(f"Erro removendo historico {code} em {dt}: {e}")
-                    conn.rollback()
-
-    if missing_map:
-        print("Removendo ocorrências ausentes na API (historico_grades):")
-        for code, dates in missing_map.items():
-            for dt in dates:
-                try:
-                    cursor.execute(
-                        "DELETE FROM historico_grades WHERE route_integration_code = %s AND data_registro = %s",
-                        (code, dt)
-                    )
-                    print(f"  - {code} removida do historico em {dt} (ausente na API)")
-                except Exception as e:
-                    print(f"Erro removendo historico ausente {code} em {dt}: {e}")
-                    conn.rollback()
-
-    conn.commit()
-    cursor.close()
-    conn.close()
-    print("Remoção concluída.")
-
-def remover_rotas_canceladas_informacoes(dias_verificar=10):
+    """)
+    cursor.executemany(
+        "INSERT INTO remocao_chaves (chave, data, motivo) VALUES (%s, %s, %s)",
+        [(chave, dt, motivo) for (chave, dt), motivo in pares.items()]
+    )
+    return sorted({dt for _, dt in pares})
+
+def _reportar_por_data(cursor, tabela, juncao):
+    # Contagem por data/motivo antes do DELETE (o rowcount só dá o total)
+    cursor.execute(f"""
+        SELECT r.data, r.motivo, COUNT(*)
+        FROM {tabela} t JOIN remocao_chaves r ON {juncao}
+        GROUP BY r.data, r.motivo
+        ORDER BY r.data, r.motivo
+    """)
+    for dt, motivo, total in cursor.fetchall():
+        print(f"  - {dt}: {total} linha(s) removida(s) ({motivo})")
+
+def _remover_historico(cursor):
+    juncao = "t.route_integration_code = r.chave AND t.data_registro = r.data"
+    _reportar_por_data(cursor, "historico_grades", juncao)
+    cursor.execute(f"""
+        INSERT IGNORE INTO mv_chaves_pendentes (route_name_norm, data_execucao)
+        SELECT t.route_key, t.data_registro
+        FROM historico_grades t JOIN remocao_chaves r ON {juncao}
+        WHERE t.route_key IS NOT NULL
+    """)
+    cursor.execute(f"DELETE t FROM historico_grades t JOIN remocao_chaves r ON {juncao}")
+    return cursor.rowcount
+
+def _remover_informacoes(cursor):
+    # remocao_chaves.chave já vem normalizada como route_key
+    juncao = "t.route_key = r.chave AND t.data_execucao = r.data"
+    _reportar_por_data(cursor, "informacoes", juncao)
+    cursor.execute("""
+        INSERT IGNORE INTO mv_chaves_pendentes (route_name_norm, data_execucao)
+        SELECT chave, data FROM remocao_chaves
+    """)
+    cursor.execute(f"DELETE t FROM informacoes t JOIN remocao_chaves r ON {juncao}")
+    return cursor.rowcount
+
+def _route_key(route_name):
+    # Mesma normalização de TRIM(LOWER(...)) usada em route_key
+    return route_name.lower().strip(" ")
+
+def _codigos_do_dia(token, data_alvo):
+    """
+    Lê o Grid/List do dia em streaming, sem montar a lista de itens, reusando
+    o snapshot do processar_grid se for recente.
+    Retorna (códigos presentes, códigos cancelados) ou None em caso de erro.
+    """
+    try:
+        with grid_snapshots.abrir_grade_dia(token, data_alvo, idade_maxima=RECONCILIACAO_VALIDADE_SNAPSHOT) as resp:
+            if resp is None:
+                return None
+
+            api_present = set()
+            api_canceled = set()
+            try:
+                for it in satx_client.iterar_array_json(resp):
+                    code = it.get('RouteIntegrationCode')
+                    if not code:
+                        continue
+                    api_present.add(code)
+                    if it.get('IsTripCanceled') is True:
+                        api_canceled.add(code)
+                resp.confirmar()
+            except Exception as e:
+                print(f"Erro lendo grade de {data_alvo.date()}: {e}")
+                return None
+    except Exception as e:
+        print(f"Erro ao consultar API para {data_alvo.date()}: {e}")
+        return None
+    return api_present, api_canceled
+
+def _conectar():
+    return mysql.connector.connect(
+        host=os.getenv("POWERBI_DB_HOST"),
+        database=os.getenv("POWERBI_DB_NAME"),
+        user=os.getenv("POWERBI_DB_USER"),
+        password=os.getenv("POWERBI_DB_PASSWORD")
+    )
+
+def reconciliar_rotas(dias_verificar=10, tabelas=TABELAS_RECONCILIACAO, atualizar_mv=None):
+    """
+    Reconcilia historico_grades e informacoes com o Grid/List numa única
+    passada: cada dia é baixado uma vez e os conjuntos de rotas canceladas e
+    ausentes das duas tabelas saem da mesma resposta. As remoções são
+    gravadas numa única transação; com atualizar_mv as chaves afetadas são
+    recalculadas na informacoes_com_cliente_mv logo em seguida.
+    """
+    if atualizar_mv is None:
+        atualizar_mv = RECONCILIACAO_ATUALIZAR_MV
     token = obter_token()
     if not token:
         print("Não foi possível obter token.")
         return
 
-    api_url = "https://integration.systemsatx.com.br/GlobalBus/Grid/List?paramClientIntegrationCode=1003"
-    headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
-
     try:
-        conn = mysql.connector.connect(
-            host=os.getenv("POWERBI_DB_HOST"),
-            database=os.getenv("POWERBI_DB_NAME"),
-            user=os.getenv("POWERBI_DB_USER"),
-            password=os.getenv("POWERBI_DB_PASSWORD")
-        )
+        conn = _conectar()
     except mysql.connector.Error as err:
         print("Erro ao conectar no banco de dados:", err)
         return
 
     cursor = conn.cursor()
-
-    # mapear integration_code -> route_name a partir de graderumocerto
+    garantir_tabelas_mv(cursor)
     try:
-        cursor.execute("SELECT route_integration_code, route_name FROM graderumocerto")
-        rows = cursor.fetchall()
+        rotas = cache_clientes.rotas_graderumocerto(cursor)
     except Exception as e:
         print("Erro obtendo mapping em graderumocerto:", e)
         cursor.close()
         conn.close()
         return
+    routes_in_db = set(rotas)
+    code_to_name = {c: n for c, n in rotas.items() if n}
+    route_names_set = set(code_to_name.values())
 
-    code_to_name = {r[0]: r[1] for r in rows if r[0] and r[1]}
-    route_names_set = {r[1] for r in rows if r[1]}
-
-    canceled_map = {}
-    missing_map = {}
+    # historico_grades é reconciliado por código; informacoes por RouteName
+    canceled_hist, missing_hist = {}, {}
+    canceled_info, missing_info = {}, {}
     now = datetime.datetime.now(pytz.timezone("America/Sao_Paulo"))
     for i in range(dias_verificar):
         data_alvo = now - datetime.timedelta(days=i)
-        data_iso = data_alvo.strftime("%Y-%m-%dT00:00:00Z")
-        payload = [{"PropertyName": "EffectiveDate", "Condition": "Equal", "Value": data_iso}]
-        try:
-            resp = requests.post(api_url, headers=headers, json=payload, timeout=30)
-        except Exception as e:
-            print(f"Erro ao consultar API para {data_alvo.date()}: {e}")
-            continue
-
-        if resp.status_code != 200:
-            print(f"API retornou {resp.status_code} para {data_alvo.date()}")
-            continue
-
-        try:
-            items = resp.json()
-        except Exception:
+        dt = data_alvo.date()
+        codigos = _codigos_do_dia(token, data_alvo)
+        if codigos is None:
             continue
-
-        api_present_codes = {it.get('RouteIntegrationCode') for it in items if it.get('RouteIntegrationCode')}
-        api_present_names = {code_to_name.get(c) for c in api_present_codes if code_to_name.get(c)}
-
-        for item in items:
-            if item.get('IsTripCanceled') is True:
-                code = item.get('RouteIntegrationCode')
+        api_present, api_canceled = codigos
+
+        if "historico_grades" in tabelas:
+            for code in api_canceled & routes_in_db:
+                canceled_hist.setdefault(code, set()).add(dt)
+            cursor.execute("SELECT DISTINCT route_integration_code FROM historico_grades WHERE data_registro = %s", (dt,))
+            db_codes_date = {row[0] for row in cursor.fetchall() if row[0]}
+            for code in (db_codes_date - api_present) & routes_in_db:
+                missing_hist.setdefault(code, set()).add(dt)
+
+        if "informacoes" in tabelas:
+            for code in api_canceled:
                 route_name = code_to_name.get(code)
-                if route_name and route_name in route_names_set:
-                    canceled_map.setdefault(route_name, set()).add(data_alvo.date())
-
-        # buscar RouteName na tabela informacoes usando a coluna data_execucao
-        try:
-            cursor.execute("SELECT DISTINCT RouteName FROM informacoes WHERE data_execucao = %s", (data_alvo.date(),))
-            db_names_date = {row[0] for row in cursor.fetchall() if row[0]}
-        except Exception as e:
-            print(f"Erro consultando informacoes (RouteName):", e)
-            continue
-
-        to_remove = db_names_date - api_present_names
-        for route_name in to_remove:
-            if route_name in route_names_set:
-                missing_map.setdefault(route_name, set()).add(data_alvo.date())
-
-    if not canceled_map and not missing_map:
-        print("Nenhuma rota cancelada ou ocorrência ausente encontrada no período verificado (informacoes).")
+                if route_name:
+                    canceled_info.setdefault(route_name, set()).add(dt)
+            api_present_names = {code_to_name[c] for c in api_present if c in code_to_name}
+            try:
+                cursor.execute("SELECT DISTINCT RouteName FROM informacoes WHERE data_execucao = %s", (dt,))
+                db_names_date = {row[0] for row in cursor.fetchall() if row[0]}
+            except Exception as e:
+                print(f"Erro consultando informacoes (RouteName):", e)
+                continue
+            for route_name in (db_names_date - api_present_names) & route_names_set:
+                missing_info.setdefault(route_name, set()).add(dt)
+
+    if not (canceled_hist or missing_hist or canceled_info or missing_info):
+        print("Nenhuma rota cancelada ou ocorrência ausente encontrada no período verificado.")
         cursor.close()
         conn.close()
         return
 
-    if canceled_map:
-        print("Removendo ocorrências marcadas como canceladas (informacoes):")
-        for route_name, dates in canceled_map.items():
-            for dt in dates:
-                try:
-                    cursor.execute(
-                        "DELETE FROM informacoes WHERE TRIM(LOWER(RouteName)) = TRIM(LOWER(%s)) AND data_execucao = %s",
-                        (route_name, dt)
-                    )
-                    print(f"  - {route_name} removida de informacoes em {dt} (cancelada)")
-                except Exception as e:
-                    print(f"Erro removendo informacoes {route_name} em {dt}: {e}")
-                    conn.rollback()
-
-    if missing_map:
-        print("Removendo ocorrências ausentes na API (informacoes):")
-        for route_name, dates in missing_map.items():
-            for dt in dates:
-                try:
-                    cursor.execute(
-                        "DELETE FROM informacoes WHERE TRIM(LOWER(RouteName)) = TRIM(LOWER(%s)) AND data_execucao = %s",
-                        (route_name, dt)
-                    )
-                    print(f"  - {route_name} removida de informacoes em {dt} (ausente na API)")
-                except Exception as e:
-                    print(f"Erro removendo informacoes ausente {route_name} em {dt}: {e}")
-                    conn.rollback()
+    try:
+        if canceled_hist or missing_hist:
+            print("Removendo ocorrências canceladas/ausentes na API (historico_grades):")
+            datas_afetadas = _carregar_remocoes(cursor, canceled_hist, missing_hist)
+            removidas = _remover_historico(cursor)
+            # O registro mais recente por rota/dia pode ter sido removido
+            for dt in datas_afetadas:
+                atualizar_grade_ultima_dia(cursor, dt)
+            print(f"Total removido do historico: {removidas}")
+        if canceled_info or missing_info:
+            print("Removendo ocorrências canceladas/ausentes na API (informacoes):")
+            _carregar_remocoes(cursor, canceled_info, missing_info, normalizar=_route_key)
+            removidas = _remover_informacoes(cursor)
+            print(f"Total removido de informacoes: {removidas}")
+        conn.commit()
+    except mysql.connector.Error as e:
+        print("Erro removendo ocorrências:", e)
+        conn.rollback()
+        cursor.close()
+        conn.close()
+        return
 
-    conn.commit()
     cursor.close()
     conn.close()
-    print("Remoção em informacoes concluída.")
+    print("Reconciliação concluída.")
+    if atualizar_mv:
+        # O refresh incremental consome as chaves marcadas em mv_chaves_pendentes
+        refresh_mv()
+
+def remover_rotas_canceladas(dias_verificar=10):
+    reconciliar_rotas(dias_verificar, tabelas=("historico_grades",), atualizar_mv=False)
+
+def remover_rotas_canceladas_informacoes(dias_verificar=10):
+    reconciliar_rotas(dias_verificar, tabelas=("informacoes",), atualizar_mv=False)
 
 if __name__ == "__main__":
 	import sys
@@ -6,9 +6,15 @@ import requests
 import mysql.connector
 from datetime import datetime
 from authtoken import obter_token
+import satx_client
+import satx_datas
+import posicoes_cache
+import analise_velocidade
+import desvio_rota
+from migracoes import aplicar_migracoes
 import time
-from dateutil import parser
 import pytz
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from apscheduler.schedulers.background import BackgroundScheduler
 import atexit
 
@@ -16,9 +22,6 @@ def routeviolation(token):
     parana_tz = pytz.timezone("America/Sao_Paulo")
     hoje = datetime.now(parana_tz).date()
 
-    url = "https://integration.systemsatx.com.br/GlobalBus/Trip/TripsWithNonConformity"
-    headers = {"Authorization": f"Bearer {token}"}
-
     try:
         conn = mysql.connector.connect(
             host=os.getenv("POWERBI_DB_HOST"),
@@ -61,7 +64,7 @@ def routeviolation(token):
             "InconformityType": 1
         }
 
-        response = requests.post(url, json=payload, headers=headers)
+        response = satx_client.post(satx_client.TRIPS_NON_CONFORMITY, token=token, json=payload)
         response.raise_for_status()
         data = response.json()
 
@@ -112,7 +115,222 @@ def routeviolation(token):
     except requests.exceptions.RequestException as e:
         print("❌ Erro na requisição:", e)
 
-def refresh_mv():
+# Refresh da informacoes_com_cliente_mv. O modo incremental lê as linhas de
+# informacoes e historico_grades alteradas desde a última marca d'água
+# (atualizado_em, id) com paginação por chave e recalcula só as chaves
+# (rota normalizada, data) afetadas. Remoções são registradas pelo
+# remover_rotas_canceladas em mv_chaves_pendentes. A reconstrução completa
+# continua disponível com refresh_mv(completo=True).
+MV_LOTE = int(os.getenv("POWERBI_MV_LOTE", "500"))
+MV_LOTE_RECONSTRUCAO = int(os.getenv("POWERBI_MV_LOTE_RECONSTRUCAO", "20000"))
+# Fração máxima de linhas que a reconstrução pode perder em relação à MV atual
+# antes de ser descartada (proteção contra origem vazia ou incompleta).
+MV_QUEDA_MAXIMA = float(os.getenv("POWERBI_MV_QUEDA_MAXIMA", "0.2"))
+
+MV_TABELA = "informacoes_com_cliente_mv"
+MV_SOMBRA = "informacoes_com_cliente_mv_nova"
+MV_ANTIGA = "informacoes_com_cliente_mv_antiga"
+# Linhas alteradas há menos de MV_FOLGA_SEGUNDOS ficam para a próxima
+# execução, para não perder transações que ainda não tinham feito commit.
+MV_FOLGA_SEGUNDOS = int(os.getenv("POWERBI_MV_FOLGA_SEGUNDOS", "120"))
+
+# Colunas explícitas: a MV tem também a route_key gerada (migracoes.py)
+MV_COLUNAS = """
+    (id, LineName, RouteName, Direction, RealVehicle, data_execucao, url,
+     violation_type, client_name, real_departure, real_arrival, id_grade)
+"""
+
+MV_SELECT = """
+    SELECT
+        i.id,
+        i.LineName,
+        i.RouteName,
+        i.Direction,
+        i.RealVehicle,
+        i.data_execucao,
+        i.url,
+        i.violation_type,
+        COALESCE(h.client_name, g.client_name) AS client_name,
+        h.real_departure,
+        h.real_arrival,
+        h.id AS id_grade
+"""
+
+# Junta graderumocerto e o registro mais recente de historico_grades por
+# rota/data, já pré-calculado em historico_grades_ultima
+MV_JOINS = """
+    JOIN
+        u834686159_powerbi.graderumocerto g
+        ON g.route_key = i.route_key
+    JOIN
+        u834686159_powerbi.historico_grades_ultima u
+        ON u.route_name_norm = i.route_key AND u.data_registro = i.data_execucao
+    JOIN
+        u834686159_powerbi.historico_grades h
+        ON h.id = u.id_grade
+"""
+
+MV_ALTERACOES = {
+    "informacoes": """
+        SELECT id, atualizado_em, route_key, data_execucao
+        FROM u834686159_powerbi.informacoes
+        WHERE (atualizado_em > %s OR (atualizado_em = %s AND id > %s)) AND atualizado_em < %s
+        ORDER BY atualizado_em, id
+        LIMIT %s
+    """,
+    "historico_grades": """
+        SELECT id, atualizado_em, route_key, data_registro
+        FROM u834686159_powerbi.historico_grades
+        WHERE (atualizado_em > %s OR (atualizado_em = %s AND id > %s)) AND atualizado_em < %s
+        ORDER BY atualizado_em, id
+        LIMIT %s
+    """,
+}
+
+def garantir_tabelas_mv(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS mv_marcas_dagua (
+            tabela VARCHAR(64) PRIMARY KEY,
+            ultima_alteracao DATETIME NOT NULL,
+            ultimo_id BIGINT NOT NULL
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS mv_chaves_pendentes (
+            route_name_norm VARCHAR(255) NOT NULL,
+            data_execucao DATE NOT NULL,
+            PRIMARY KEY (route_name_norm, data_execucao)
+        )
+    """)
+
+def _carregar_marcas(cursor):
+    cursor.execute("SELECT tabela, ultima_alteracao, ultimo_id FROM mv_marcas_dagua")
+    return {r[0]: (r[1], r[2]) for r in cursor.fetchall()}
+
+def _salvar_marca(cursor, tabela, ultima_alteracao, ultimo_id):
+    cursor.execute("""
+        INSERT INTO mv_marcas_dagua (tabela, ultima_alteracao, ultimo_id) VALUES (%s, %s, %s)
+        ON DUPLICATE KEY UPDATE ultima_alteracao = VALUES(ultima_alteracao), ultimo_id = VALUES(ultimo_id)
+    """, (tabela, ultima_alteracao, ultimo_id))
+
+def _reconstruir_mv(conn, cursor, limite):
+    # A reconstrução preenche uma tabela sombra e troca as duas com um único
+    # RENAME TABLE: leitores da MV nunca veem a tabela vazia ou pela metade.
+    print(f"🔄 Reconstruindo a Materialized View (MV) às {datetime.now()}...")
+
+    # Tudo que está pendente agora é coberto pela reconstrução, mas só sai de
+    # mv_chaves_pendentes depois da troca: se a sombra for descartada, o
+    # refresh incremental ainda precisa dessas chaves.
+    cursor.execute("DROP TEMPORARY TABLE IF EXISTS mv_chaves_cobertas")
+    cursor.execute("""
+        CREATE TEMPORARY TABLE mv_chaves_cobertas
+        SELECT route_name_norm, data_execucao FROM mv_chaves_pendentes
+    """)
+
+    cursor.execute(f"DROP TABLE IF EXISTS {MV_SOMBRA}")
+    cursor.execute(f"CREATE TABLE {MV_SOMBRA} LIKE {MV_TABELA}")
+
+    # Ninguém lê a sombra: faixas grandes de id, um INSERT ... SELECT por faixa
+    cursor.execute("SELECT MIN(id), MAX(id) FROM informacoes")
+    min_id, max_id = cursor.fetchone()
+    if min_id is not None:
+        inicio = min_id
+        while inicio <= max_id:
+            fim = inicio + MV_LOTE_RECONSTRUCAO
+            cursor.execute(f"""
+                INSERT INTO {MV_SOMBRA} {MV_COLUNAS}
+                {MV_SELECT}
+                FROM u834686159_powerbi.informacoes i
+                {MV_JOINS}
+                WHERE i.id >= %s AND i.id < %s AND h.real_departure IS NOT NULL;
+            """, (inicio, fim))
+            conn.commit()
+            inicio = fim
+
+    cursor.execute(f"SELECT COUNT(*) FROM {MV_SOMBRA}")
+    novas = cursor.fetchone()[0]
+    cursor.execute(f"SELECT COUNT(*) FROM {MV_TABELA}")
+    atuais = cursor.fetchone()[0]
+    if atuais and novas < atuais * (1 - MV_QUEDA_MAXIMA):
+        # Queda brusca indica falha na origem; mantém a MV atual
+        print(f"❌ Reconstrução descartada: {novas} linhas contra {atuais} na MV atual.")
+        cursor.execute(f"DROP TABLE IF EXISTS {MV_SOMBRA}")
+        return
+
+    cursor.execute(f"DROP TABLE IF EXISTS {MV_ANTIGA}")
+    cursor.execute(f"RENAME TABLE {MV_TABELA} TO {MV_ANTIGA}, {MV_SOMBRA} TO {MV_TABELA}")
+    cursor.execute(f"DROP TABLE {MV_ANTIGA}")
+
+    cursor.execute("""
+        DELETE p FROM mv_chaves_pendentes p
+        JOIN mv_chaves_cobertas c
+          ON c.route_name_norm = p.route_name_norm AND c.data_execucao = p.data_execucao
+    """)
+    for tabela in MV_ALTERACOES:
+        _salvar_marca(cursor, tabela, limite, 0)
+    conn.commit()
+    print(f"✅ MV reconstruída com sucesso ({novas} linhas; antes {atuais}).")
+
+def _recalcular_chaves(cursor, chaves):
+    cursor.execute("DELETE FROM mv_chaves_lote")
+    cursor.executemany("INSERT IGNORE INTO mv_chaves_lote (route_name_norm, data_execucao) VALUES (%s, %s)", list(chaves))
+    cursor.execute(f"""
+        DELETE mv FROM {MV_TABELA} mv
+        JOIN mv_chaves_lote k
+          ON mv.route_key = k.route_name_norm AND mv.data_execucao = k.data_execucao
+    """)
+    cursor.execute(f"""
+        INSERT INTO {MV_TABELA} {MV_COLUNAS}
+        {MV_SELECT}
+        FROM mv_chaves_lote k
+        JOIN u834686159_powerbi.informacoes i
+          ON i.route_key = k.route_name_norm AND i.data_execucao = k.data_execucao
+        {MV_JOINS}
+        WHERE h.real_departure IS NOT NULL;
+    """)
+
+def _refresh_incremental(conn, cursor, marcas, limite):
+    print(f"🔄 Atualizando a Materialized View (MV) de forma incremental às {datetime.now()}...")
+    cursor.execute("""
+        CREATE TEMPORARY TABLE IF NOT EXISTS mv_chaves_lote (
+            route_name_norm VARCHAR(255) NOT NULL,
+            data_execucao DATE NOT NULL,
+            PRIMARY KEY (route_name_norm, data_execucao)
+        )
+    """)
+
+    recalculadas = 0
+    for tabela, consulta in MV_ALTERACOES.items():
+        ultima_alteracao, ultimo_id = marcas[tabela]
+        while True:
+            cursor.execute(consulta, (ultima_alteracao, ultima_alteracao, ultimo_id, limite, MV_LOTE))
+            linhas = cursor.fetchall()
+            if not linhas:
+                break
+            chaves = {(r[2], r[3]) for r in linhas if r[2] and r[3]}
+            if chaves:
+                _recalcular_chaves(cursor, chaves)
+            ultimo_id, ultima_alteracao = linhas[-1][0], linhas[-1][1]
+            _salvar_marca(cursor, tabela, ultima_alteracao, ultimo_id)
+            conn.commit()
+            recalculadas += len(chaves)
+
+    # Chaves de linhas removidas (não aparecem por atualizado_em)
+    while True:
+        cursor.execute("SELECT route_name_norm, data_execucao FROM mv_chaves_pendentes LIMIT %s", (MV_LOTE,))
+        chaves = cursor.fetchall()
+        if not chaves:
+            break
+        _recalcular_chaves(cursor, chaves)
+        cursor.executemany("DELETE FROM mv_chaves_pendentes WHERE route_name_norm = %s AND data_execucao = %s", chaves)
+        conn.commit()
+        recalculadas += len(chaves)
+
+    print(f"✅ MV atualizada com sucesso ({recalculadas} chaves rota/data recalculadas).")
+
+def refresh_mv(completo=False):
+    conn = None
+    bloqueado = False
     try:
         conn = mysql.connector.connect(
             host=os.getenv("POWERBI_DB_HOST"),
@@ -120,73 +338,91 @@ def refresh_mv():
             user=os.getenv("POWERBI_DB_USER"),
             password=os.getenv("POWERBI_DB_PASSWORD")
         )
+        aplicar_migracoes(conn)
         cursor = conn.cursor()
-
-        print(f"🔄 Atualizando a Materialized View (MV) às {datetime.now()}...")
-
-        cursor.execute("TRUNCATE TABLE informacoes_com_cliente_mv;")
-        conn.commit()
-
-        # Processar em lotes menores para evitar timeouts no servidor
-        cursor.execute("SELECT COUNT(*) FROM informacoes;")
-        total = cursor.fetchone()[0]
-        batch_size = 500
-        offset = 0
-
-        while offset < total:
-            cursor.execute("SELECT id FROM informacoes ORDER BY id LIMIT %s OFFSET %s", (batch_size, offset))
-            ids = [row[0] for row in cursor.fetchall()]
-            if not ids:
-                break
-
-            placeholders = ",".join(["%s"] * len(ids))
-
-            insert_sql = f"""
-                INSERT INTO informacoes_com_cliente_mv
-                SELECT 
-                    i.id,
-                    i.LineName,
-                    i.RouteName,
-                    i.Direction,
-                    i.RealVehicle,
-                    i.data_execucao,
-                    i.url,
-                    i.violation_type,
-                    COALESCE(h.client_name, g.client_name) AS client_name,
-                    h.real_departure,
-                    h.real_arrival,
-                    h.id AS id_grade
-                FROM 
-                    u834686159_powerbi.informacoes i
-                JOIN 
-                    u834686159_powerbi.graderumocerto g 
-                    ON TRIM(LOWER(i.RouteName)) = TRIM(LOWER(g.route_name))
-                JOIN (
-                    -- pega apenas o registro mais recente por rota/data na historico_grades
-                    SELECT hg.*
-                    FROM u834686159_powerbi.historico_grades hg
-                    JOIN (
-                        SELECT TRIM(LOWER(route_name)) AS route_name_norm, data_registro, MAX(id) AS max_id
-                        FROM u834686159_powerbi.historico_grades
-                        GROUP BY TRIM(LOWER(route_name)), data_registro
-                    ) latest
-                    ON TRIM(LOWER(hg.route_name)) = latest.route_name_norm AND hg.data_registro = latest.data_registro AND hg.id = latest.max_id
-                ) h ON TRIM(LOWER(i.RouteName)) = TRIM(LOWER(h.route_name)) AND i.data_execucao = h.data_registro
-                WHERE i.id IN ({placeholders}) AND h.id IS NOT NULL AND h.real_departure IS NOT NULL;
-            """
-
-            cursor.execute(insert_sql, tuple(ids))
-            conn.commit()
-
-            offset += batch_size
-
-        print("✅ MV atualizada com sucesso.")
-        conn.close()
+        garantir_tabelas_mv(cursor)
+
+        # Refresh incremental e reconstrução não podem rodar ao mesmo tempo
+        cursor.execute("SELECT GET_LOCK('refresh_mv', 0)")
+        if not cursor.fetchone()[0]:
+            print("⏩ Refresh da MV já em andamento; pulando.")
+            return
+        bloqueado = True
+
+        cursor.execute("SELECT NOW() - INTERVAL %s SECOND", (MV_FOLGA_SEGUNDOS,))
+        limite = cursor.fetchone()[0]
+
+        marcas = _carregar_marcas(cursor)
+        # Sem marcas d'água ainda (primeira execução) só a reconstrução é confiável
+        if completo or any(tabela not in marcas for tabela in MV_ALTERACOES):
+            _reconstruir_mv(conn, cursor, limite)
+        else:
+            _refresh_incremental(conn, cursor, marcas, limite)
 
     except Exception as e:
         print(f"❌ Erro ao atualizar a MV: {e}")
-
-def verificar_violações_por_velocidade(token):
+    finally:
+        # Sem isso uma exceção deixaria o lock preso até a sessão cair
+        if conn is not None:
+            try:
+                if bloqueado:
+                    cursor = conn.cursor()
+                    cursor.execute("SELECT RELEASE_LOCK('refresh_mv')")
+                    cursor.fetchone()
+                    cursor.close()
+            except mysql.connector.Error:
+                pass
+            conn.close()
+
+# Verificação de velocidade: as consultas de HistoryPosition rodam em paralelo
+# (VELOCIDADE_CONCORRENCIA workers) limitadas pelo token bucket do
+# satx_client; as classificações são gravadas à medida que as consultas
+# terminam, em UPDATEs de até VELOCIDADE_GRAVACAO viagens, para que uma
+# consulta lenta não segure as já concluídas do lote.
+VELOCIDADE_CONCORRENCIA = int(os.getenv("POWERBI_VELOCIDADE_CONCORRENCIA", "4"))
+VELOCIDADE_LOTE = int(os.getenv("POWERBI_VELOCIDADE_LOTE", "50"))
+VELOCIDADE_GRAVACAO = int(os.getenv("POWERBI_VELOCIDADE_GRAVACAO", "10"))
+
+def _buscar_posicoes(token, vehicle_code, start_dt, end_dt):
+    # O dia inteiro do veículo vem do cache e é compartilhado entre as viagens.
+    # None é falha da API; [] é janela sem posições (204, corpo vazio ou
+    # nada enviado no trecho da viagem).
+    return posicoes_cache.posicoes_na_janela(
+        token, vehicle_code, satx_datas.local_para_utc(start_dt), satx_datas.local_para_utc(end_dt)
+    )
+
+def _classificar_posicoes(positions):
+    # Perfil completo da viagem; a classificação segue a regra anterior
+    # (qualquer posição acima do primeiro limite = Velocidade Excedida)
+    perfil = analise_velocidade.perfil_velocidade(positions)
+    limite = min(analise_velocidade.VELOCIDADE_LIMITES)
+    violacao = "Velocidade Excedida" if perfil["velocidade_maxima"] > limite else "Desvio de Rota"
+    return {"violation_type": violacao, **analise_velocidade.colunas_informacoes(perfil)}
+
+def _gravar_classificacoes(cursor, classificacoes):
+    # Um único UPDATE por lote, com um CASE por coluna; linhas sem valor para
+    # uma coluna a mantêm como está
+    if not classificacoes:
+        return
+    colunas = []
+    for valores in classificacoes.values():
+        for coluna in valores:
+            if coluna not in colunas:
+                colunas.append(coluna)
+
+    sets = []
+    params = []
+    for coluna in colunas:
+        ids_coluna = [i for i, valores in classificacoes.items() if coluna in valores]
+        casos = " ".join(["WHEN %s THEN %s"] * len(ids_coluna))
+        sets.append(f"{coluna} = CASE id {casos} ELSE {coluna} END")
+        params.extend(v for i in ids_coluna for v in (i, classificacoes[i][coluna]))
+
+    ids = list(classificacoes)
+    placeholders = ",".join(["%s"] * len(ids))
+    cursor.execute(f"UPDATE informacoes SET {', '.join(sets)} WHERE id IN ({placeholders})", params + ids)
+
+def verificar_violações_por_velocidade(token, concorrencia=None):
     def conectar_mysql():
         return mysql.connector.connect(
             host=os.getenv("POWERBI_DB_HOST"),
@@ -195,124 +431,118 @@ def verificar_violações_por_velocidade(token):
             password=os.getenv("POWERBI_DB_PASSWORD")
         )
 
-    parana_tz = pytz.timezone("America/Sao_Paulo")
-
     conn = conectar_mysql()
+    aplicar_migracoes(conn)
     cursor = conn.cursor(dictionary=True)
+    executor = ThreadPoolExecutor(max_workers=concorrencia or VELOCIDADE_CONCORRENCIA)
 
-    batch_size = 10  # Reduzido para evitar timeout
-    offset = 0
+    def gravar(classificacoes):
+        nonlocal conn, cursor
+        if not classificacoes:
+            return 0
+        try:
+            conn.ping(reconnect=True)
+        except Exception:
+            conn = conectar_mysql()
+            cursor = conn.cursor(dictionary=True)
+        _gravar_classificacoes(cursor, classificacoes)
+        conn.commit()
+        gravadas = len(classificacoes)
+        classificacoes.clear()
+        return gravadas
+
+    # Fila de trabalho: só linhas ainda sem classificação em informacoes,
+    # achadas pelo índice (violation_type, id) e paginadas por id (keyset),
+    # com número fixo de consultas por lote.
+    batch_size = VELOCIDADE_LOTE
+    ultimo_id = 0
     lote = 1
     while True:
-        print(f"🔹 Processando lote {lote} (offset {offset})...")
+        print(f"🔹 Processando lote {lote} (id > {ultimo_id})...")
         cursor.execute("""
-            SELECT id AS informacoes_id, RealVehicle, real_departure, real_arrival, RouteName, violation_type, id_grade
-            FROM informacoes_com_cliente_mv
-            WHERE real_departure IS NOT NULL AND real_arrival IS NOT NULL
-            LIMIT %s OFFSET %s
-        """, (batch_size, offset))
+            SELECT mv.id AS informacoes_id, mv.RealVehicle, mv.real_departure, mv.real_arrival, mv.RouteName, mv.Direction, mv.id_grade
+            FROM informacoes i
+            JOIN informacoes_com_cliente_mv mv ON mv.id = i.id
+            WHERE i.violation_type IS NULL
+              AND i.id > %s
+              AND mv.real_departure IS NOT NULL AND mv.real_arrival IS NOT NULL
+            ORDER BY i.id
+            LIMIT %s
+        """, (ultimo_id, batch_size))
         registros = cursor.fetchall()
         if not registros:
             break
-
+        ultimo_id = registros[-1]['informacoes_id']
+
+        # Uma consulta valida todas as grades do lote e já traz os horários tipados
+        ids_grade = list({reg['id_grade'] for reg in registros if reg.get('id_grade') is not None})
+        grades = {}
+        if ids_grade:
+            placeholders = ",".join(["%s"] * len(ids_grade))
+            cursor.execute(f"""
+                SELECT id, real_departure_dt, real_arrival_dt
+                FROM u834686159_powerbi.historico_grades
+                WHERE id IN ({placeholders})
+            """, ids_grade)
+            grades = {g['id']: (g['real_departure_dt'], g['real_arrival_dt']) for g in cursor.fetchall()}
+
+        classificacoes = {}
+        classificadas = 0
+        futuros = {}
         for reg in registros:
-            if reg.get('violation_type'):
-                print(f"⏩ Pulando {reg['RouteName']} ({reg['RealVehicle']}) — violação já registrada: {reg['violation_type']}")
-                continue
-
             try:
                 informacoes_id = reg.get('informacoes_id')
                 id_grade = reg.get('id_grade')
 
-                if id_grade is None:
-                    print(f"⚠️ ID_GRADE ausente na MV para informacoes_id={informacoes_id}; marcando como inconsistente.")
-                    cursor.execute("UPDATE informacoes SET violation_type = %s WHERE id = %s", ("Dados Inconsistentes (grade ausente)", informacoes_id))
-                    conn.commit()
-                    continue
-
-                validate_cursor = conn.cursor()
-                validate_cursor.execute("SELECT COUNT(*) FROM u834686159_powerbi.historico_grades WHERE id = %s", (id_grade,))
-                exists = validate_cursor.fetchone()[0] > 0
-                validate_cursor.close()
-
-                if not exists:
-                    print(f"⚠️ Grade id={id_grade} não encontrada para informacoes_id={informacoes_id}; marcando como inconsistente.")
-                    cursor.execute("UPDATE informacoes SET violation_type = %s WHERE id = %s", ("Dados Inconsistentes (grade ausente)", informacoes_id))
-                    conn.commit()
+                if id_grade is None or id_grade not in grades:
+                    print(f"⚠️ Grade id={id_grade} ausente para informacoes_id={informacoes_id}; marcando como inconsistente.")
+                    classificacoes[informacoes_id] = {"violation_type": "Dados Inconsistentes (grade ausente)"}
                     continue
 
+                grade = grades[id_grade]
                 vehicle_code = reg['RealVehicle']
-                start = reg['real_departure']
-                end = reg['real_arrival']
-                route_name = reg['RouteName']
+                start = grade[0] or reg['real_departure']
+                end = grade[1] or reg['real_arrival']
 
                 if not (vehicle_code and start and end):
                     continue
 
-                start_dt = parser.parse(start, dayfirst=True) if isinstance(start, str) else start
-                end_dt = parser.parse(end, dayfirst=True) if isinstance(end, str) else end
-
-                if getattr(start_dt, 'tzinfo', None) is None:
-                    start_dt = parana_tz.localize(start_dt)
-                else:
-                    start_dt = start_dt.astimezone(parana_tz)
-                if getattr(end_dt, 'tzinfo', None) is None:
-                    end_dt = parana_tz.localize(end_dt)
-                else:
-                    end_dt = end_dt.astimezone(parana_tz)
-
-                start_utc = start_dt.astimezone(pytz.utc)
-                end_utc = end_dt.astimezone(pytz.utc)
+                start_dt = satx_datas.br_para_datetime(start) if isinstance(start, str) else start
+                end_dt = satx_datas.br_para_datetime(end) if isinstance(end, str) else end
 
-                payload = {
-                    "TrackedUnitType": 1,
-                    "TrackedUnitIntegrationCode": vehicle_code,
-                    "StartDatePosition": start_utc.strftime("%Y-%m-%dT%H:%M:%S.000Z"),
-                    "EndDatePosition": end_utc.strftime("%Y-%m-%dT%H:%M:%S.000Z")
-                }
+                futuro = executor.submit(_buscar_posicoes, token, vehicle_code, start_dt, end_dt)
+                futuros[futuro] = reg
 
-                headers = {"Authorization": f"Bearer {token}"}
-
-                response = requests.post(
-                    "https://integration.systemsatx.com.br/Controlws/HistoryPosition/List",
-                    json=payload,
-                    headers=headers
-                )
+            except Exception as e:
+                print(f"💥 Erro inesperado na rota {reg.get('RouteName')} ({reg.get('RealVehicle')}): {e}")
+                continue
 
-                if response.status_code == 204:
-                    continue
-                elif response.status_code == 200 and response.content:
-                    try:
-                        positions = response.json()
-                    except Exception:
-                        continue
-                else:
+        for futuro in as_completed(futuros):
+            reg = futuros[futuro]
+            try:
+                positions = futuro.result()
+                # Falha ou janela vazia: a viagem fica sem classificação e volta na próxima execução
+                if not positions:
                     continue
-
-                violacao = "Desvio de Rota"
-                for pos in positions:
-                    if pos.get("Velocity", 0) > 70:
-                        violacao = "Velocidade Excedida"
-                        break
-
-                try:
-                    conn.ping(reconnect=True)
-                except Exception:
-                    conn = conectar_mysql()
-                    cursor = conn.cursor(dictionary=True)
-
-                cursor.execute("UPDATE informacoes SET violation_type = %s WHERE id = %s", (violacao, informacoes_id))
-                conn.commit()
-
-                time.sleep(1)
-
+                classificacao = _classificar_posicoes(positions)
+                # Sem referência pronta (montada pelo preparar_referencias) o desvio fica de fora
+                indice = desvio_rota.obter_indice(conn, token, reg['RouteName'], reg.get('Direction'),
+                                                  construir=False)
+                if indice is not None:
+                    classificacao.update(desvio_rota.medir_desvio(indice, positions))
+                    classificacao["desvio_medido_em"] = datetime.now()
+                classificacoes[reg['informacoes_id']] = classificacao
             except Exception as e:
                 print(f"💥 Erro inesperado na rota {reg.get('RouteName')} ({reg.get('RealVehicle')}): {e}")
                 continue
+            if len(classificacoes) >= VELOCIDADE_GRAVACAO:
+                classificadas += gravar(classificacoes)
 
-        offset += batch_size
+        classificadas += gravar(classificacoes)
+        print(f"✅ Lote {lote}: {classificadas} de {len(registros)} viagens classificadas.")
         lote += 1
 
+    executor.shutdown(wait=True)
     conn.close()
 
 def iniciar_agendador():
@@ -0,0 +1,231 @@
+import os
+from dotenv import load_dotenv
+load_dotenv()
+
+import codecs
+import json
+import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+
+# Cliente HTTP único para a API SATX: uma Session com pool de conexões
+# (keep-alive), timeout por endpoint e novas tentativas com backoff
+# exponencial e jitter em 429/5xx e falhas de conexão.
+BASE_URL = "https://integration.systemsatx.com.br"
+
+LOGIN = "/Login"
+GRID_LIST = "/GlobalBus/Grid/List"
+TRIPS_NON_CONFORMITY = "/GlobalBus/Trip/TripsWithNonConformity"
+HISTORY_POSITION = "/Controlws/HistoryPosition/List"
+
+GRID_PARAMS = {"paramClientIntegrationCode": "1003"}
+
+# (timeout de conexão, timeout de leitura) em segundos
+TIMEOUTS = {
+    LOGIN: (5, 30),
+    GRID_LIST: (10, 120),
+    TRIPS_NON_CONFORMITY: (10, 60),
+    HISTORY_POSITION: (10, 60),
+}
+TIMEOUT_PADRAO = (10, 60)
+
+STATUS_RETENTAVEIS = {429, 500, 502, 503, 504}
+MAX_TENTATIVAS = int(os.getenv("SATX_MAX_TENTATIVAS", "4"))
+BACKOFF_BASE = float(os.getenv("SATX_BACKOFF_BASE_SEGUNDOS", "1"))
+BACKOFF_MAX = float(os.getenv("SATX_BACKOFF_MAX_SEGUNDOS", "30"))
+POOL_TAMANHO = int(os.getenv("SATX_POOL_TAMANHO", "10"))
+STREAM_CHUNK = int(os.getenv("SATX_STREAM_CHUNK_BYTES", "65536"))
+
+class LimitadorTaxa:
+    """
+    Token bucket compartilhado entre threads. A taxa cai pela metade a cada
+    429 (respeitando Retry-After) e volta a subir aos poucos com respostas
+    bem-sucedidas, até a taxa configurada.
+    """
+    def __init__(self, taxa, capacidade=None, taxa_minima=0.2):
+        self.taxa_maxima = taxa
+        self.taxa = taxa
+        self.taxa_minima = taxa_minima
+        self.capacidade = capacidade or max(1.0, taxa)
+        self.fichas = self.capacidade
+        self.ultimo = time.monotonic()
+        self.pausa_ate = 0.0
+        self.lock = threading.Lock()
+
+    def _repor(self, agora):
+        self.fichas = min(self.capacidade, self.fichas + (agora - self.ultimo) * self.taxa)
+        self.ultimo = agora
+
+    def aguardar(self):
+        while True:
+            with self.lock:
+                agora = time.monotonic()
+                self._repor(agora)
+                if agora >= self.pausa_ate and self.fichas >= 1:
+                    self.fichas -= 1
+                    return
+                espera = max(self.pausa_ate - agora, (1 - self.fichas) / self.taxa)
+            time.sleep(espera)
+
+    def limitado(self, retry_after=None):
+        with self.lock:
+            self.taxa = max(self.taxa_minima, self.taxa / 2)
+            self.fichas = 0
+            if retry_after:
+                try:
+                    self.pausa_ate = max(self.pausa_ate, time.monotonic() + float(retry_after))
+                except ValueError:
+                    pass
+        print(f"SATX limitou a taxa; reduzindo para {self.taxa:.2f} req/s")
+
+    def sucesso(self):
+        with self.lock:
+            if self.taxa < self.taxa_maxima:
+                self.taxa = min(self.taxa_maxima, self.taxa + 0.05 * self.taxa_maxima)
+
+# Limites por endpoint (req/s). Só endpoints chamados em volume têm limitador.
+LIMITADORES = {
+    HISTORY_POSITION: LimitadorTaxa(float(os.getenv("SATX_HISTORY_POSITION_RPS", "5"))),
+}
+
+_sessao = None
+_sessao_lock = threading.Lock()
+
+def obter_sessao():
+    global _sessao
+    if _sessao is None:
+        with _sessao_lock:
+            if _sessao is None:
+                sessao = requests.Session()
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=POOL_TAMANHO, max_retries=0)
+                sessao.mount("https://", adapter)
+                sessao.mount("http://", adapter)
+                _sessao = sessao
+    return _sessao
+
+def _tempo_espera(tentativa, retry_after=None):
+    if retry_after:
+        try:
+            return min(BACKOFF_MAX, float(retry_after))
+        except ValueError:
+            pass
+    # "full jitter": espera aleatória entre 0 e o teto exponencial
+    teto = min(BACKOFF_MAX, BACKOFF_BASE * (2 ** tentativa))
+    return random.uniform(0, teto)
+
+def post(caminho, token=None, json=None, params=None, timeout=None, stream=False):
+    """
+    Faz POST em BASE_URL + caminho reaproveitando as conexões do pool.
+    Repete em 429/5xx e erros de conexão; em 401 renova o token uma vez.
+    Endpoints em LIMITADORES passam pelo token bucket antes de cada tentativa.
+    Retorna a última resposta obtida (o chamador continua tratando status_code).
+    """
+    url = BASE_URL + caminho
+    timeout = timeout or TIMEOUTS.get(caminho, TIMEOUT_PADRAO)
+    sessao = obter_sessao()
+    limitador = LIMITADORES.get(caminho)
+    token_renovado = False
+
+    for tentativa in range(MAX_TENTATIVAS):
+        if limitador:
+            limitador.aguardar()
+        headers = {"Content-Type": "application/json"}
+        if token:
+            headers["Authorization"] = f"Bearer {token}"
+        try:
+            resp = sessao.post(url, json=json, params=params, headers=headers, timeout=timeout, stream=stream)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            if tentativa == MAX_TENTATIVAS - 1:
+                raise
+            espera = _tempo_espera(tentativa)
+            print(f"Falha de conexão em {caminho} (tentativa {tentativa+1}): {e}; nova tentativa em {espera:.1f}s")
+            time.sleep(espera)
+            continue
+
+        if resp.status_code == 401 and token and not token_renovado:
+            from authtoken import invalidar_token, obter_token
+            resp.close()
+            invalidar_token(token)
+            novo_token = obter_token()
+            token_renovado = True
+            if novo_token:
+                token = novo_token
+                continue
+            return resp
+
+        if limitador:
+            if resp.status_code == 429:
+                limitador.limitado(resp.headers.get("Retry-After"))
+            elif resp.status_code < 400:
+                limitador.sucesso()
+
+        if resp.status_code in STATUS_RETENTAVEIS and tentativa < MAX_TENTATIVAS - 1:
+            espera = _tempo_espera(tentativa, resp.headers.get("Retry-After"))
+            print(f"SATX {caminho} retornou {resp.status_code} (tentativa {tentativa+1}); nova tentativa em {espera:.1f}s")
+            resp.close()
+            time.sleep(espera)
+            continue
+
+        return resp
+    return resp
+
+DELIMITADORES_JSON = ",] \t\r\n"
+
+def _pular_espacos(texto, pos):
+    while pos < len(texto) and texto[pos] in " \t\r\n":
+        pos += 1
+    return pos
+
+def iterar_array_json(resp, tamanho_chunk=STREAM_CHUNK):
+    """
+    Decodifica incrementalmente um array JSON de uma resposta obtida com
+    stream=True, entregando um item por vez sem montar a lista inteira.
+    Corpo vazio ou null não entrega nada (mesmo tratamento do caminho sem
+    streaming); qualquer outro corpo que não seja array gera ValueError.
+    """
+    decoder = json.JSONDecoder()
+    texto = codecs.getincrementaldecoder(resp.encoding or "utf-8")(errors="replace")
+    buffer = ""
+    pos = 0
+    dentro_do_array = False
+
+    for chunk in resp.iter_content(chunk_size=tamanho_chunk):
+        buffer += texto.decode(chunk)
+        while True:
+            pos = _pular_espacos(buffer, pos)
+            if pos >= len(buffer):
+                break
+            if not dentro_do_array:
+                if buffer[pos] != "[":
+                    # Não é array: só null é aceito, como dia sem grade
+                    restante = b"".join(resp.iter_content(chunk_size=tamanho_chunk))
+                    buffer += texto.decode(restante, final=True)
+                    if json.loads(buffer[pos:]) is not None:
+                        raise ValueError("Resposta da SATX não é um array JSON")
+                    return
+                dentro_do_array = True
+                pos += 1
+                continue
+            if buffer[pos] == ",":
+                pos += 1
+                continue
+            if buffer[pos] == "]":
+                return
+            try:
+                item, fim = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                break  # item incompleto: aguarda o próximo chunk
+            if not isinstance(item, (dict, list, str)) and (fim >= len(buffer) or buffer[fim] not in DELIMITADORES_JSON):
+                break  # número/literal pode continuar no próximo chunk ("2." + "5")
+            yield item
+            pos = fim
+        buffer = buffer[pos:]
+        pos = 0
+
+    buffer += texto.decode(b"", final=True)
+    pos = _pular_espacos(buffer, 0)
+    if not dentro_do_array and pos >= len(buffer):
+        return  # corpo vazio
+    raise ValueError("JSON truncado ou inválido na resposta da SATX")
@@ -0,0 +1,95 @@
+import os
+from datetime import datetime, timedelta
+from functools import lru_cache
+import pytz
+
+# Conversões dos formatos fixos de data da SATX. As strings são interpretadas
+# por fatiamento (sem strptime/dateutil) e os resultados ficam num cache LRU
+# limitado, já que o mesmo horário se repete muitas vezes num payload.
+CACHE_TAMANHO = int(os.getenv("POWERBI_DATAS_CACHE", "65536"))
+FUSO_LOCAL = pytz.timezone("America/Sao_Paulo")
+
+def _campos_iso(s):
+    # 'YYYY-MM-DDTHH:MM:SS' seguido opcionalmente de fração e fuso (ignorados,
+    # como já fazia o código anterior ao subtrair o deslocamento fixo)
+    if len(s) < 19 or s[4] != '-' or s[7] != '-' or s[10] not in 'T ' or s[13] != ':' or s[16] != ':':
+        raise ValueError(s)
+    return datetime(int(s[0:4]), int(s[5:7]), int(s[8:10]), int(s[11:13]), int(s[14:16]), int(s[17:19]))
+
+@lru_cache(maxsize=CACHE_TAMANHO)
+def satx_para_br(date_str):
+    """
+    '2024-05-10T11:20:00Z' -> '10/05/2024 11:20:00' (formato gravado em historico_grades).
+    Valores fora do formato são devolvidos sem alteração.
+    """
+    if not date_str:
+        return None
+    if len(date_str) != 20 or date_str[19] != 'Z':
+        return date_str
+    try:
+        _campos_iso(date_str)
+    except ValueError:
+        return date_str
+    return f"{date_str[8:10]}/{date_str[5:7]}/{date_str[0:4]} {date_str[11:19]}"
+
+@lru_cache(maxsize=CACHE_TAMANHO)
+def satx_para_datetime(date_str):
+    """
+    '2024-05-10T11:20:00Z' -> datetime ingênuo para as colunas DATETIME.
+    Datas vazias, inválidas ou "zeradas" (ano 0001) viram None.
+    """
+    if not date_str or len(date_str) != 20 or date_str[19] != 'Z':
+        return None
+    try:
+        dt = _campos_iso(date_str)
+    except ValueError:
+        return None
+    return dt if dt.year >= 1000 else None
+
+@lru_cache(maxsize=CACHE_TAMANHO)
+def iso_para_local(dt_str, shift_hours=3):
+    """
+    Converte o EventDate ISO para horário local numa única leitura.
+    Retorna ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d') ou None se não for possível.
+    """
+    if not dt_str:
+        return None
+    try:
+        dt = _campos_iso(dt_str) - timedelta(hours=shift_hours)
+    except (ValueError, OverflowError):
+        return None
+    return dt.strftime('%Y-%m-%d %H:%M:%S'), dt.strftime('%Y-%m-%d')
+
+@lru_cache(maxsize=CACHE_TAMANHO)
+def iso_para_datetime(dt_str):
+    """
+    EventDate ISO (UTC, com ou sem fração) -> datetime ingênuo em UTC.
+    Retorna None se não for possível.
+    """
+    if not dt_str:
+        return None
+    try:
+        return _campos_iso(dt_str)
+    except ValueError:
+        return None
+
+@lru_cache(maxsize=CACHE_TAMANHO)
+def br_para_datetime(date_str):
+    """
+    'dd/mm/YYYY HH:MM:SS' -> datetime ingênuo. Outros formatos recorrem ao
+    dateutil (dayfirst), como o código anterior.
+    """
+    s = date_str.strip()
+    if len(s) == 19 and s[2] == '/' and s[5] == '/' and s[10] == ' ' and s[13] == ':' and s[16] == ':':
+        try:
+            return datetime(int(s[6:10]), int(s[3:5]), int(s[0:2]), int(s[11:13]), int(s[14:16]), int(s[17:19]))
+        except ValueError:
+            pass
+    from dateutil import parser
+    return parser.parse(s, dayfirst=True)
+
+def local_para_utc(dt):
+    """Horário local (ingênuo = America/Sao_Paulo) -> datetime ingênuo em UTC."""
+    if dt.tzinfo is None:
+        dt = FUSO_LOCAL.localize(dt)
+    return dt.astimezone(pytz.utc).replace(tzinfo=None)
@@ -21,58 +21,19 @@ def preencher_tabela_aluno(data_execucao):
     alunos = sorted(set(veiculo_df['Matricula'].unique() if not veiculo_df.empty else []).union(
                     set(escola_df['Matricula'].unique() if not escola_df.empty else [])))
 
+    # Particiona os logs do dia uma vez para todos os alunos
+    trechos = _trechos_veiculo(veiculo_df) if not veiculo_df.empty else {}
+    placas = _moda_por_aluno(veiculo_df, 'Placa') if not veiculo_df.empty else {}
+    periodos_escola = _periodo_escola(escola_df) if not escola_df.empty else {}
+    escolas = _moda_por_aluno(escola_df, 'Nome') if not escola_df.empty else {}
+
+    linhas_aluno = []
     for matricula in alunos:
-        veic_logs = veiculo_df[veiculo_df['Matricula'] == matricula].sort_values('EventDate') if not veiculo_df.empty else pd.DataFrame()
-        escola_logs = escola_df[escola_df['Matricula'] == matricula].sort_values('EventDate') if not escola_df.empty else pd.DataFrame()
-        # Processar mesmo se não houver logs de veículo, desde que haja logs da escola
-        if veic_logs.empty and escola_logs.empty:
-            continue
-        escola_nome = (escola_logs['Nome'].mode()[0] if not escola_logs.empty else "COL.ESTAD.DJALMA MARINHO")
-        veiculo_placa = veic_logs['Placa'].mode()[0] if not veic_logs.empty else None
-
-        # Somente preparar datetime/agrupamentos se houver logs de veículo
-        agrupamentos = []
-        if not veic_logs.empty:
-            veic_logs['EventDate_dt'] = pd.to_datetime(veic_logs['EventDate'])
-            veic_logs = veic_logs.sort_values('EventDate_dt').reset_index(drop=True)
-            agrupamentos = _split_by_gap(veic_logs, 'EventDate_dt', GAP_SECONDS)
-
-        entrada_ida_veic = saida_ida_veic = entrada_volta_veic = saida_volta_veic = None
-        if len(agrupamentos) >= 1:
-            ida_agrup = agrupamentos[0]
-            entrada_ida_veic = None
-            saida_ida_veic = None
-            if len(ida_agrup) == 1:
-                entrada_ida_veic = ida_agrup['EventDate'].iloc[0]
-            else:
-                entrada = ida_agrup['EventDate'].min()
-                saida = ida_agrup['EventDate'].max()
-                if entrada != saida:
-                    entrada_ida_veic = entrada
-                    saida_ida_veic = saida
-                else:
-                    entrada_ida_veic = entrada
-        if len(agrupamentos) >= 2:
-            volta_agrup = agrupamentos[1]
-            entrada_volta_veic = None
-            saida_volta_veic = None
-            if len(volta_agrup) == 1:
-                entrada_volta_veic = volta_agrup['EventDate'].iloc[0]
-            else:
-                entrada = volta_agrup['EventDate'].min()
-                saida = volta_agrup['EventDate'].max()
-                if entrada != saida:
-                    entrada_volta_veic = entrada
-                    saida_volta_veic = saida
-                else:
-                    entrada_volta_veic = entrada
-        entrada_escola = escola_logs['EventDate'].min() if not escola_logs.empty else None
-        saida_escola = escola_logs['EventDate'].max() if not escola_logs.empty else None
-        if len(escola_logs) == 1:
-            saida_escola = None
-        elif entrada_escola == saida_escola:
-            entrada_escola = None
-            saida_escola = None
+        escola_nome = escolas.get(matricula, "COL.ESTAD.DJALMA MARINHO")
+        veiculo_placa = placas.get(matricula)
+        entrada_ida_veic, saida_ida_veic, entrada_volta_veic, saida_volta_veic = trechos.get(
+            matricula, (None, None, None, None))
+        entrada_escola, saida_escola = periodos_escola.get(matricula, (None, None))
         if entrada_escola and not saida_escola and entrada_volta_veic:
             try:
                 from datetime import datetime, timedelta
@@ -149,8 +110,19 @@ def preencher_tabela_aluno(data_execucao):
             saida_volta_veic
         )
 
-        cursor = conn.cursor()
-        cursor.execute("""
+        linhas_aluno.append((
+            matricula,
+            escola_nome,
+            veiculo_placa,
+            entrada_ida_veic,
+            saida_ida_veic,
+            entrada_escola,
+            saida_escola,
+            entrada_volta_veic,
+            saida_volta_veic,
+            data_str
+        ))
+    _gravar_em_lotes(conn, """
             INSERT INTO Aluno (
                 Matricula, Escola, Veiculo,
                 Entrada_Ida_Veiculo, Saida_Ida_Veiculo,
@@ -165,20 +137,7 @@ def preencher_tabela_aluno(data_execucao):
                 Saida_Escola = VALUES(Saida_Escola),
                 Entrada_Volta_Veiculo = VALUES(Entrada_Volta_Veiculo),
                 Saida_Volta_Veiculo = VALUES(Saida_Volta_Veiculo)
-        """, (
-            matricula,
-            escola_nome,
-            veiculo_placa,
-            entrada_ida_veic,
-            saida_ida_veic,
-            entrada_escola,
-            saida_escola,
-            entrada_volta_veic,
-            saida_volta_veic,
-            data_execucao.strftime('%Y-%m-%d')
-        ))
-        cursor.close()
-    conn.commit()
+        """, linhas_aluno, "Aluno")
     conn.close()
 def criar_tabela_aluno():
     conn = get_db_connection()
@@ -210,13 +169,14 @@ def criar_tabela_aluno():
 import mysql.connector
 from mysql.connector import pooling
 import os
+import time
 from dotenv import load_dotenv
 
-import requests
+import satx_datas
+import posicoes_cache
 
 from typing import List, Optional
 
-API_URL = "https://integration.systemsatx.com.br/Controlws/HistoryPosition/List"
 GAP_SECONDS = 600  # 10 minutos
 
 def _ajustar_timestamp_iso_para_local(dt_str: Optional[str], shift_hours: int = 3) -> Optional[str]:
@@ -226,25 +186,18 @@ def _ajustar_timestamp_iso_para_local(dt_str: Optional[str], shift_hours: int =
     """
     if not dt_str:
         return dt_str
-    try:
-        import dateutil.parser
-        from datetime import timedelta
-        dt = dateutil.parser.isoparse(dt_str) - timedelta(hours=shift_hours)
-        return dt.strftime('%Y-%m-%d %H:%M:%S')
-    except Exception:
-        return dt_str
+    convertido = satx_datas.iso_para_local(dt_str, shift_hours)
+    return convertido[0] if convertido else dt_str
 
-def _derivar_data_execucao_do_evento(event_date_str: Optional[str], fallback_date) -> str:
+def _evento_local(event_date_str: Optional[str], fallback_date):
     """
-    Deriva 'YYYY-MM-DD' a partir do EventDate (ajustado UTC-3). Se falhar, usa a data do parâmetro fallback_date.
+    Lê o EventDate uma única vez e retorna (horário local, 'YYYY-MM-DD').
+    Se falhar, mantém o valor original e usa a data de fallback_date.
     """
-    try:
-        import dateutil.parser
-        from datetime import timedelta
-        dt = dateutil.parser.isoparse(event_date_str) - timedelta(hours=3)
-        return dt.strftime('%Y-%m-%d')
-    except Exception:
-        return fallback_date.strftime('%Y-%m-%d')
+    convertido = satx_datas.iso_para_local(event_date_str, 3) if event_date_str else None
+    if convertido:
+        return convertido
+    return event_date_str, fallback_date.strftime('%Y-%m-%d')
 
 def _split_by_gap(df, time_col: str, gap_seconds: int = GAP_SECONDS) -> List:
     """
@@ -260,6 +213,55 @@ def _split_by_gap(df, time_col: str, gap_seconds: int = GAP_SECONDS) -> List:
     ends = starts[1:] + [len(temp)]
     return [temp.iloc[s:e].drop(columns='__gap__') for s, e in zip(starts, ends) if not temp.iloc[s:e].empty]
 
+def _moda_por_aluno(df, coluna):
+    """
+    Valor mais frequente de `coluna` por Matricula, com o mesmo desempate de
+    Series.mode()[0] (o menor valor). Retorna {matricula: valor}.
+    """
+    contagem = df.groupby(['Matricula', coluna]).size().reset_index(name='__n__')
+    contagem = contagem.sort_values(['Matricula', '__n__', coluna], ascending=[True, False, True])
+    return dict(contagem.drop_duplicates('Matricula')[['Matricula', coluna]].itertuples(index=False, name=None))
+
+def _trechos_veiculo(veiculo_df, gap_seconds: int = GAP_SECONDS):
+    """
+    Ida (primeiro trecho) e volta (segundo trecho) de cada aluno nos logs de
+    veículo. Os logs são ordenados uma vez por (Matricula, EventDate) e um
+    novo trecho começa quando o intervalo até o log anterior do mesmo aluno
+    excede gap_seconds. Um trecho com um único horário só tem entrada.
+    Retorna {matricula: (entrada_ida, saida_ida, entrada_volta, saida_volta)}.
+    """
+    import pandas as pd
+    logs = pd.DataFrame({
+        'Matricula': veiculo_df['Matricula'],
+        'EventDate': pd.to_datetime(veiculo_df['EventDate']),
+    }).sort_values(['Matricula', 'EventDate'], kind='stable')
+    gap = logs.groupby('Matricula', sort=False)['EventDate'].diff().dt.total_seconds()
+    logs['__trecho__'] = (gap > gap_seconds).groupby(logs['Matricula'], sort=False).cumsum()
+    limites = logs[logs['__trecho__'] < 2].groupby(['Matricula', '__trecho__'])['EventDate'].agg(['min', 'max'])
+
+    trechos = {}
+    for (matricula, trecho), entrada, saida in limites.itertuples(name=None):
+        horarios = trechos.setdefault(matricula, [None, None, None, None])
+        horarios[2 * trecho] = entrada
+        horarios[2 * trecho + 1] = saida if saida != entrada else None
+    return {matricula: tuple(horarios) for matricula, horarios in trechos.items()}
+
+def _periodo_escola(escola_df):
+    """
+    (entrada, saida) de cada aluno nos logs da escola: primeiro e último
+    horário; com um único log só há entrada e, se os horários coincidem,
+    nenhum dos dois. Retorna {matricula: (entrada, saida)}.
+    """
+    agregado = escola_df.groupby('Matricula')['EventDate'].agg(['min', 'max', 'size'])
+    periodos = {}
+    for matricula, entrada, saida, quantidade in agregado.itertuples(name=None):
+        if quantidade == 1:
+            saida = None
+        elif entrada == saida:
+            entrada = saida = None
+        periodos[matricula] = (entrada, saida)
+    return periodos
+
 load_dotenv()
 
 DB_HOST = os.getenv('POWERBI_DB_HOST')
@@ -267,6 +269,9 @@ DB_USER = os.getenv('POWERBI_DB_USER')
 DB_PASSWORD = os.getenv('POWERBI_DB_PASSWORD')
 DB_NAME = os.getenv('POWERBI_DB_NAME')
 
+# Linhas por executemany/commit nas gravações de Aluno, Escola e Veiculo
+TAGS_LOTE = int(os.getenv('POWERBI_TAGS_LOTE', '500'))
+
 # HORÁRIOS PADRAO POR MATRÍCULA
 HORARIOS_PADRAO = {
     "5809670":   {"ida_entrada":"06:32","ida_saida":"06:33","escola_entrada":"12:10","escola_saida":"12:14","volta_entrada":"12:15","volta_saida":"12:17"},
@@ -582,6 +587,22 @@ connection_pool = pooling.MySQLConnectionPool(pool_name="mypool_tags", pool_size
 def get_db_connection():
     return connection_pool.get_connection()
 
+def _gravar_em_lotes(conn, sql, linhas, tabela):
+    """
+    Grava as linhas com executemany (INSERT de várias linhas) em lotes de
+    TAGS_LOTE, com um commit e um log de tempo por lote.
+    """
+    cursor = conn.cursor()
+    try:
+        for inicio in range(0, len(linhas), TAGS_LOTE):
+            lote = linhas[inicio:inicio + TAGS_LOTE]
+            t0 = time.time()
+            cursor.executemany(sql, lote)
+            conn.commit()
+            print(f"{tabela}: lote de {len(lote)} linhas gravado em {time.time() - t0:.2f}s")
+    finally:
+        cursor.close()
+
 def criar_tabela_escola():
     conn = get_db_connection()
     cursor = conn.cursor()
@@ -631,88 +652,44 @@ def criar_tabela_veiculo():
 
 
 def consultar_api_escola(data_consulta, token=None):
-    url = API_URL
-    from datetime import datetime
-    data_inicio = data_consulta.strftime('%Y-%m-%dT00:00:00.000Z')
-    data_fim = data_consulta.strftime('%Y-%m-%dT23:59:59.595Z')
-    payload = {
-        "TrackedUnitType": 1,
-        "TrackedUnitIntegrationCode": "COL.ESTAD.DJALMA MARINHO",
-        "StartDatePosition": data_inicio,
-        "EndDatePosition": data_fim
-    }
     if token is None:
         from authtoken import obter_token
         token = obter_token()
     if not token:
         print("Não foi possível obter o token de autenticação.")
         return None
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {token}"
-    }
-    response = requests.post(url, json=payload, headers=headers)
-    if response.status_code == 200:
-        import dateutil.parser
-        from datetime import timedelta
-        dados = response.json()
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        if isinstance(dados, list):
-            for item in dados:
-                matricula = item.get('Driver')
-                idevent = item.get('IdEvent')
-                if (matricula is not None and str(matricula).strip() != "" and idevent == 65):
-                    nome = item.get('TrackedUnit')
-                    event_date_raw = item.get('EventDate')
-                    update_date_raw = item.get('UpdateDate')
-
-                    data_execucao_sql = _derivar_data_execucao_do_evento(event_date_raw, data_consulta)
-                    if data_execucao_sql != data_consulta.strftime('%Y-%m-%d'):
-                        continue
-                    event_date = _ajustar_timestamp_iso_para_local(event_date_raw, 3)
-                    update_date = _ajustar_timestamp_iso_para_local(update_date_raw, 3)
-
-                    cursor.execute("""
-                        INSERT INTO Escola (Nome, EventDate, UpdateDate, Matricula, Data_Execucao)
-                        VALUES (%s, %s, %s, %s, %s)
-                        ON DUPLICATE KEY UPDATE
-                            Nome = VALUES(Nome),
-                            UpdateDate = VALUES(UpdateDate)
-                    """, (nome, event_date, update_date, matricula, data_execucao_sql))
-        else:
-            item = dados
-            matricula = item.get('Driver')
-            idevent = item.get('IdEvent')
-            if (matricula is not None and str(matricula).strip() != "" and idevent == 65):
-                nome = item.get('TrackedUnit')
-                event_date_raw = item.get('EventDate')
-                update_date_raw = item.get('UpdateDate')
-
-                data_execucao_sql = _derivar_data_execucao_do_evento(event_date_raw, data_consulta)
-                if data_execucao_sql != data_consulta.strftime('%Y-%m-%d'):
-                    return dados
-                event_date = _ajustar_timestamp_iso_para_local(event_date_raw, 3)
-                update_date = _ajustar_timestamp_iso_para_local(update_date_raw, 3)
-
-                cursor.execute("""
-                    INSERT INTO Escola (Nome, EventDate, UpdateDate, Matricula, Data_Execucao)
-                    VALUES (%s, %s, %s, %s, %s)
-                    ON DUPLICATE KEY UPDATE
-                        Nome = VALUES(Nome),
-                        UpdateDate = VALUES(UpdateDate)
-                """, (nome, event_date, update_date, matricula, data_execucao_sql))
-        conn.commit()
-        cursor.close()
-        conn.close()
-        return dados
-    else:
-        print("Erro na consulta:", response.status_code, response.text)
+    dados = posicoes_cache.posicoes_do_dia(token, "COL.ESTAD.DJALMA MARINHO", data_consulta.date())
+    if dados is None:
+        print("Erro na consulta de posições da escola.")
         return None
+    linhas = []
+    for item in dados:
+        matricula = item.get('Driver')
+        idevent = item.get('IdEvent')
+        if (matricula is not None and str(matricula).strip() != "" and idevent == 65):
+            nome = item.get('TrackedUnit')
+            event_date_raw = item.get('EventDate')
+            update_date_raw = item.get('UpdateDate')
+
+            event_date, data_execucao_sql = _evento_local(event_date_raw, data_consulta)
+            if data_execucao_sql != data_consulta.strftime('%Y-%m-%d'):
+                continue
+            update_date = _ajustar_timestamp_iso_para_local(update_date_raw, 3)
+
+            linhas.append((nome, event_date, update_date, matricula, data_execucao_sql))
+    conn = get_db_connection()
+    _gravar_em_lotes(conn, """
+        INSERT INTO Escola (Nome, EventDate, UpdateDate, Matricula, Data_Execucao)
+        VALUES (%s, %s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE
+            Nome = VALUES(Nome),
+            UpdateDate = VALUES(UpdateDate)
+    """, linhas, "Escola")
+    conn.close()
+    return dados
 
 def consultar_api_veiculo(data_consulta, token=None):
     import pandas as pd
-    url = API_URL
     placas = ["AXM9A53", "CUE2D20", "IUZ4F94"]
     if token is None:
         from authtoken import obter_token
@@ -720,71 +697,32 @@ def consultar_api_veiculo(data_consulta, token=None):
     if not token:
         print("Não foi possível obter o token de autenticação.")
         return None
-    from datetime import datetime
-    data_inicio = data_consulta.strftime('%Y-%m-%dT00:00:00.000Z')
-    data_fim = data_consulta.strftime('%Y-%m-%dT23:59:59.595Z')
     todos_logs = []
-    from datetime import datetime, timedelta, timezone
-    import dateutil.parser
     for placa in placas:
-        payload = {
-            "TrackedUnitType": 1,
-            "TrackedUnitIntegrationCode": placa,
-            "StartDatePosition": data_inicio,
-            "EndDatePosition": data_fim
-        }
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {token}"
-        }
-        response = requests.post(url, json=payload, headers=headers)
-        if response.status_code == 200:
-            dados = response.json()
-            if isinstance(dados, list):
-                for item in dados:
-                    matricula = item.get('Driver')
-                    idevent = item.get('IdEvent')
-                    if (item.get('Ignition') == True and matricula is not None and str(matricula).strip() != "" and idevent == 65):
-                        eventdate_raw = item.get('EventDate')
-                        updatedate_raw = item.get('UpdateDate')
-                        data_execucao_sql = _derivar_data_execucao_do_evento(eventdate_raw, data_consulta)
-                        if data_execucao_sql != data_consulta.strftime('%Y-%m-%d'):
-                            continue
-                        eventdate = _ajustar_timestamp_iso_para_local(eventdate_raw, 3)
-                        updatedate = _ajustar_timestamp_iso_para_local(updatedate_raw, 3)
-
-                        todos_logs.append({
-                            'Placa': item.get('TrackedUnitIntegrationCode'),
-                            'EventDate': eventdate,
-                            'UpdateDate': updatedate,
-                            'Ignition': item.get('Ignition'),
-                            'Matricula': matricula,
-                            'Latitude': item.get('Latitude'),
-                            'Longitude': item.get('Longitude'),
-                            'Data_Execucao': data_execucao_sql
-                        })
-            else:
-                matricula = dados.get('Driver')
-                idevent = dados.get('IdEvent')
-                if dados.get('Ignition') == True and matricula is not None and str(matricula).strip() != "" and idevent == 65:
-                    eventdate_raw = dados.get('EventDate')
-                    updatedate_raw = dados.get('UpdateDate')
-                    data_execucao_sql = _derivar_data_execucao_do_evento(eventdate_raw, data_consulta)
-                    if data_execucao_sql != data_consulta.strftime('%Y-%m-%d'):
-                        continue
-                    eventdate = _ajustar_timestamp_iso_para_local(eventdate_raw, 3)
-                    updatedate = _ajustar_timestamp_iso_para_local(updatedate_raw, 3)
-
-                    todos_logs.append({
-                        'Placa': dados.get('TrackedUnitIntegrationCode'),
-                        'EventDate': eventdate,
-                        'UpdateDate': updatedate,
-                        'Ignition': dados.get('Ignition'),
-                        'Matricula': matricula,
-                        'Latitude': dados.get('Latitude'),
-                        'Longitude': dados.get('Longitude'),
-                        'Data_Execucao': data_execucao_sql
-                    })
+        dados = posicoes_cache.posicoes_do_dia(token, placa, data_consulta.date())
+        if not dados:
+            continue
+        for item in dados:
+            matricula = item.get('Driver')
+            idevent = item.get('IdEvent')
+            if (item.get('Ignition') == True and matricula is not None and str(matricula).strip() != "" and idevent == 65):
+                eventdate_raw = item.get('EventDate')
+                updatedate_raw = item.get('UpdateDate')
+                eventdate, data_execucao_sql = _evento_local(eventdate_raw, data_consulta)
+                if data_execucao_sql != data_consulta.strftime('%Y-%m-%d'):
+                    continue
+                updatedate = _ajustar_timestamp_iso_para_local(updatedate_raw, 3)
+
+                todos_logs.append({
+                    'Placa': item.get('TrackedUnitIntegrationCode'),
+                    'EventDate': eventdate,
+                    'UpdateDate': updatedate,
+                    'Ignition': item.get('Ignition'),
+                    'Matricula': matricula,
+                    'Latitude': item.get('Latitude'),
+                    'Longitude': item.get('Longitude'),
+                    'Data_Execucao': data_execucao_sql
+                })
     if not todos_logs:
         return
     df = pd.DataFrame(todos_logs)
@@ -800,29 +738,26 @@ def consultar_api_veiculo(data_consulta, token=None):
             else:
                 eventos_filtrados.append(sub.iloc[0].to_dict())   # entrada
                 eventos_filtrados.append(sub.iloc[-1].to_dict())  # saída
+    linhas = [(
+        item['Placa'],
+        item['EventDate'],
+        item['UpdateDate'],
+        item['Ignition'],
+        item['Matricula'],
+        item['Latitude'],
+        item['Longitude'],
+        item['Data_Execucao']
+    ) for item in eventos_filtrados]
     conn = get_db_connection()
-    cursor = conn.cursor()
-    for item in eventos_filtrados:
-        cursor.execute("""
-            INSERT INTO Veiculo (Placa, EventDate, UpdateDate, Ignition, Matricula, Latitude, Longitude, Data_Execucao)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-            ON DUPLICATE KEY UPDATE
-                UpdateDate = VALUES(UpdateDate),
-                Ignition = VALUES(Ignition),
-                Latitude = VALUES(Latitude),
-                Longitude = VALUES(Longitude)
-        """, (
-            item['Placa'],
-            item['EventDate'],
-            item['UpdateDate'],
-            item['Ignition'],
-            item['Matricula'],
-            item['Latitude'],
-            item['Longitude'],
-            item['Data_Execucao']
-        ))
-    conn.commit()
-    cursor.close()
+    _gravar_em_lotes(conn, """
+        INSERT INTO Veiculo (Placa, EventDate, UpdateDate, Ignition, Matricula, Latitude, Longitude, Data_Execucao)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE
+            UpdateDate = VALUES(UpdateDate),
+            Ignition = VALUES(Ignition),
+            Latitude = VALUES(Latitude),
+            Longitude = VALUES(Longitude)
+    """, linhas, "Veiculo")
     conn.close()
 
 def garantir_ordem_cronologica_global(entrada_ida, saida_ida, entrada_escola, saida_escola, entrada_volta, saida_volta):
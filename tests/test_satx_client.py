@@ -0,0 +1,46 @@
+import json
+
+import pytest
+
+import satx_client
+
+
+class RespostaFalsa:
+    def __init__(self, chunks, encoding="utf-8"):
+        self.chunks = [c.encode("utf-8") for c in chunks]
+        self.encoding = encoding
+
+    def iter_content(self, chunk_size=None):
+        while self.chunks:
+            yield self.chunks.pop(0)
+
+
+def _itens(*chunks):
+    return list(satx_client.iterar_array_json(RespostaFalsa(list(chunks))))
+
+
+def test_array_dividido_em_chunks():
+    corpo = json.dumps([{"RouteIntegrationCode": "A"}, {"RouteIntegrationCode": "B", "x": [1, 2]}])
+    chunks = [corpo[i:i + 3] for i in range(0, len(corpo), 3)]
+    assert _itens(*chunks) == [{"RouteIntegrationCode": "A"}, {"RouteIntegrationCode": "B", "x": [1, 2]}]
+
+
+def test_numero_dividido_entre_chunks():
+    assert _itens("[2.", "5, 1", "0]") == [2.5, 10]
+    assert _itens("[1e", "3, tr", "ue]") == [1000.0, True]
+
+
+def test_corpo_vazio_ou_null_nao_entrega_itens():
+    assert _itens() == []
+    assert _itens("  ") == []
+    assert _itens("nu", "ll") == []
+
+
+def test_corpo_que_nao_e_array_gera_value_error():
+    with pytest.raises(ValueError):
+        _itens('{"Message": ', '"erro"}')
+
+
+def test_array_truncado_gera_value_error():
+    with pytest.raises(ValueError):
+        _itens('[{"a": 1}, {"b"')